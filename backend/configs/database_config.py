@@ -1,5 +1,5 @@
 from typing import Any
-from pydantic import Field, NonNegativeInt, computed_field
+from pydantic import Field, NonNegativeInt, PositiveInt, computed_field
 from pydantic_settings import BaseSettings
 
 class DatabaseConfig(BaseSettings):
@@ -33,6 +33,11 @@ class DatabaseConfig(BaseSettings):
         default=False,
     )
 
+    SQLALCHEMY_BULK_CHUNK_SIZE: PositiveInt = Field(
+        description="Maximum number of rows written by one statement of the bulk insert and update paths.",
+        default=500,
+    )
+
     @computed_field
     def SQLALCHEMY_ENGINE_OPTIONS(self) -> dict[str, Any]:
         return {
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from fastapi import APIRouter, Depends
 from fastapi_utils.cbv import cbv
@@ -40,6 +41,20 @@ class RetrievalModel(BaseModel):
     keyword: Optional[str] = None
 
 
+class BatchRetrievalModel(BaseModel):
+    page: int
+    page_size: int
+    kb_ids: List[str]
+    doc_ids: List[str]
+    top_k: int = 1024
+    highlight: bool = False
+    similarity_threshold: float = 0.0
+    vector_similarity_weight: float = 0.3
+    questions: List[str]
+    rerank_id: Optional[str] = None
+    keyword: Optional[str] = None
+
+
 @cbv(chunk_rt)
 class ChunkRoute:
     @chunk_rt.delete("/chunk")
@@ -187,6 +202,54 @@ class ChunkRoute:
 
         return ranks
 
+    @chunk_rt.post("/chunk/retrieval-test/batch")
+    async def post_batch(self, data: BatchRetrievalModel, current_user=Depends(login_manager)):
+        account = current_user
+        tenant_ids = []
+
+        tenants = await TenantService.get_join_tenants(account)
+        for kb_id in data.kb_ids:
+            for tenant in tenants:
+                if await KnowledgebaseService.query(tenant_id=tenant.id, id=kb_id):
+                    tenant_ids.append(tenant.id)
+                    break
+            else:
+                raise BusinessError(error_code=ServiceErrorCode.NO_AUTHORIZATION,
+                                    description='Only owner of knowledgebase authorized for this operation.')
+
+        kb = await KnowledgebaseService.get_by_id(data.kb_ids[0])
+        if not kb:
+            raise BusinessError(error_code=ServiceErrorCode.ARGUMENT_ERROR, description="Knowledgebase not found!")
+
+        embd_mdl = await LLMBundle.create(kb.tenant_id, LLMType.EMBEDDING.value, llm_name=kb.embd_id)
+
+        rerank_mdl = None
+        if data.rerank_id:
+            rerank_mdl = await LLMBundle.create(kb.tenant_id, LLMType.RERANK.value, llm_name=data.rerank_id)
+
+        questions = list(data.questions)
+        if data.keyword:
+            chat_mdl = await LLMBundle.create(kb.tenant_id, LLMType.CHAT)
+            keywords = await asyncio.gather(*[keyword_extraction(chat_mdl, q) for q in questions])
+            questions = [q + kwd for q, kwd in zip(questions, keywords)]
+
+        labels = await asyncio.gather(*[label_question(question, [kb]) for question in questions])
+        ranks_list = await settings.retrievaler.retrieval_batch(questions, embd_mdl, tenant_ids, data.kb_ids,
+                                                                data.page, data.page_size,
+                                                                data.similarity_threshold,
+                                                                data.vector_similarity_weight,
+                                                                data.top_k,
+                                                                data.doc_ids, rerank_mdl=rerank_mdl,
+                                                                highlight=data.highlight,
+                                                                rank_features=labels)
+
+        for ranks, label in zip(ranks_list, labels):
+            for c in ranks["chunks"]:
+                c.pop("vector", None)
+            ranks["labels"] = label
+
+        return ranks_list
+
     @chunk_rt.get("/chunk/knowledge-graph/{doc_id}")
     async def get_knowledge_graph(self, doc_id: str, current_user=Depends(login_manager)):
         tenant_id = await DocumentService.get_tenant_id(doc_id)
@@ -32,6 +32,7 @@ class ConversationIds(BaseModel):
 class CompletionModel(BaseModel):
     messages: Optional[List[Dict[str, Any]]] = None
     stream: Optional[bool] = None
+    delta: Optional[bool] = None
 
 
 class TTSModel(BaseModel):
@@ -290,6 +291,13 @@ class ConversationRoute:
         async def stream():
             try:
                 async for ans in chat(dia, msg, True, **req):
+                    if ans.get("delta"):
+                        # Delta events only carry the new text, the conversation is updated by the final event.
+                        ans["id"] = message_id
+                        ans["session_id"] = conv.id
+                        yield "data:" + json.dumps({"code": 0, "message": "", "data": ans},
+                                                   ensure_ascii=False) + "\n\n"
+                        continue
                     ans = structure_answer(conv, ans, message_id, conv.id)
                     yield "data:" + json.dumps({"code": 0, "message": "", "data": ans}, ensure_ascii=False) + "\n\n"
                 await ConversationService.update_by_id(conv.id, conv.to_dict())
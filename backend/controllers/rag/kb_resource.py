@@ -1,3 +1,4 @@
+import functools
 import json
 from typing import List
 
@@ -11,13 +12,14 @@ import os
 from services.account_service import TenantService
 from services.document_service import DocumentService, File2DocumentService
 from services.dialog_service import DialogService
+from services.doc_store_cleanup_service import DocStoreCleanupService
 from services.file_service import FileService
 from services.service_error_code import ServiceErrorCode
 from services.task_service import TaskService
 from services.utils import duplicate_name, get_uuid
 from services.constants import DATASET_NAME_LIMIT
 from services.knowledgebase_service import KnowledgebaseService
-from models import StatusEnum, Account, File, FileSource, transactional, Task
+from models import StatusEnum, Account, File, FileSource, transactional, Task, after_commit
 from services import settings
 from rag.settings import PAGERANK_FLD
 from rag.nlp import search
@@ -169,7 +171,7 @@ class KBRoute:
         kb = await KnowledgebaseService.get_by_id(kb_id)
         for doc in await DocumentService.query(kb_id=kb_id):
             await TaskService.filter_delete([Task.doc_id == doc.id])
-            await DocumentService.remove_document(doc, kb.tenant_id)
+            await DocumentService.remove_document(doc, kb.tenant_id, clean_doc_store=False)
             f2ds = await File2DocumentService.find_by_document_id(doc.id)
             if f2ds:
                 await FileService.filter_delete(
@@ -179,12 +181,22 @@ class KBRoute:
         await FileService.filter_delete(
             [File.source_type == FileSource.KNOWLEDGEBASE, File.type == "folder", File.name == kb.name])
 
-        settings.docStoreConn.delete({"kb_id": kb_id}, search.index_name(kb.tenant_id), kb_id)
-        settings.docStoreConn.deleteIdx(search.index_name(kb.tenant_id), kb_id)
+        # the chunks of the knowledge base are removed in the background once it is deleted, the job can be
+        # followed by its id
+        job_id = get_uuid()
+        after_commit(f"drop_kb_{kb_id}", lambda: functools.partial(
+            DocStoreCleanupService.submit, kb.tenant_id, kb_id, drop_kb=True, job_id=job_id))
 
         await DialogService.delete_by_name(kb_id)
         await KnowledgebaseService.delete_by_id(kb_id)
-        return {"result": "success"}
+        return {"result": "success", "cleanup_job_id": job_id}
+
+    @kb_rt.get("/kb/cleanup_jobs/{job_id}")
+    async def get_cleanup_job(self, job_id: str, current_user=Depends(login_manager)):
+        progress = DocStoreCleanupService.progress(job_id)
+        if progress is None:
+            raise BusinessError(error_code=ServiceErrorCode.NOT_FOUND)
+        return progress
 
     @kb_rt.get("/kb/{kb_id}/tags")
     async def get_kb_tags(self, kb_id: str, current_user=Depends(login_manager)):
@@ -9,6 +9,7 @@ from datetime import datetime
 import json
 from timeit import default_timer as timer
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.http_conn import HTTP_CONN
 from configs import app_config
 
 sys_rt = APIRouter(prefix="/rag")
@@ -92,5 +93,6 @@ class SysRoute:
         except Exception:
             logging.exception("get task executor heartbeats failed!")
         res["task_executor_heartbeats"] = task_executor_heartbeats
+        res["llm_http"] = HTTP_CONN.stats()
 
         return res
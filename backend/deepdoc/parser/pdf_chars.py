@@ -0,0 +1,172 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# the function of the pool workers lives outside the deepdoc.parser package, its imports are theirs
+from deepdoc.pdf_chars_worker import CHAR_FIELDS, chars_dtype, has_color, chars_to_array, \
+    extract_page_chars  # noqa: F401
+from rag.settings import PDF_CHARS_WORKERS, PDF_CHARS_PAGES_PER_JOB
+
+# first characters of the chars followed by a space when the next char is half a char width away
+SPACED_CHARS = list("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ,.:;!%")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def array_to_chars(arr):
+    """The chars of a page as the dicts `RAGFlowPdfParser.__ocr` merges into the text boxes."""
+    cols = [arr[f].tolist() for f in CHAR_FIELDS] + [arr["text"].tolist()]
+    return [dict(zip(CHAR_FIELDS + ["text"], vals)) for vals in zip(*cols)]
+
+
+def merge_spaces(arr):
+    """
+    Append a space to the alphanumeric chars followed, half a char width or more away, by another char.
+    """
+    if len(arr) < 2:
+        return arr
+    first = arr["text"].astype("U1")
+    gap = arr["x0"][1:] - arr["x1"][:-1]
+    spaced = (first[:-1] != "") & (first[1:] != "") & np.isin(first[:-1], SPACED_CHARS) \
+        & (gap >= np.minimum(arr["width"][1:], arr["width"][:-1]) / 2)
+    idx = np.nonzero(spaced)[0]
+    if not len(idx):
+        return arr
+    arr = arr.copy()
+    arr["text"][idx] = np.char.add(arr["text"][idx], " ")
+    return arr
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned rather than forked, the parsers run in threaded processes
+            _pool = ProcessPoolExecutor(max_workers=PDF_CHARS_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+class PageCharsJob(object):
+    """
+    Characters of a page range extracted in the background, by `PDF_CHARS_WORKERS` processes taking
+    `PDF_CHARS_PAGES_PER_JOB` pages each. Short ranges, or a pool that can't be used, are done in the caller.
+    """
+
+    def __init__(self, fnm, page_from, page_to):
+        self.fnm = fnm
+        self.page_from = page_from
+        self.page_to = page_to
+        self.path = None
+        self.futures = []
+        per_job = max(PDF_CHARS_PAGES_PER_JOB, 1)
+        spans = [(s, min(s + per_job, page_to)) for s in range(page_from, page_to, per_job)]
+        if PDF_CHARS_WORKERS <= 1 or len(spans) <= 1:
+            return
+        try:
+            if not isinstance(fnm, str):
+                # the workers read the document from a file instead of a copy of its bytes per job
+                fd, self.path = tempfile.mkstemp(suffix=".pdf")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(fnm)
+            pool = _get_pool()
+            self.futures = [pool.submit(extract_page_chars, self.path or fnm, s, e) for s, e in spans]
+        except Exception:
+            logging.exception("PageCharsJob fails to submit, extracting in process")
+            self.futures = []
+
+    def result(self):
+        try:
+            if self.futures:
+                try:
+                    return [arr for f in self.futures for arr in f.result()]
+                except Exception:
+                    logging.exception("PageCharsJob fails in the pool, extracting in process")
+            return extract_page_chars(self.fnm, self.page_from, self.page_to)
+        finally:
+            if self.path:
+                os.remove(self.path)
+                self.path = None
+
+
+def text_layer_reliable(arr, min_chars, min_valid):
+    """
+    Whether the text layer of a page can stand for its OCR: enough chars, mostly mapped to Unicode
+    rather than `(cid:N)` or private use code points.
+    """
+    if len(arr) < min_chars:
+        return False
+    text = arr["text"]
+    first = text.astype("U1")
+    private = (first >= "\ue000") & (first <= "\uf8ff")
+    valid = (first != "") & ~np.char.startswith(text, "(cid:") & ~private
+    return float(np.mean(valid)) >= min_valid
+
+
+def chars_to_lines(arr, gap_ratio=2.0):
+    """
+    Group the chars of a page into text line boxes (x0, x1, top, bottom, text), like the detector's:
+    a char whose vertical center is within the current line joins it, and lines are split where
+    the gap between two chars is wider than `gap_ratio` times their height.
+    """
+    if not len(arr):
+        return []
+    top, bottom = arr["top"].tolist(), arr["bottom"].tolist()
+    x0, x1, height = arr["x0"].tolist(), arr["x1"].tolist(), arr["height"].tolist()
+
+    lines = []
+    line_bottom = None
+    for i in np.argsort(arr["top"], kind="stable").tolist():
+        if lines and (top[i] + bottom[i]) / 2 <= line_bottom:
+            lines[-1].append(i)
+            line_bottom = max(line_bottom, bottom[i])
+            continue
+        lines.append([i])
+        line_bottom = bottom[i]
+
+    segments = []
+    for line in lines:
+        line.sort(key=lambda i: x0[i])
+        seg = [line[0]]
+        for i in line[1:]:
+            if x0[i] - x1[seg[-1]] > gap_ratio * max(height[i], height[seg[-1]]):
+                segments.append(seg)
+                seg = []
+            seg.append(i)
+        segments.append(seg)
+
+    # spaces are merged in reading order, the chars of a segment being consecutive
+    ordered = merge_spaces(arr[np.array([i for seg in segments for i in seg], dtype=np.int64)])
+    texts = ordered["text"].tolist()
+    boxes, s = [], 0
+    for seg in segments:
+        txt = "".join(texts[s: s + len(seg)]).strip()
+        s += len(seg)
+        if not txt:
+            continue
+        boxes.append({"x0": min(x0[i] for i in seg), "x1": max(x1[i] for i in seg),
+                      "top": min(top[i] for i in seg), "bottom": max(bottom[i] for i in seg),
+                      "text": txt})
+    return boxes
@@ -0,0 +1,160 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from rag import settings
+
+
+class PdfPageImageStore(object):
+    """
+    The page images of a PDF page range, rendered on demand at `72 * zoomin` DPI.
+
+    Decoded pages are kept in an LRU bounded by `PDF_PAGE_CACHE_MB`. An evicted page is spilled to a
+    temporary directory, as raw RGB read back through a memory map (`raw`) or as PNG (`png`), so later
+    crops don't render it again; with `none` it is rendered again when needed.
+    Indexing and iteration give PIL images like the list it replaces.
+    """
+
+    def __init__(self, pdf, page_from=0, page_to=299, zoomin=3,
+                 cache_mb=None, spill=None):
+        self.pdf = pdf
+        self.pages = pdf.pages[page_from:page_to]
+        self.zoomin = zoomin
+        self.cache_bytes = (settings.PDF_PAGE_CACHE_MB if cache_mb is None else cache_mb) * 1024 * 1024
+        self.spill = (settings.PDF_PAGE_SPILL if spill is None else spill).lower()
+        self.sizes = [None] * len(self.pages)
+        self.cached = OrderedDict()
+        self.cached_bytes = 0
+        self.spilled = {}
+        self.spill_dir = None
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("page image index out of range")
+        if i in self.cached:
+            self.cached.move_to_end(i)
+            return self.cached[i]
+        img = self._load(i)
+        if img is None:
+            img = self.render(i, self.zoomin)
+            self.sizes[i] = img.size
+        self._cache(i, img)
+        return img
+
+    def render(self, i, zoomin):
+        """Render page `i` at the given zoom, without caching it."""
+        img = self.pages[i].to_image(resolution=72 * zoomin).annotated
+        return img if img.mode == "RGB" else img.convert("RGB")
+
+    def page_size(self, i):
+        """(width, height) of page `i` at the store's zoom."""
+        if self.sizes[i] is None:
+            self[i]
+        return self.sizes[i]
+
+    def crop(self, i, box):
+        """Same as `self[i].crop(box)`, reading only the cropped rows of a page spilled as raw RGB."""
+        if i in self.cached or self.spilled.get(i, (None, ""))[1] != "raw":
+            return self[i].crop(box)
+
+        path, _ = self.spilled[i]
+        w, h = self.sizes[i]
+        left, top, right, bott = [int(round(v)) for v in box]
+        right, bott = max(right, left), max(bott, top)
+        out = np.zeros((bott - top, right - left, 3), dtype=np.uint8)
+        x0, y0, x1, y1 = max(left, 0), max(top, 0), min(right, w), min(bott, h)
+        if x0 < x1 and y0 < y1:
+            mm = np.memmap(path, dtype=np.uint8, mode="r", shape=(h, w, 3))
+            out[y0 - top:y1 - top, x0 - left:x1 - left] = mm[y0:y1, x0:x1]
+            del mm
+        return Image.fromarray(out, "RGB")
+
+    def close(self):
+        self.cached.clear()
+        self.cached_bytes = 0
+        self.spilled = {}
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+        try:
+            self.pdf.close()
+        except Exception:
+            pass
+
+    def __del__(self):
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def _cache(self, i, img):
+        self.cached[i] = img
+        self.cached_bytes += img.size[0] * img.size[1] * 3
+        # the page just asked for always stays, even if it alone is over the cap
+        while self.cached_bytes > self.cache_bytes and len(self.cached) > 1:
+            j, evicted = self.cached.popitem(last=False)
+            self.cached_bytes -= evicted.size[0] * evicted.size[1] * 3
+            self._spill(j, evicted)
+
+    def _spill(self, i, img):
+        if i in self.spilled or self.spill not in ["raw", "png"]:
+            return
+        try:
+            if not self.spill_dir:
+                self.spill_dir = tempfile.mkdtemp(prefix="pdf_pages_")
+            if self.spill == "raw":
+                path = os.path.join(self.spill_dir, f"{i}.rgb")
+                arr = np.asarray(img, dtype=np.uint8)
+                mm = np.memmap(path, dtype=np.uint8, mode="w+", shape=arr.shape)
+                mm[:] = arr
+                mm.flush()
+                del mm
+            else:
+                path = os.path.join(self.spill_dir, f"{i}.png")
+                img.save(path, format="PNG", compress_level=1)
+            self.spilled[i] = (path, self.spill)
+        except Exception:
+            logging.exception(f"PdfPageImageStore fails to spill page {i}")
+
+    def _load(self, i):
+        if i not in self.spilled:
+            return
+        path, fmt = self.spilled[i]
+        if fmt == "raw":
+            w, h = self.sizes[i]
+            mm = np.memmap(path, dtype=np.uint8, mode="r", shape=(h, w, 3))
+            img = Image.fromarray(np.array(mm), "RGB")
+            del mm
+            return img
+        with Image.open(path) as img:
+            return img.convert("RGB")
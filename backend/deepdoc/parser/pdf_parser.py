@@ -20,6 +20,7 @@ import random
 from timeit import default_timer as timer
 
 import xgboost as xgb
+import xxhash
 from io import BytesIO
 import re
 import pdfplumber
@@ -29,8 +30,14 @@ from pypdf import PdfReader as pdf2_read
 
 from services import settings
 from services.utils.file_utils import get_project_base_directory
-from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
+from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer, BoxIndex
+from deepdoc.parser.pdf_page_store import PdfPageImageStore
+from deepdoc.parser.pdf_chars import PageCharsJob, has_color, chars_dtype, array_to_chars, merge_spaces, \
+    text_layer_reliable, chars_to_lines
 from rag.nlp import rag_tokenizer
+from rag.settings import PDF_OCR_CACHE_TTL, PDF_TEXT_LAYER, PDF_TEXT_LAYER_MIN_CHARS, PDF_TEXT_LAYER_MIN_VALID, \
+    PDF_TEXT_LAYER_MIN_REGION, PDF_OCR_RETRY_ZOOM
+from libs.utils import get_ocr_cache, set_ocr_cache, get_layout_cache, set_layout_cache
 from copy import deepcopy
 from huggingface_hub import snapshot_download
 
@@ -179,12 +186,7 @@ class RAGFlowPdfParser:
         return arr
 
     def _has_color(self, o):
-        if o.get("ncs", "") == "DeviceGray":
-            if o["stroking_color"] and o["stroking_color"][0] == 1 and o["non_stroking_color"] and \
-                    o["non_stroking_color"][0] == 1:
-                if re.match(r"[a-zT_\[\]\(\)-]+", o.get("text", "")):
-                    return False
-        return True
+        return has_color(o)
 
     def _table_transformer_job(self, ZM):
         logging.debug("Table processing...")
@@ -206,7 +208,7 @@ class RAGFlowPdfParser:
                 right *= ZM
                 bott *= ZM
                 pos.append((left, top))
-                imgs.append(self.page_images[p].crop((left, top, right, bott)))
+                imgs.append(self.page_images.crop(p, (left, top, right, bott)))
 
         assert len(self.page_images) == len(tbcnt) - 1
         if not imgs:
@@ -245,17 +247,18 @@ class RAGFlowPdfParser:
         clmns = sorted([r for r in self.tb_cpns if re.match(
             r"table column$", r["label"])], key=lambda x: (x["pn"], x["layoutno"], x["x0"]))
         clmns = Recognizer.layouts_cleanup(self.boxes, clmns, 5, 0.5)
+        rows_index, headers_index = BoxIndex(rows), BoxIndex(headers)
+        clmns_index, spans_index = BoxIndex(clmns), BoxIndex(spans)
         for b in self.boxes:
             if b.get("layout_type", "") != "table":
                 continue
-            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3)
+            ii = rows_index.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["R"] = ii
                 b["R_top"] = rows[ii]["top"]
                 b["R_bott"] = rows[ii]["bottom"]
 
-            ii = Recognizer.find_overlapped_with_threashold(
-                b, headers, thr=0.3)
+            ii = headers_index.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["H_top"] = headers[ii]["top"]
                 b["H_bott"] = headers[ii]["bottom"]
@@ -263,13 +266,13 @@ class RAGFlowPdfParser:
                 b["H_right"] = headers[ii]["x1"]
                 b["H"] = ii
 
-            ii = Recognizer.find_horizontally_tightest_fit(b, clmns)
+            ii = clmns_index.find_horizontally_tightest_fit(b)
             if ii is not None:
                 b["C"] = ii
                 b["C_left"] = clmns[ii]["x0"]
                 b["C_right"] = clmns[ii]["x1"]
 
-            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3)
+            ii = spans_index.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["H_top"] = spans[ii]["top"]
                 b["H_bott"] = spans[ii]["bottom"]
@@ -277,15 +280,48 @@ class RAGFlowPdfParser:
                 b["H_right"] = spans[ii]["x1"]
                 b["SP"] = ii
 
+    @staticmethod
+    def _image_hash(img):
+        return xxhash.xxh64(np.ascontiguousarray(img)).hexdigest()
+
+    @staticmethod
+    def _chars_digest(chars):
+        hasher = xxhash.xxh64()
+        for c in chars:
+            hasher.update(f"{c['text']}\t{c['x0']:.1f}\t{c['top']:.1f}\n".encode("utf-8"))
+        return hasher.hexdigest()
+
     def __ocr(self, pagenum, img, chars, ZM=3):
+        """
+        Detect and recognize the text boxes of a page image into `self.boxes`.
+        Returns the hash of the image when the OCR cache is on.
+        """
         start = timer()
-        bxs = self.ocr.detect(np.array(img))
+        img_np = np.array(img)
+        cache_key = None
+        if PDF_OCR_CACHE_TTL > 0:
+            # the boxes of a page depend on its bitmap, the zoom, the models and the text layer merged into them
+            cache_key = (self._image_hash(img_np), ZM, self.ocr.model_version, self._chars_digest(chars))
+            rows = get_ocr_cache(*cache_key)
+            if rows is not None:
+                bxs = [{"x0": x0, "x1": x1, "top": top, "bottom": bottom, "text": text, "page_number": pagenum}
+                       for x0, x1, top, bottom, text in rows]
+                if bxs and self.mean_height[-1] == 0:
+                    self.mean_height[-1] = np.median([b["bottom"] - b["top"]
+                                                      for b in bxs])
+                self.boxes.append(bxs)
+                logging.info(f"__ocr reuses {len(bxs)} cached boxes of page {pagenum}")
+                return cache_key[0]
+
+        bxs = self.ocr.detect(img_np)
         logging.info(f"__ocr detecting boxes of a image cost ({timer() - start}s)")
 
         start = timer()
         if not bxs:
+            if cache_key:
+                set_ocr_cache(*cache_key, [], PDF_OCR_CACHE_TTL)
             self.boxes.append([])
-            return
+            return cache_key[0] if cache_key else None
         bxs = [(line[0], line[1][0]) for line in bxs]
         bxs = Recognizer.sort_Y_firstly(
             [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
@@ -296,9 +332,10 @@ class RAGFlowPdfParser:
         )
         
         # merge chars in the same rect
+        bxs_index = BoxIndex(bxs)
         for c in Recognizer.sort_Y_firstly(
                 chars, self.mean_height[pagenum - 1] // 4):
-            ii = Recognizer.find_overlapped(c, bxs)
+            ii = bxs_index.find_overlapped(c)
             if ii is None:
                 self.lefted_chars.append(c)
                 continue
@@ -316,29 +353,112 @@ class RAGFlowPdfParser:
         logging.info(f"__ocr sorting {len(chars)} chars cost {timer() - start}s")
         start = timer()
         boxes_to_reg = []
-        img_np = np.array(img)
         for b in bxs:
             if not b["text"]:
-                left, right, top, bott = b["x0"] * ZM, b["x1"] * \
-                                         ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["box_image"] = self.ocr.get_rotate_crop_image(img_np, np.array([[left, top], [right, top], [right, bott], [left, bott]], dtype=np.float32))
                 boxes_to_reg.append(b)
             del b["txt"]
-        texts = self.ocr.recognize_batch([b["box_image"] for b in boxes_to_reg])
+        # the boxes are axis-aligned, so their crops are slices of the page image
+        quads = [[[b["x0"] * ZM, b["top"] * ZM], [b["x1"] * ZM, b["top"] * ZM],
+                  [b["x1"] * ZM, b["bottom"] * ZM], [b["x0"] * ZM, b["bottom"] * ZM]] for b in boxes_to_reg]
+        texts = self.ocr.recognize_batch(self.ocr.get_crop_images(img_np, quads))
         for i in range(len(boxes_to_reg)):
             boxes_to_reg[i]["text"] = texts[i]
-            del boxes_to_reg[i]["box_image"]
-        logging.info(f"__ocr recognize {len(bxs)} boxes cost {timer() - start}s")
+        logging.info(f"__ocr recognize {len(bxs)} boxes cost {timer() - start}s, "
+                     f"batch occupancy {self.ocr.text_recognizer.occupancy():.2f}")
         bxs = [b for b in bxs if b["text"]]
         if self.mean_height[-1] == 0:
             self.mean_height[-1] = np.median([b["bottom"] - b["top"]
                                               for b in bxs])
+        if cache_key:
+            set_ocr_cache(*cache_key, [[float(b["x0"]), float(b["x1"]), float(b["top"]), float(b["bottom"]), b["text"]]
+                                       for b in bxs], PDF_OCR_CACHE_TTL)
         self.boxes.append(bxs)
+        return cache_key[0] if cache_key else None
+
+    def _has_content(self, i):
+        """Whether page `i` has chars or images, a blank one isn't worth detecting again."""
+        if len(self.page_chars[i]):
+            return True
+        try:
+            return bool(self.page_images.pages[i].images)
+        except Exception:
+            return True
+
+    def _text_layer_boxes(self, i, img_np, ZM):
+        """
+        The text boxes of page `i` built from its text layer, with the image regions holding no text
+        detected and recognized like `__ocr` does. None when the text layer can't be relied on.
+        """
+        chars = self.page_chars[i]
+        if not text_layer_reliable(chars, PDF_TEXT_LAYER_MIN_CHARS, PDF_TEXT_LAYER_MIN_VALID):
+            return
+        start = timer()
+        bxs = chars_to_lines(chars)
+        for b in bxs:
+            b["page_number"] = i + 1
+
+        try:
+            page = self.page_images.pages[i]
+            regions = [(max(im["x0"], 0), max(im["top"], 0), min(im["x1"], page.width), min(im["bottom"], page.height))
+                       for im in page.images]
+            page_area = page.width * page.height
+        except Exception:
+            logging.exception(f"_text_layer_boxes fails to read the images of page {i + 1}")
+            regions, page_area = [], 0
+        bxs_index = BoxIndex(bxs)
+        quads, ocr_bxs = [], []
+        for x0, top, x1, bott in regions:
+            region = {"x0": x0, "x1": x1, "top": top, "bottom": bott}
+            if (x1 - x0) * (bott - top) < PDF_TEXT_LAYER_MIN_REGION * page_area or len(bxs_index.candidates(region)):
+                continue
+            # an embedded scan or figure: its text lines are detected on the region of the page image
+            left, upper = int(x0 * ZM), int(top * ZM)
+            dt_boxes, _ = self.ocr.text_detector(img_np[upper:int(bott * ZM), left:int(x1 * ZM)])
+            if dt_boxes is None or not len(dt_boxes):
+                continue
+            for b in self.ocr.sorted_boxes(dt_boxes):
+                if b[0][0] > b[1][0] or b[0][1] > b[-1][1]:
+                    continue
+                b = [[p[0] + left, p[1] + upper] for p in b]
+                quads.append(b)
+                ocr_bxs.append({"x0": b[0][0] / ZM, "x1": b[1][0] / ZM, "top": b[0][1] / ZM,
+                                "bottom": b[-1][1] / ZM, "page_number": i + 1})
+        if quads:
+            texts = self.ocr.recognize_batch(self.ocr.get_crop_images(img_np, quads))
+            for b, t in zip(ocr_bxs, texts):
+                b["text"] = t
+            bxs.extend([b for b in ocr_bxs if b["text"]])
+
+        if bxs and self.mean_height[-1] == 0:
+            self.mean_height[-1] = np.median([b["bottom"] - b["top"] for b in bxs])
+        logging.info(f"_text_layer_boxes builds {len(bxs)} boxes of page {i + 1}, {len(ocr_bxs)} by OCR, "
+                     f"cost {timer() - start}s")
+        return Recognizer.sort_Y_firstly(bxs, self.mean_height[-1] / 3)
+
+    def _layout_detections(self, ZM, batch_size=16):
+        """
+        The layout model's detections of every page, taken from the cache for the page images seen before.
+        """
+        if PDF_OCR_CACHE_TTL <= 0 or len(self.page_hashes) != len(self.page_images) \
+                or not all(self.page_hashes):
+            return
+        version = self.layouter.model_version
+        layouts = [get_layout_cache(h, ZM, version) for h in self.page_hashes]
+        missing = [i for i, lts in enumerate(layouts) if lts is None]
+        # pages go through the model batch by batch, so only a batch of them is held at once
+        for b in range(0, len(missing), batch_size):
+            idx = missing[b: b + batch_size]
+            detected = self.layouter.forward([self.page_images[i] for i in idx], thr=0.2, batch_size=batch_size)
+            for i, lts in zip(idx, detected):
+                layouts[i] = lts
+                set_layout_cache(self.page_hashes[i], ZM, version, lts, PDF_OCR_CACHE_TTL)
+        logging.info(f"_layout_detections reuses {len(layouts) - len(missing)} cached pages of {len(layouts)}")
+        return layouts
 
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
         self.boxes, self.page_layout = self.layouter(
-            self.page_images, self.boxes, ZM, drop=drop)
+            self.page_images, self.boxes, ZM, drop=drop, layouts=self._layout_detections(ZM))
         # cumlative Y
         for i in range(len(self.boxes)):
             self.boxes[i]["top"] += \
@@ -453,6 +573,66 @@ class RAGFlowPdfParser:
             bxs.pop(i + 1)
         self.boxes = bxs
 
+    def _concat_downward_target(self, boxes, up, dp, concat_between_pages=True):
+        """
+        Return the index of the box `up` concatenates with among the next 12 boxes from `dp`, or None.
+        The candidates left to the model are featurized together and scored by one predict call,
+        the first one in order above 0.5 wins.
+        """
+        candidates, target = [], None
+        i = dp
+        while i < min(dp + 12, len(boxes)):
+            ydis = self._y_dis(up, boxes[i])
+            smpg = up["page_number"] == boxes[i]["page_number"]
+            mh = self.mean_height[up["page_number"] - 1]
+            mw = self.mean_width[up["page_number"] - 1]
+            if smpg and ydis > mh * 4:
+                break
+            if not smpg and ydis > mh * 16:
+                break
+            down = boxes[i]
+            if not concat_between_pages and down["page_number"] > up["page_number"]:
+                break
+
+            if up.get("R", "") != down.get(
+                    "R", "") and up["text"][-1] != "，":
+                i += 1
+                continue
+
+            if re.match(r"[0-9]{2,3}/[0-9]{3}$", up["text"]) \
+                    or re.match(r"[0-9]{2,3}/[0-9]{3}$", down["text"]) \
+                    or not down["text"].strip():
+                i += 1
+                continue
+
+            if not down["text"].strip() or not up["text"].strip():
+                i += 1
+                continue
+
+            if up["x1"] < down["x0"] - 10 * \
+                    mw or up["x0"] > down["x1"] + 10 * mw:
+                i += 1
+                continue
+
+            if i - dp < 5 and up.get("layout_type") == "text":
+                if up.get("layoutno", "1") == down.get(
+                        "layoutno", "2"):
+                    target = i
+                    break
+                i += 1
+                continue
+
+            candidates.append(i)
+            i += 1
+
+        if candidates:
+            feas = [self._updown_concat_features(up, boxes[j]) for j in candidates]
+            scores = self.updown_cnt_mdl.predict(xgb.DMatrix(feas))
+            for j, score in zip(candidates, scores):
+                if score > 0.5:
+                    return j
+        return target
+
     def _concat_downward(self, concat_between_pages=True):
         # count boxes in the same row as a feature
         for i in range(len(self.boxes)):
@@ -470,67 +650,22 @@ class RAGFlowPdfParser:
                     break
                 j += 1
 
-        # concat between rows
+        # concat between rows, each box links downward to at most one box and the chain makes a block
         boxes = deepcopy(self.boxes)
         blocks = []
         while boxes:
-            chunks = []
-
-            def dfs(up, dp):
+            chunks, linked = [], []
+            up, dp = boxes[0], 1
+            while True:
                 chunks.append(up)
-                i = dp
-                while i < min(dp + 12, len(boxes)):
-                    ydis = self._y_dis(up, boxes[i])
-                    smpg = up["page_number"] == boxes[i]["page_number"]
-                    mh = self.mean_height[up["page_number"] - 1]
-                    mw = self.mean_width[up["page_number"] - 1]
-                    if smpg and ydis > mh * 4:
-                        break
-                    if not smpg and ydis > mh * 16:
-                        break
-                    down = boxes[i]
-                    if not concat_between_pages and down["page_number"] > up["page_number"]:
-                        break
-
-                    if up.get("R", "") != down.get(
-                            "R", "") and up["text"][-1] != "，":
-                        i += 1
-                        continue
-
-                    if re.match(r"[0-9]{2,3}/[0-9]{3}$", up["text"]) \
-                            or re.match(r"[0-9]{2,3}/[0-9]{3}$", down["text"]) \
-                            or not down["text"].strip():
-                        i += 1
-                        continue
-
-                    if not down["text"].strip() or not up["text"].strip():
-                        i += 1
-                        continue
-
-                    if up["x1"] < down["x0"] - 10 * \
-                            mw or up["x0"] > down["x1"] + 10 * mw:
-                        i += 1
-                        continue
-
-                    if i - dp < 5 and up.get("layout_type") == "text":
-                        if up.get("layoutno", "1") == down.get(
-                                "layoutno", "2"):
-                            dfs(down, i + 1)
-                            boxes.pop(i)
-                            return
-                        i += 1
-                        continue
-
-                    fea = self._updown_concat_features(up, down)
-                    if self.updown_cnt_mdl.predict(
-                            xgb.DMatrix([fea]))[0] <= 0.5:
-                        i += 1
-                        continue
-                    dfs(down, i + 1)
-                    boxes.pop(i)
-                    return
-
-            dfs(boxes[0], 1)
+                i = self._concat_downward_target(boxes, up, dp, concat_between_pages)
+                if i is None:
+                    break
+                linked.append(i)
+                up, dp = boxes[i], i + 1
+            # the linked indices increase along the chain
+            for i in reversed(linked):
+                boxes.pop(i)
             boxes.pop(0)
             if chunks:
                 blocks.append(chunks)
@@ -781,9 +916,8 @@ class RAGFlowPdfParser:
                 if right < left:
                     right = left + 1
                 poss.append((pn + self.page_from, left, right, top, bott))
-                return self.page_images[pn] \
-                    .crop((left * ZM, top * ZM,
-                           right * ZM, bott * ZM))
+                return self.page_images.crop(pn, (left * ZM, top * ZM,
+                                                  right * ZM, bott * ZM))
             pn = {}
             for b in bxs:
                 p = b["page_number"] - 1
@@ -863,8 +997,8 @@ class RAGFlowPdfParser:
         page_images_cnt = len(self.page_images)
         if pn[-1] - 1 >= page_images_cnt:
             return ""
-        while bott * ZM > self.page_images[pn[-1] - 1].size[1]:
-            bott -= self.page_images[pn[-1] - 1].size[1] / ZM
+        while bott * ZM > self.page_images.page_size(pn[-1] - 1)[1]:
+            bott -= self.page_images.page_size(pn[-1] - 1)[1] / ZM
             pn.append(pn[-1] + 1)
             if pn[-1] - 1 >= page_images_cnt:
                 return ""
@@ -885,7 +1019,7 @@ class RAGFlowPdfParser:
             if b.get("layout_type"):
                 return True
             if width(
-                    b) > self.page_images[b["page_number"] - 1].size[0] / ZM / 3:
+                    b) > self.page_images.page_size(b["page_number"] - 1)[0] / ZM / 3:
                 return True
             if b["bottom"] - b["top"] > self.mean_height[b["page_number"] - 1]:
                 return True
@@ -895,7 +1029,7 @@ class RAGFlowPdfParser:
         while boxes:
             lines = []
             widths = []
-            pw = self.page_images[boxes[0]["page_number"] - 1].size[0] / ZM
+            pw = self.page_images.page_size(boxes[0]["page_number"] - 1)[0] / ZM
             mh = self.mean_height[boxes[0]["page_number"] - 1]
             mj = self.proj_match(
                 boxes[0]["text"]) or boxes[0].get(
@@ -963,23 +1097,22 @@ class RAGFlowPdfParser:
         self.garbages = {}
         self.page_cum_height = [0]
         self.page_layout = []
+        self.page_hashes = []
         self.page_from = page_from
+        if isinstance(getattr(self, "page_images", None), PdfPageImageStore):
+            self.page_images.close()
         start = timer()
         try:
             self.pdf = pdfplumber.open(fnm) if isinstance(
                 fnm, str) else pdfplumber.open(BytesIO(fnm))
-            self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                enumerate(self.pdf.pages[page_from:page_to])]
-            try:
-                self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in self.pdf.pages[page_from:page_to]]
-            except Exception as e:
-                logging.info(f"Failed to extract characters for pages {page_from}-{page_to}: {str(e)}")
-                self.page_chars = [[] for _ in range(page_to - page_from)]  # If failed to extract, using empty list instead.
-                
+            # pages are rendered when first used and the store keeps its own handle of the document
+            self.page_images = PdfPageImageStore(self.pdf, page_from, page_to, zoomin)
             self.total_page = len(self.pdf.pages)
+            # extracted by the worker processes while the outlines are read
+            chars_job = PageCharsJob(fnm, page_from, min(page_to, self.total_page))
         except Exception:
             logging.exception("RAGFlowPdfParser __images__")
-        logging.info(f"__images__ dedupe_chars cost {timer() - start}s")
+            chars_job = None
 
         self.outlines = []
         try:
@@ -999,9 +1132,17 @@ class RAGFlowPdfParser:
         if not self.outlines:
             logging.info("Miss outlines")
 
+        self.page_chars = [np.zeros(0, dtype=chars_dtype()) for _ in self.page_images]
+        try:
+            if chars_job:
+                self.page_chars = chars_job.result()
+        except Exception as e:
+            logging.info(f"Failed to extract characters for pages {page_from}-{page_to}: {str(e)}")
+        logging.info(f"__images__ dedupe_chars cost {timer() - start}s")
+
         logging.debug("Images converted.")
         self.is_english = [re.search(r"[a-zA-Z0-9,/¸;:'\[\]\(\)!@#$%^&*\"?<>._-]{30,}", "".join(
-            random.choices([c["text"] for c in self.page_chars[i]], k=min(100, len(self.page_chars[i]))))) for i in
+            random.choices(self.page_chars[i]["text"].tolist(), k=min(100, len(self.page_chars[i]))))) for i in
                            range(len(self.page_chars))]
         if sum([1 if e else 0 for e in self.is_english]) > len(
                 self.page_images) / 2:
@@ -1011,30 +1152,38 @@ class RAGFlowPdfParser:
 
         start = timer()
         for i, img in enumerate(self.page_images):
-            chars = self.page_chars[i] if not self.is_english else []
+            page_chars = self.page_chars[i] if not self.is_english else self.page_chars[i][:0]
             self.mean_height.append(
-                np.median(sorted([c["height"] for c in chars])) if chars else 0
+                float(np.median(page_chars["height"])) if len(page_chars) else 0
             )
             self.mean_width.append(
-                np.median(sorted([c["width"] for c in chars])) if chars else 8
+                float(np.median(page_chars["width"])) if len(page_chars) else 8
             )
             self.page_cum_height.append(img.size[1] / zoomin)
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
 
-            self.__ocr(i + 1, img, chars, zoomin)
+            if PDF_TEXT_LAYER:
+                img_np = np.array(img)
+                bxs = self._text_layer_boxes(i, img_np, zoomin)
+                if bxs:
+                    # born-digital page: the detector only ran on its image regions without text
+                    self.boxes.append(bxs)
+                    self.page_hashes.append(self._image_hash(img_np) if PDF_OCR_CACHE_TTL > 0 else None)
+                    if callback and i % 6 == 5:
+                        callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+                    continue
+
+            chars = array_to_chars(merge_spaces(page_chars))
+            self.page_hashes.append(self.__ocr(i + 1, img, chars, zoomin))
+            if PDF_OCR_RETRY_ZOOM and not self.boxes[-1] and zoomin < 9 and self._has_content(i):
+                # only the pages without any text box are detected again, at a higher zoom
+                self.boxes.pop()
+                self.__ocr(i + 1, self.page_images.render(i, zoomin * 3), chars, zoomin * 3)
             if callback and i % 6 == 5:
                 callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
         logging.info(f"__images__ {len(self.page_images)} pages cost {timer() - start}s")
 
         if not self.is_english and not any(
-                [c for c in self.page_chars]) and self.boxes:
+                [len(c) for c in self.page_chars]) and self.boxes:
             bxes = [b for bxs in self.boxes for b in bxs]
             self.is_english = re.search(r"[\na-zA-Z0-9,/¸;:'\[\]\(\)!@#$%^&*\"?<>._-]{30,}",
                                         "".join([b["text"] for b in random.choices(bxes, k=min(30, len(bxes)))]))
@@ -1043,8 +1192,6 @@ class RAGFlowPdfParser:
 
         self.page_cum_height = np.cumsum(self.page_cum_height)
         assert len(self.page_cum_height) == len(self.page_images) + 1
-        if len(self.boxes) == 0 and zoomin < 9:
-            self.__images__(fnm, zoomin * 3, page_from, page_to, callback)
 
     async def __call__(self, fnm, need_image=True, zoomin=3, return_html=False):
         self.__images__(fnm, zoomin)
@@ -1082,38 +1229,38 @@ class RAGFlowPdfParser:
         poss.insert(0, ([pos[0][0]], pos[1], pos[2], max(
             0, pos[3] - 120), max(pos[3] - GAP, 0)))
         pos = poss[-1]
-        poss.append(([pos[0][-1]], pos[1], pos[2], min(self.page_images[pos[0][-1]].size[1] / ZM, pos[4] + GAP),
-                     min(self.page_images[pos[0][-1]].size[1] / ZM, pos[4] + 120)))
+        poss.append(([pos[0][-1]], pos[1], pos[2], min(self.page_images.page_size(pos[0][-1])[1] / ZM, pos[4] + GAP),
+                     min(self.page_images.page_size(pos[0][-1])[1] / ZM, pos[4] + 120)))
 
         positions = []
         for ii, (pns, left, right, top, bottom) in enumerate(poss):
             right = left + max_width
             bottom *= ZM
             for pn in pns[1:]:
-                bottom += self.page_images[pn - 1].size[1]
+                bottom += self.page_images.page_size(pn - 1)[1]
             imgs.append(
-                self.page_images[pns[0]].crop((left * ZM, top * ZM,
+                self.page_images.crop(pns[0], (left * ZM, top * ZM,
                                                right *
                                                ZM, min(
-                    bottom, self.page_images[pns[0]].size[1])
+                    bottom, self.page_images.page_size(pns[0])[1])
                                                ))
             )
             if 0 < ii < len(poss) - 1:
                 positions.append((pns[0] + self.page_from, left, right, top, min(
-                    bottom, self.page_images[pns[0]].size[1]) / ZM))
-            bottom -= self.page_images[pns[0]].size[1]
+                    bottom, self.page_images.page_size(pns[0])[1]) / ZM))
+            bottom -= self.page_images.page_size(pns[0])[1]
             for pn in pns[1:]:
                 imgs.append(
-                    self.page_images[pn].crop((left * ZM, 0,
+                    self.page_images.crop(pn, (left * ZM, 0,
                                                right * ZM,
                                                min(bottom,
-                                                   self.page_images[pn].size[1])
+                                                   self.page_images.page_size(pn)[1])
                                                ))
                 )
                 if 0 < ii < len(poss) - 1:
                     positions.append((pn + self.page_from, left, right, 0, min(
-                        bottom, self.page_images[pn].size[1]) / ZM))
-                bottom -= self.page_images[pn].size[1]
+                        bottom, self.page_images.page_size(pn)[1]) / ZM))
+                bottom -= self.page_images.page_size(pn)[1]
 
         if not imgs:
             if need_position:
@@ -1147,13 +1294,13 @@ class RAGFlowPdfParser:
         top = bx["top"] - self.page_cum_height[pn - 1]
         bott = bx["bottom"] - self.page_cum_height[pn - 1]
         poss.append((pn, bx["x0"], bx["x1"], top, min(
-            bott, self.page_images[pn - 1].size[1] / ZM)))
-        while bott * ZM > self.page_images[pn - 1].size[1]:
-            bott -= self.page_images[pn - 1].size[1] / ZM
+            bott, self.page_images.page_size(pn - 1)[1] / ZM)))
+        while bott * ZM > self.page_images.page_size(pn - 1)[1]:
+            bott -= self.page_images.page_size(pn - 1)[1] / ZM
             top = 0
             pn += 1
             poss.append((pn, bx["x0"], bx["x1"], top, min(
-                bott, self.page_images[pn - 1].size[1] / ZM)))
+                bott, self.page_images.page_size(pn - 1)[1] / ZM)))
         return poss
 
 
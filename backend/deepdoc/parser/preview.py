@@ -0,0 +1,140 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import re
+import unicodedata
+from io import BytesIO
+
+import xxhash
+from docx import Document
+from openpyxl import load_workbook
+from pypdf import PdfReader
+
+from deepdoc.parser.utils import get_text
+from libs.utils import get_preview_cache, set_preview_cache
+from rag.settings import DOC_PREVIEW_BYTES, DOC_PREVIEW_CACHE_TTL, PDF_TEXT_LAYER_MIN_CHARS, PDF_TEXT_LAYER_MIN_VALID
+
+TEXT_SUFFIXES = {"txt", "md", "markdown", "csv", "json", "yml", "xml", "ini", "sql", "py", "js", "java", "c",
+                 "cpp", "h", "php", "go", "ts", "sh", "cs", "kt"}
+HTML_SUFFIXES = {"htm", "html"}
+
+
+def _suffix(filename):
+    return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+
+def _truncate(txt, max_bytes):
+    return txt.encode("utf-8")[:max_bytes].decode("utf-8", errors="ignore")
+
+
+def _collect(texts, max_bytes):
+    """Join the texts until `max_bytes` of them are collected, reading no further than needed."""
+    parts, size = [], 0
+    for txt in texts:
+        if not txt:
+            continue
+        parts.append(txt)
+        size += len(txt.encode("utf-8")) + 1
+        if size >= max_bytes:
+            break
+    return "\n".join(parts)
+
+
+def text_reliable(txt, min_chars=PDF_TEXT_LAYER_MIN_CHARS, min_valid=PDF_TEXT_LAYER_MIN_VALID):
+    """
+    `pdf_chars.text_layer_reliable` on extracted text: enough chars, mostly mapped to Unicode rather than
+    private use, replacement or control code points, as the glyphs of a font without a ToUnicode map come out.
+    """
+    chars = [c for c in txt if not c.isspace()]
+    if len(chars) < min_chars:
+        return False
+    valid = [c != "\ufffd" and unicodedata.category(c) not in ("Co", "Cc", "Cs") for c in chars]
+    return sum(valid) / len(chars) >= min_valid
+
+
+def _pdf_texts(binary):
+    for page in PdfReader(BytesIO(binary)).pages:
+        yield page.extract_text() or ""
+
+
+def _docx_texts(binary):
+    for p in Document(BytesIO(binary)).paragraphs:
+        yield p.text.strip()
+
+
+def _xlsx_texts(binary):
+    wb = load_workbook(BytesIO(binary), read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            yield ws.title
+            for row in ws.iter_rows(values_only=True):
+                yield "\t".join(["" if v is None else str(v) for v in row]).strip()
+    finally:
+        wb.close()
+
+
+def _html_text(binary, max_bytes):
+    # markup takes most of the bytes of a page, more of them are decoded than are kept
+    txt = get_text("", binary[: max_bytes * 8])
+    txt = re.sub(r"(?is)<(script|style)[^>]*>.*?</\1>", " ", txt)
+    txt = re.sub(r"<[^>]+>", " ", txt)
+    return re.sub(r"[ \t\r\f]+", " ", txt)
+
+
+def _extract(filename, binary, max_bytes):
+    suffix = _suffix(filename)
+    if suffix == "pdf":
+        # a garbage text layer gives no preview, the document is then read by OCR
+        txt = _collect(_pdf_texts(binary), max_bytes)
+        return txt if text_reliable(txt) else ""
+    if suffix == "docx":
+        return _collect(_docx_texts(binary), max_bytes)
+    if suffix == "xlsx":
+        return _collect(_xlsx_texts(binary), max_bytes)
+    if suffix in HTML_SUFFIXES:
+        return _html_text(binary, max_bytes)
+    if suffix in TEXT_SUFFIXES:
+        # a few more bytes than kept, find_codec guesses better on them and a cut char is dropped anyway
+        return get_text(filename, binary[: max_bytes + 16])
+    # legacy office formats, slides, pictures and audio have no text to read without a model
+    return ""
+
+
+def document_preview(filename: str, binary, max_bytes: int = DOC_PREVIEW_BYTES) -> str:
+    """
+    The first `max_bytes` of a document's text, read from its text layer only: no OCR nor layout model
+    is run, so a scanned PDF, one whose text layer is unreliable, or a picture gives an empty preview.
+    It is cached by the hash of the file, letting the classifier and the parse task share it.
+    """
+    if not binary:
+        return ""
+    hasher = xxhash.xxh64()
+    hasher.update(binary)
+    hasher.update(_suffix(filename).encode("utf-8"))
+    file_hash = hasher.hexdigest()
+
+    txt = get_preview_cache(file_hash, max_bytes)
+    if txt is not None:
+        return txt
+    try:
+        txt = _truncate(_extract(filename, binary, max_bytes), max_bytes).strip()
+    except Exception:
+        logging.exception(f"document_preview fails to read {filename}")
+        return ""
+    if DOC_PREVIEW_CACHE_TTL > 0:
+        set_preview_cache(file_hash, max_bytes, txt, DOC_PREVIEW_CACHE_TTL)
+    return txt
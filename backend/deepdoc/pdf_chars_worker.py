@@ -0,0 +1,69 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Extraction of the characters of PDF pages, run by the process pool of `deepdoc.parser.pdf_chars`.
+It stays out of the `deepdoc.parser` package and imports nothing but pdfplumber and numpy, so a spawned
+worker doesn't load the parsers, their models and their connections.
+"""
+import logging
+import re
+from io import BytesIO
+
+import numpy as np
+import pdfplumber
+
+CHAR_FIELDS = ["x0", "x1", "top", "bottom", "width", "height"]
+
+
+def chars_dtype(text_len=1):
+    # one more character than the longest text, for the space `merge_spaces` may append
+    return np.dtype([(f, np.float32) for f in CHAR_FIELDS] + [("text", f"U{max(text_len, 1) + 1}")])
+
+
+def has_color(o):
+    if o.get("ncs", "") == "DeviceGray":
+        if o["stroking_color"] and o["stroking_color"][0] == 1 and o["non_stroking_color"] and \
+                o["non_stroking_color"][0] == 1:
+            if re.match(r"[a-zT_\[\]\(\)-]+", o.get("text", "")):
+                return False
+    return True
+
+
+def chars_to_array(chars):
+    arr = np.zeros(len(chars), dtype=chars_dtype(max([len(c["text"]) for c in chars], default=1)))
+    for f in CHAR_FIELDS:
+        arr[f] = [c[f] for c in chars]
+    arr["text"] = [c["text"] for c in chars]
+    return arr
+
+
+def extract_page_chars(fnm, page_from, page_to):
+    """
+    The deduplicated, visible characters of the pages in [page_from, page_to), one array of `chars_dtype` per page.
+    Runs in the worker processes, so it only takes the file path or its bytes.
+    """
+    res = []
+    with pdfplumber.open(fnm if isinstance(fnm, str) else BytesIO(fnm)) as pdf:
+        for pn, page in enumerate(pdf.pages[page_from:page_to]):
+            try:
+                chars = [c for c in page.dedupe_chars().chars if has_color(c)]
+            except Exception as e:
+                # If failed to extract, using empty list instead.
+                logging.info(f"Failed to extract characters of page {page_from + pn}: {str(e)}")
+                chars = []
+            res.append(chars_to_array(chars))
+    return res
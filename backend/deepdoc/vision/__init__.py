@@ -21,6 +21,7 @@ from .ocr import OCR
 from .recognizer import Recognizer
 from .layout_recognizer import LayoutRecognizer4YOLOv10 as LayoutRecognizer
 from .table_structure_recognizer import TableStructureRecognizer
+from .spatial_index import BoxIndex
 
 
 def init_in_out(args):
@@ -74,5 +75,6 @@ __all__ = [
     "Recognizer",
     "LayoutRecognizer",
     "TableStructureRecognizer",
+    "BoxIndex",
     "init_in_out",
 ]
@@ -26,6 +26,7 @@ from huggingface_hub import snapshot_download
 from services.utils.file_utils import get_project_base_directory
 from deepdoc.vision import Recognizer
 from deepdoc.vision.operators import nms
+from deepdoc.vision.spatial_index import BoxIndex
 
 
 class LayoutRecognizer(Recognizer):
@@ -58,7 +59,7 @@ class LayoutRecognizer(Recognizer):
         self.garbage_layouts = ["footer", "header", "reference"]
 
     def __call__(self, image_list, ocr_res, scale_factor=3,
-                 thr=0.2, batch_size=16, drop=True):
+                 thr=0.2, batch_size=16, drop=True, layouts=None):
         def __is_garbage(b):
             patt = [r"^•+$", r"(版权归©|免责条款|地址[:：])", r"\.{3,}", "^[0-9]{1,2} / ?[0-9]{1,2}$",
                     r"^[0-9]{1,2} of [0-9]{1,2}$", "^http://[^ ]{12,}",
@@ -67,7 +68,9 @@ class LayoutRecognizer(Recognizer):
                     ]
             return any([re.search(p, b["text"]) for p in patt])
 
-        layouts = super().__call__(image_list, thr, batch_size)
+        # `layouts` are the model's detections of the images when the caller already has them
+        if layouts is None:
+            layouts = super().__call__(image_list, thr, batch_size)
         # save_results(image_list, layouts, self.labels, output_dir='output/', threshold=0.7)
         assert len(image_list) == len(ocr_res)
         # Tag layout type
@@ -87,11 +90,13 @@ class LayoutRecognizer(Recognizer):
                 [lt["bottom"] - lt["top"] for lt in lts]) / 2)
             lts = self.layouts_cleanup(bxs, lts)
             page_layout.append(lts)
+            page_height = image_list[pn].size[1]
 
             # Tag layout type, layouts are ready
             def findLayout(ty):
                 nonlocal bxs, lts, self
                 lts_ = [lt for lt in lts if lt["type"] == ty]
+                lts_index = BoxIndex(lts_)
                 i = 0
                 while i < len(bxs):
                     if bxs[i].get("layout_type"):
@@ -101,8 +106,7 @@ class LayoutRecognizer(Recognizer):
                         bxs.pop(i)
                         continue
 
-                    ii = self.find_overlapped_with_threashold(bxs[i], lts_,
-                                                              thr=0.4)
+                    ii = lts_index.find_overlapped_with_threashold(bxs[i], thr=0.4)
                     if ii is None:  # belong to nothing
                         bxs[i]["layout_type"] = ""
                         i += 1
@@ -110,9 +114,9 @@ class LayoutRecognizer(Recognizer):
                     lts_[ii]["visited"] = True
                     keep_feats = [
                         lts_[
-                            ii]["type"] == "footer" and bxs[i]["bottom"] < image_list[pn].size[1] * 0.9 / scale_factor,
+                            ii]["type"] == "footer" and bxs[i]["bottom"] < page_height * 0.9 / scale_factor,
                         lts_[
-                            ii]["type"] == "header" and bxs[i]["top"] > image_list[pn].size[1] * 0.1 / scale_factor,
+                            ii]["type"] == "header" and bxs[i]["top"] > page_height * 0.1 / scale_factor,
                     ]
                     if drop and lts_[
                             ii]["type"] in self.garbage_layouts and not any(keep_feats):
@@ -15,7 +15,7 @@
 #
 
 import logging
-import copy
+import threading
 import time
 import os
 
@@ -27,11 +27,11 @@ from . import operators
 import math
 import numpy as np
 import cv2
-import onnxruntime as ort
+from .onnx_session import ONNX_SESSIONS
 
 from .postprocess import build_post_process
 
-loaded_models = {}
+rec_schedulers = {}
 
 
 def transform(data, ops=None):
@@ -68,65 +68,70 @@ def create_operators(op_param_list, global_config=None):
 
 
 def load_model(model_dir, nm):
-    model_file_path = os.path.join(model_dir, nm + ".onnx")
-    global loaded_models
-    loaded_model = loaded_models.get(model_file_path)
-    if loaded_model:
-        logging.info(f"load_model {model_file_path} reuses cached model")
-        return loaded_model
-
-    if not os.path.exists(model_file_path):
-        raise ValueError("not find model file path {}".format(
-            model_file_path))
-
-    def cuda_is_available():
-        try:
-            import torch
-            if torch.cuda.is_available():
-                return True
-        except Exception:
-            return False
-        return False
-
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
-
-    # https://github.com/microsoft/onnxruntime/issues/9509#issuecomment-951546580
-    # Shrink GPU memory after execution
-    run_options = ort.RunOptions()
-    if cuda_is_available():
-        cuda_provider_options = {
-            "device_id": 0,  # Use specific GPU
-            "gpu_mem_limit": 512 * 1024 * 1024,  # Limit gpu memory
-            "arena_extend_strategy": "kNextPowerOfTwo",  # gpu memory allocation strategy
-        }
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CUDAExecutionProvider'],
-            provider_options=[cuda_provider_options]
-        )
-        run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "gpu:0")
-        logging.info(f"load_model {model_file_path} uses GPU")
-    else:
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CPUExecutionProvider'])
-        run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu")
-        logging.info(f"load_model {model_file_path} uses CPU")
-    loaded_model = (sess, run_options)
-    loaded_models[model_file_path] = loaded_model
-    return loaded_model
+    return ONNX_SESSIONS.load(model_dir, nm)
+
+
+def model_version(model_dir, nm):
+    """
+    Identify a model file by its name, size and modification time, to key the cached results of the model.
+    """
+    return ONNX_SESSIONS.model_version(model_dir, nm)
+
+
+class RecognizeScheduler(object):
+    """
+    Coalesce the crops of the concurrent callers of a recognition model.
+    The first caller finding the model idle runs everything pending, its own crops and the other callers',
+    as one width-bucketed plan, and hands the results back; the others wait for theirs.
+    """
+
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.cond = threading.Condition()
+        self.pending = []
+        self.running = False
+
+    def __call__(self, img_list):
+        req = {"imgs": img_list, "res": None, "err": None}
+        with self.cond:
+            self.pending.append(req)
+            while self.running and req["res"] is None and req["err"] is None:
+                self.cond.wait()
+            if req["res"] is None and req["err"] is None:
+                self.running = True
+                reqs, self.pending = self.pending, []
+            else:
+                reqs = []
+
+        if reqs:
+            try:
+                res = self.recognizer.recognize([img for r in reqs for img in r["imgs"]])
+                st = 0
+                for r in reqs:
+                    r["res"] = res[st: st + len(r["imgs"])]
+                    st += len(r["imgs"])
+            except Exception as e:
+                for r in reqs:
+                    r["err"] = e
+            finally:
+                with self.cond:
+                    self.running = False
+                    self.cond.notify_all()
+
+        if req["err"] is not None:
+            raise req["err"]
+        return req["res"]
 
 
 class TextRecognizer(object):
+    rec_image_shape = [int(v) for v in "3, 48, 320".split(",")]
+    rec_batch_num = 16
+    # a batch holds crops of one width bucket, within a budget of padded pixel columns
+    rec_width_step = 160
+    rec_batch_width = 16 * 640
+
     def __init__(self, model_dir):
-        self.rec_image_shape = [int(v) for v in "3, 48, 320".split(",")]
-        self.rec_batch_num = 16
+        self.stats = {"batches": 0, "crops": 0, "width": 0, "padded_width": 0}
         postprocess_params = {
             'name': 'CTCLabelDecode',
             "character_dict_path": os.path.join(model_dir, "ocr.res"),
@@ -135,6 +140,8 @@ class TextRecognizer(object):
         self.postprocess_op = build_post_process(postprocess_params)
         self.predictor, self.run_options = load_model(model_dir, 'rec')
         self.input_tensor = self.predictor.get_inputs()[0]
+        # the session is shared by model path, so are the crops of its callers
+        self.scheduler = rec_schedulers.setdefault(os.path.join(model_dir, "rec.onnx"), RecognizeScheduler(self))
 
     def resize_norm_img(self, img, max_wh_ratio):
         imgC, imgH, imgW = self.rec_image_shape
@@ -346,35 +353,54 @@ class TextRecognizer(object):
 
         return img
 
-    def __call__(self, img_list):
-        img_num = len(img_list)
-        # Calculate the aspect ratio of all text bars
-        width_list = []
-        for img in img_list:
-            width_list.append(img.shape[1] / float(img.shape[0]))
-        # Sorting can speed up the recognition process
-        indices = np.argsort(np.array(width_list))
-        rec_res = [['', 0.0]] * img_num
-        batch_num = self.rec_batch_num
-        st = time.time()
-
-        for beg_img_no in range(0, img_num, batch_num):
-            end_img_no = min(img_num, beg_img_no + batch_num)
+    def plan_batches(self, img_list):
+        """
+        Sort the crops by aspect ratio and group them into batches.
+        A new batch starts at a new width bucket, at `rec_batch_num` crops, or when the padded width of
+        the batch would go over `rec_batch_width`.
+        """
+        imgC, imgH, imgW = self.rec_image_shape[:3]
+        # the width a crop is padded to at least
+        widths = [max(imgW, imgH * img.shape[1] / float(img.shape[0])) for img in img_list]
+        indices = np.argsort(np.array(widths), kind="stable").tolist()
+        batches, batch, bucket = [], [], None
+        for i in indices:
+            b = math.ceil(widths[i] / self.rec_width_step)
+            if batch and (b != bucket or len(batch) >= self.rec_batch_num
+                          or (len(batch) + 1) * widths[i] > self.rec_batch_width):
+                batches.append(batch)
+                batch = []
+            if not batch:
+                bucket = b
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches, widths
+
+    def occupancy(self):
+        """Share of the recognized pixel columns that were crops rather than padding, over all callers."""
+        stats = self.scheduler.recognizer.stats
+        return stats["width"] / stats["padded_width"] if stats["padded_width"] else 1.0
+
+    def recognize(self, img_list):
+        rec_res = [['', 0.0]] * len(img_list)
+        batches, widths = self.plan_batches(img_list)
+        imgC, imgH, imgW = self.rec_image_shape[:3]
+
+        for batch in batches:
             norm_img_batch = []
-            imgC, imgH, imgW = self.rec_image_shape[:3]
-            max_wh_ratio = imgW / imgH
-            # max_wh_ratio = 0
-            for ino in range(beg_img_no, end_img_no):
-                h, w = img_list[indices[ino]].shape[0:2]
-                wh_ratio = w * 1.0 / h
-                max_wh_ratio = max(max_wh_ratio, wh_ratio)
-            for ino in range(beg_img_no, end_img_no):
-                norm_img = self.resize_norm_img(img_list[indices[ino]],
-                                                max_wh_ratio)
+            max_wh_ratio = max(imgW / imgH, max([widths[i] for i in batch]) / imgH)
+            for i in batch:
+                norm_img = self.resize_norm_img(img_list[i], max_wh_ratio)
                 norm_img = norm_img[np.newaxis, :]
                 norm_img_batch.append(norm_img)
             norm_img_batch = np.concatenate(norm_img_batch)
             norm_img_batch = norm_img_batch.copy()
+            self.stats["batches"] += 1
+            self.stats["crops"] += len(batch)
+            self.stats["width"] += sum([min(norm_img_batch.shape[3], math.ceil(imgH * img_list[i].shape[1] / float(img_list[i].shape[0])))
+                                        for i in batch])
+            self.stats["padded_width"] += norm_img_batch.shape[3] * len(batch)
 
             input_dict = {}
             input_dict[self.input_tensor.name] = norm_img_batch
@@ -389,9 +415,16 @@ class TextRecognizer(object):
             preds = outputs[0]
             rec_result = self.postprocess_op(preds)
             for rno in range(len(rec_result)):
-                rec_res[indices[beg_img_no + rno]] = rec_result[rno]
+                rec_res[batch[rno]] = rec_result[rno]
 
-        return rec_res, time.time() - st
+        logging.debug(f"TextRecognizer {len(img_list)} crops in {len(batches)} batches, occupancy {self.occupancy():.2f}")
+        return rec_res
+
+    def __call__(self, img_list):
+        st = time.time()
+        if not img_list:
+            return [], time.time() - st
+        return self.scheduler(img_list), time.time() - st
 
 
 class TextDetector(object):
@@ -534,6 +567,7 @@ class OCR(object):
                 self.text_detector = TextDetector(model_dir)
                 self.text_recognizer = TextRecognizer(model_dir)
 
+        self.model_version = "|".join([model_version(model_dir, "det"), model_version(model_dir, "rec")])
         self.drop_score = 0.5
         self.crop_image_res_index = 0
 
@@ -549,6 +583,9 @@ class OCR(object):
         points[:, 1] = points[:, 1] - top
         '''
         assert len(points) == 4, "shape of points must be 4*2"
+        dst_img = self.get_axis_aligned_crop_image(img, points)
+        if dst_img is not None:
+            return dst_img
         img_crop_width = int(
             max(
                 np.linalg.norm(points[0] - points[1]),
@@ -571,6 +608,35 @@ class OCR(object):
             dst_img = np.rot90(dst_img)
         return dst_img
 
+    @staticmethod
+    def get_axis_aligned_crop_image(img, points, eps=1e-3):
+        """
+        Crop an axis-aligned rectangle (clockwise from the top left) by slicing, instead of the perspective warp.
+        The corners are rounded to the pixel grid and the border is replicated like the warp does.
+        Returns None for any other quadrilateral.
+        """
+        (x0, y0), (x1, y1), (x2, y2), (x3, y3) = [(float(x), float(y)) for x, y in points]
+        if abs(y0 - y1) > eps or abs(y2 - y3) > eps or abs(x0 - x3) > eps or abs(x1 - x2) > eps:
+            return
+        w, h = int(x1 - x0), int(y3 - y0)
+        if w < 1 or h < 1:
+            return
+        left, top = int(round(x0)), int(round(y0))
+        img_h, img_w = img.shape[0:2]
+        if left >= 0 and top >= 0 and left + w <= img_w and top + h <= img_h:
+            dst_img = img[top:top + h, left:left + w].copy()
+        else:
+            ys = np.clip(np.arange(top, top + h), 0, img_h - 1)
+            xs = np.clip(np.arange(left, left + w), 0, img_w - 1)
+            dst_img = img[np.ix_(ys, xs)]
+        if h * 1.0 / w >= 1.5:
+            dst_img = np.rot90(dst_img)
+        return dst_img
+
+    def get_crop_images(self, img, boxes):
+        """Crop the text lines of `boxes` out of `img`, axis-aligned ones by slicing."""
+        return [self.get_rotate_crop_image(img, np.asarray(box, dtype=np.float32)) for box in boxes]
+
     def sorted_boxes(self, dt_boxes):
         """
         Sort text boxes in order from top to bottom, left to right
@@ -580,19 +646,24 @@ class OCR(object):
             sorted boxes(array) with shape [4, 2]
         """
         num_boxes = dt_boxes.shape[0]
-        sorted_boxes = sorted(dt_boxes, key=lambda x: (x[0][1], x[0][0]))
-        _boxes = list(sorted_boxes)
+        if num_boxes == 0:
+            return []
+        dt_boxes = np.asarray(dt_boxes)
+        order = np.lexsort((dt_boxes[:, 0, 0], dt_boxes[:, 0, 1]))
+        # the same-line pass runs on plain floats, reading numpy scalars one by one is what made it slow
+        xs = dt_boxes[order, 0, 0].tolist()
+        ys = dt_boxes[order, 0, 1].tolist()
+        order = order.tolist()
 
         for i in range(num_boxes - 1):
             for j in range(i, -1, -1):
-                if abs(_boxes[j + 1][0][1] - _boxes[j][0][1]) < 10 and \
-                        (_boxes[j + 1][0][0] < _boxes[j][0][0]):
-                    tmp = _boxes[j]
-                    _boxes[j] = _boxes[j + 1]
-                    _boxes[j + 1] = tmp
+                if abs(ys[j + 1] - ys[j]) < 10 and xs[j + 1] < xs[j]:
+                    xs[j], xs[j + 1] = xs[j + 1], xs[j]
+                    ys[j], ys[j + 1] = ys[j + 1], ys[j]
+                    order[j], order[j + 1] = order[j + 1], order[j]
                 else:
                     break
-        return _boxes
+        return [dt_boxes[i] for i in order]
 
     def detect(self, img):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
@@ -647,14 +718,8 @@ class OCR(object):
             time_dict['all'] = end - start
             return None, None, time_dict
 
-        img_crop_list = []
-
         dt_boxes = self.sorted_boxes(dt_boxes)
-
-        for bno in range(len(dt_boxes)):
-            tmp_box = copy.deepcopy(dt_boxes[bno])
-            img_crop = self.get_rotate_crop_image(ori_im, tmp_box)
-            img_crop_list.append(img_crop)
+        img_crop_list = self.get_crop_images(ori_im, dt_boxes)
 
         rec_res, elapse = self.text_recognizer(img_crop_list)
 
@@ -0,0 +1,243 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import onnxruntime as ort
+
+from rag.settings import DEEPDOC_ORT_INTRA_THREADS, DEEPDOC_ORT_INTER_THREADS, DEEPDOC_ORT_EXECUTION_MODE, \
+    DEEPDOC_ORT_OPT_LEVEL, DEEPDOC_ORT_INT8, DEEPDOC_ORT_MODEL_CONF
+from rag.utils import singleton
+from services.utils.file_utils import get_project_base_directory
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+class _ModelStats:
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, elapsed):
+        self.runs += 1
+        self.latency_sum += elapsed
+        for i, b in enumerate(LATENCY_BUCKETS):
+            if elapsed <= b:
+                self.latency_buckets[i] += 1
+                return
+        self.latency_buckets[-1] += 1
+
+    def to_dict(self):
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "latency_avg": self.latency_sum / self.runs if self.runs else 0.0,
+            "latency_buckets": {str(b): c for b, c in zip(LATENCY_BUCKETS + ["+Inf"], self.latency_buckets)},
+        }
+
+
+class TimedSession:
+    """
+    An InferenceSession recording the latency of its `run` calls, everything else is passed through.
+    """
+
+    def __init__(self, sess, stats, lock):
+        self.sess = sess
+        self._stats = stats
+        self._lock = lock
+
+    def run(self, *args, **kwargs):
+        st = time.perf_counter()
+        try:
+            return self.sess.run(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - st
+            with self._lock:
+                self._stats.observe(elapsed)
+
+    def __getattr__(self, name):
+        return getattr(self.sess, name)
+
+
+def dummy_feeds(sess, batch=1, height=64, width=64):
+    """Inputs of the session's shapes, the symbolic dimensions set to `batch` and the spatial ones."""
+    feeds = {}
+    for node in sess.get_inputs():
+        sizes = [batch, None, height, width]
+        shape = [d if isinstance(d, int) and d > 0 else (sizes[i] if i < len(sizes) and sizes[i] else 1)
+                 for i, d in enumerate(node.shape)]
+        dtype = np.int64 if "int64" in node.type else np.float32
+        feeds[node.name] = np.ones(shape, dtype=dtype) if len(shape) < 4 else np.zeros(shape, dtype=dtype)
+    return feeds
+
+
+@singleton
+class OnnxSessionManager:
+    """
+    Loads the ONNX Runtime sessions of the deepdoc models once per process, with the threads, execution mode,
+    graph optimization level and INT8 variant configured for each model, and keeps their latency histograms.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._stats = defaultdict(_ModelStats)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def model_conf(nm) -> dict:
+        conf = {
+            "intra_op_num_threads": DEEPDOC_ORT_INTRA_THREADS,
+            "inter_op_num_threads": DEEPDOC_ORT_INTER_THREADS,
+            "execution_mode": DEEPDOC_ORT_EXECUTION_MODE,
+            "graph_optimization_level": DEEPDOC_ORT_OPT_LEVEL,
+            "int8": bool(DEEPDOC_ORT_INT8),
+            "cpu_mem_arena": False,
+        }
+        # DEEPDOC_ORT_MODEL_CONF overrides by the model name, e.g. "rec", or its family, e.g. "layout" for "layout.paper"
+        conf.update(DEEPDOC_ORT_MODEL_CONF.get(nm.split(".")[0], {}))
+        conf.update(DEEPDOC_ORT_MODEL_CONF.get(nm, {}))
+        return conf
+
+    def model_path(self, model_dir, nm) -> str:
+        """The INT8-quantized `<nm>.int8.onnx` when it's enabled for the model and present, `<nm>.onnx` otherwise."""
+        if self.model_conf(nm)["int8"]:
+            int8_path = os.path.join(model_dir, nm + ".int8.onnx")
+            if os.path.exists(int8_path):
+                return int8_path
+            logging.warning(f"INT8 variant of {nm} is enabled but {int8_path} is missing, loading the FP32 model")
+        return os.path.join(model_dir, nm + ".onnx")
+
+    def model_version(self, model_dir, nm) -> str:
+        """Identify the model file loaded for `nm` by its name, size and modification time."""
+        model_file_path = self.model_path(model_dir, nm)
+        try:
+            st = os.stat(model_file_path)
+        except OSError:
+            return nm
+        return f"{os.path.basename(model_file_path)[:-len('.onnx')]}-{st.st_size}-{int(st.st_mtime)}"
+
+    def load(self, model_dir, nm):
+        model_file_path = self.model_path(model_dir, nm)
+        with self._lock:
+            loaded_model = self._sessions.get(model_file_path)
+        if loaded_model:
+            logging.info(f"load_model {model_file_path} reuses cached model")
+            return loaded_model
+
+        if not os.path.exists(model_file_path):
+            raise ValueError("not find model file path {}".format(
+                model_file_path))
+
+        def cuda_is_available():
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    return True
+            except Exception:
+                return False
+            return False
+
+        conf = self.model_conf(nm)
+        options = ort.SessionOptions()
+        options.enable_cpu_mem_arena = bool(conf["cpu_mem_arena"])
+        options.execution_mode = EXECUTION_MODES.get(str(conf["execution_mode"]).lower(),
+                                                     ort.ExecutionMode.ORT_SEQUENTIAL)
+        options.graph_optimization_level = OPT_LEVELS.get(str(conf["graph_optimization_level"]).lower(),
+                                                          ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        options.intra_op_num_threads = int(conf["intra_op_num_threads"])
+        options.inter_op_num_threads = int(conf["inter_op_num_threads"])
+
+        # https://github.com/microsoft/onnxruntime/issues/9509#issuecomment-951546580
+        # Shrink GPU memory after execution
+        run_options = ort.RunOptions()
+        if cuda_is_available():
+            cuda_provider_options = {
+                "device_id": 0,  # Use specific GPU
+                "gpu_mem_limit": 512 * 1024 * 1024,  # Limit gpu memory
+                "arena_extend_strategy": "kNextPowerOfTwo",  # gpu memory allocation strategy
+            }
+            sess = ort.InferenceSession(
+                model_file_path,
+                options=options,
+                providers=['CUDAExecutionProvider'],
+                provider_options=[cuda_provider_options]
+            )
+            run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "gpu:0")
+            logging.info(f"load_model {model_file_path} uses GPU")
+        else:
+            sess = ort.InferenceSession(
+                model_file_path,
+                options=options,
+                providers=['CPUExecutionProvider'])
+            run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu")
+            logging.info(f"load_model {model_file_path} uses CPU with {conf}")
+
+        name = os.path.basename(model_file_path)[:-len(".onnx")]
+        loaded_model = (TimedSession(sess, self._stats[name], self._lock), run_options)
+        with self._lock:
+            loaded_model = self._sessions.setdefault(model_file_path, loaded_model)
+        return loaded_model
+
+    def prewarm(self, model_dir=None, names=("det", "rec", "layout", "tsr")):
+        """
+        Load the sessions and run each once on a dummy input, so the first task doesn't pay for
+        the session creation and the first-run allocations.
+        """
+        model_dir = model_dir or os.path.join(get_project_base_directory(), "rag/res/deepdoc")
+        for nm in names:
+            st = time.perf_counter()
+            try:
+                sess, run_options = self.load(model_dir, nm)
+                sess.sess.run(None, dummy_feeds(sess), run_options)
+                logging.info(f"prewarm {nm} cost {time.perf_counter() - st:.2f}s")
+            except Exception:
+                logging.exception(f"prewarm {nm}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {nm: s.to_dict() for nm, s in self._stats.items()}
+
+    def reset(self):
+        """Drop the loaded sessions and their stats, the next `load` applies the configuration anew."""
+        with self._lock:
+            self._sessions.clear()
+            self._stats.clear()
+
+
+ONNX_SESSIONS = OnnxSessionManager()
@@ -26,7 +26,8 @@ from services.utils.file_utils import get_project_base_directory
 from .operators import *  # noqa: F403
 from .operators import preprocess
 from . import operators
-from .ocr import load_model
+from .ocr import load_model, model_version
+from .spatial_index import BoxIndex
 
 class Recognizer(object):
     def __init__(self, label_list, task_name, model_dir=None):
@@ -46,10 +47,26 @@ class Recognizer(object):
                         get_project_base_directory(),
                         "rag/res/deepdoc")
         self.ort_sess, self.run_options = load_model(model_dir, task_name)
+        self.model_version = model_version(model_dir, task_name)
         self.input_names = [node.name for node in self.ort_sess.get_inputs()]
         self.output_names = [node.name for node in self.ort_sess.get_outputs()]
         self.input_shape = self.ort_sess.get_inputs()[0].shape[2:4]
         self.label_list = label_list
+        # Models exported with a symbolic batch dimension take a whole batch in one session run.
+        # The detection models with `scale_factor` also need `bbox_num` to split the results back.
+        self.batchable = not isinstance(self.ort_sess.get_inputs()[0].shape[0], int) \
+            and ("scale_factor" not in self.input_names or len(self.output_names) > 1)
+        self.preprocess_ops = []
+        if "scale_factor" in self.input_names:
+            for op_info in [
+                {'interp': 2, 'keep_ratio': False, 'target_size': [800, 608], 'type': 'LinearResize'},
+                {'is_scale': True, 'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225], 'type': 'StandardizeImage'},
+                {'type': 'Permute'},
+                {'stride': 32, 'type': 'PadStride'}
+            ]:
+                new_op_info = op_info.copy()
+                op_type = new_op_info.pop('type')
+                self.preprocess_ops.append(getattr(operators, op_type)(**new_op_info))
 
     @staticmethod
     def sort_Y_firstly(arr, threashold):
@@ -139,7 +156,7 @@ class Recognizer(object):
                         a["bottom"] < b["top"],
                         a["top"] > b["bottom"]])
 
-        i = 0
+        i, box_index = 0, None
         while i + 1 < len(layouts):
             j = i + 1
             while j < min(i + far, len(layouts)) \
@@ -161,12 +178,10 @@ class Recognizer(object):
                     layouts.pop(i)
                 continue
 
-            area_i, area_i_1 = 0, 0
-            for b in boxes:
-                if not notOverlapped(b, layouts[i]):
-                    area_i += Recognizer.overlapped_area(b, layouts[i], False)
-                if not notOverlapped(b, layouts[j]):
-                    area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+            if box_index is None:
+                box_index = BoxIndex(boxes)
+            area_i = box_index.overlapped_area_sum(layouts[i])
+            area_i_1 = box_index.overlapped_area_sum(layouts[j])
 
             if area_i > area_i_1:
                 layouts.pop(j)
@@ -284,19 +299,8 @@ class Recognizer(object):
     def preprocess(self, image_list):
         inputs = []
         if "scale_factor" in self.input_names:
-            preprocess_ops = []
-            for op_info in [
-                {'interp': 2, 'keep_ratio': False, 'target_size': [800, 608], 'type': 'LinearResize'},
-                {'is_scale': True, 'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225], 'type': 'StandardizeImage'},
-                {'type': 'Permute'},
-                {'stride': 32, 'type': 'PadStride'}
-            ]:
-                new_op_info = op_info.copy()
-                op_type = new_op_info.pop('type')
-                preprocess_ops.append(getattr(operators, op_type)(**new_op_info))
-
             for im_path in image_list:
-                im, im_info = preprocess(im_path, preprocess_ops)
+                im, im_info = preprocess(im_path, self.preprocess_ops)
                 inputs.append({"image": np.array((im,)).astype('float32'),
                                "scale_factor": np.array((im_info["scale_factor"],)).astype('float32')})
         else:
@@ -407,22 +411,52 @@ class Recognizer(object):
             "score": float(scores[i])
         } for i in indices]
 
-    def __call__(self, image_list, thr=0.7, batch_size=16):
-        res = []
-        imgs = []
-        for i in range(len(image_list)):
-            if not isinstance(image_list[i], np.ndarray):
-                imgs.append(np.array(image_list[i]))
+    def run_batch(self, inputs, thr):
+        """
+        Run the preprocessed inputs of a batch through one session call and split the outputs back
+        per image. Returns None if the outputs can't be split, then the caller runs image by image.
+        """
+        feeds = {}
+        for k in self.input_names:
+            arrs = [np.asarray(ins[k], dtype=np.float32) for ins in inputs]
+            if arrs[0].ndim == 4:
+                # pad images to the batch's largest height/width, which are already multiples of the stride
+                hh = max([a.shape[2] for a in arrs])
+                ww = max([a.shape[3] for a in arrs])
+                batch = np.zeros((len(arrs), arrs[0].shape[1], hh, ww), dtype=np.float32)
+                for j, a in enumerate(arrs):
+                    batch[j, :, :a.shape[2], :a.shape[3]] = a[0]
+                feeds[k] = batch
             else:
-                imgs.append(image_list[i])
+                feeds[k] = np.concatenate(arrs, axis=0)
+
+        outputs = self.ort_sess.run(None, feeds, self.run_options)
+        if "scale_factor" in self.input_names:
+            bbox_num = np.asarray(outputs[1]).reshape(-1)
+            if len(bbox_num) != len(inputs) or int(np.sum(bbox_num)) != len(outputs[0]):
+                logging.warning("Recognizer.run_batch can't split the batched outputs, fall back to one by one.")
+                return None
+            parts = np.split(outputs[0], np.cumsum(bbox_num)[:-1].astype(int))
+        else:
+            parts = [outputs[0][j:j + 1] for j in range(len(inputs))]
+        return [self.postprocess(p, ins, thr) for p, ins in zip(parts, inputs)]
 
-        batch_loop_cnt = math.ceil(float(len(imgs)) / batch_size)
+    def __call__(self, image_list, thr=0.7, batch_size=16):
+        res = []
+        # images are converted batch by batch, the page images of a whole document can't all be held at once
+        batch_loop_cnt = math.ceil(float(len(image_list)) / batch_size)
         for i in range(batch_loop_cnt):
             start_index = i * batch_size
-            end_index = min((i + 1) * batch_size, len(imgs))
-            batch_image_list = imgs[start_index:end_index]
+            end_index = min((i + 1) * batch_size, len(image_list))
+            batch_image_list = [img if isinstance(img, np.ndarray) else np.array(img)
+                                for img in image_list[start_index:end_index]]
             inputs = self.preprocess(batch_image_list)
             logging.debug("preprocess")
+            if self.batchable and len(inputs) > 1:
+                bbs = self.run_batch(inputs, thr)
+                if bbs is not None:
+                    res.extend(bbs)
+                    continue
             for ins in inputs:
                 bb = self.postprocess(self.ort_sess.run(None, {k:v for k,v in ins.items() if k in self.input_names}, self.run_options)[0], ins, thr)
                 res.append(bb)
@@ -0,0 +1,119 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import numpy as np
+
+
+class BoxIndex(object):
+    """
+    Column-wise index over a fixed list of boxes (dicts with x0, x1, top, bottom).
+
+    Boxes are kept as NumPy arrays and sorted by `top`, together with the running maximum of
+    `bottom`, so the boxes vertically overlapping a query are found with two binary searches.
+    The overlap measures are then computed on that slice at once.
+    The lookups return the same indices as the linear scans of `Recognizer` with the same name.
+    """
+
+    def __init__(self, boxes):
+        self.size = len(boxes)
+        self.x0 = np.array([b["x0"] for b in boxes], dtype=np.float64)
+        self.x1 = np.array([b["x1"] for b in boxes], dtype=np.float64)
+        self.top = np.array([b["top"] for b in boxes], dtype=np.float64)
+        self.bottom = np.array([b["bottom"] for b in boxes], dtype=np.float64)
+        self.layoutno = [b.get("layoutno", "0") for b in boxes]
+        self.area = (self.x1 - self.x0) * (self.bottom - self.top)
+
+        self._order = np.argsort(self.top, kind="stable")
+        self._tops = self.top[self._order]
+        self._reach = np.maximum.accumulate(self.bottom[self._order]) if self.size else self._tops
+
+    def __len__(self):
+        return self.size
+
+    def candidates(self, box):
+        """Indices, in the original order, of the boxes which may overlap `box`."""
+        if not self.size:
+            return np.zeros(0, dtype=np.int64)
+        s = np.searchsorted(self._reach, box["top"], side="left")
+        e = np.searchsorted(self._tops, box["bottom"], side="right")
+        if s >= e:
+            return np.zeros(0, dtype=np.int64)
+        idx = np.sort(self._order[s:e])
+        mask = (self.bottom[idx] >= box["top"]) & (self.x0[idx] <= box["x1"]) & (self.x1[idx] >= box["x0"])
+        return idx[mask]
+
+    def intersection(self, box, idx):
+        w = np.minimum(self.x1[idx], box["x1"]) - np.maximum(self.x0[idx], box["x0"])
+        h = np.minimum(self.bottom[idx], box["bottom"]) - np.maximum(self.top[idx], box["top"])
+        return np.clip(w, 0, None) * np.clip(h, 0, None)
+
+    def overlapped_ratio(self, box, idx):
+        """
+        Return (overlap / area of the indexed boxes, overlap / area of `box`) for the boxes in `idx`,
+        same as `Recognizer.overlapped_area(boxes[i], box)` and `Recognizer.overlapped_area(box, boxes[i])`.
+        """
+        inter = self.intersection(box, idx)
+        area = self.area[idx]
+        ov = np.divide(inter, area, out=np.zeros_like(inter), where=area != 0)
+        box_area = (box["x1"] - box["x0"]) * (box["bottom"] - box["top"])
+        _ov = inter / box_area if box_area != 0 else np.zeros_like(inter)
+        return ov, _ov
+
+    def overlapped_area_sum(self, box):
+        """Sum of `Recognizer.overlapped_area(boxes[i], box, False)` over all the indexed boxes."""
+        idx = self.candidates(box)
+        if not len(idx):
+            return 0
+        inter = self.intersection(box, idx)
+        inter[self.area[idx] == 0] = 0
+        return float(np.sum(inter))
+
+    def find_overlapped(self, box):
+        idx = self.candidates(box)
+        if not len(idx):
+            return
+        ov, _ = self.overlapped_ratio(box, idx)
+        i = int(np.argmax(ov))
+        if ov[i] <= 0:
+            return
+        return int(idx[i])
+
+    def find_overlapped_with_threashold(self, box, thr=0.3):
+        idx = self.candidates(box) if thr > 0 else np.arange(self.size)
+        if not len(idx):
+            return
+        # ranked by the overlap ratio over `box` first, then over the indexed box; the last one wins a tie
+        _ov, ov = self.overlapped_ratio(box, idx)
+        mask = ov >= thr
+        if not np.any(mask):
+            return
+        idx, ov, _ov = idx[mask], ov[mask], _ov[mask]
+        return int(idx[np.lexsort((idx, _ov, ov))[-1]])
+
+    def find_horizontally_tightest_fit(self, box):
+        if not self.size:
+            return
+        layoutno = box.get("layoutno", "0")
+        idx = np.array([i for i, no in enumerate(self.layoutno) if no == layoutno], dtype=np.int64)
+        if not len(idx):
+            return
+        x0, x1 = self.x0[idx], self.x1[idx]
+        dis = np.minimum(np.minimum(np.abs(box["x0"] - x0), np.abs(box["x1"] - x1)),
+                         np.abs(box["x0"] + box["x1"] - x1 - x0) / 2)
+        i = int(np.argmin(dis))
+        if dis[i] >= 1000000:
+            return
+        return int(idx[i])
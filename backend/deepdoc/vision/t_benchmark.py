@@ -0,0 +1,309 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+from deepdoc.vision import LayoutRecognizer, TableStructureRecognizer, Recognizer, BoxIndex, OCR, init_in_out
+from deepdoc.vision.ocr import TextRecognizer
+from deepdoc.vision.onnx_session import ONNX_SESSIONS, dummy_feeds
+from rag.settings import DEEPDOC_ORT_MODEL_CONF
+from services.utils.file_utils import get_project_base_directory
+import argparse
+import copy
+import json
+import math
+import random
+import time
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def synthetic_pages(n, zoomin=3):
+    """Letter-sized pages of text lines and ruled tables, at the resolution the pdf parser renders them."""
+    random.seed(0)
+    pages = []
+    for _ in range(n):
+        w, h = 612 * zoomin, 792 * zoomin
+        img = Image.new("RGB", (w, h), "white")
+        draw = ImageDraw.Draw(img)
+        y = 60 * zoomin
+        while y < h - 80 * zoomin:
+            if random.random() < 0.2:
+                rows, cols = random.randint(3, 10), random.randint(2, 6)
+                rh, cw = 18 * zoomin, (w - 120 * zoomin) // cols
+                for r in range(rows + 1):
+                    draw.line([(60 * zoomin, y + r * rh), (60 * zoomin + cols * cw, y + r * rh)], fill="black")
+                for c in range(cols + 1):
+                    draw.line([(60 * zoomin + c * cw, y), (60 * zoomin + c * cw, y + rows * rh)], fill="black")
+                for r in range(rows):
+                    for c in range(cols):
+                        draw.text((64 * zoomin + c * cw, y + r * rh + 4 * zoomin), f"{random.random():.3f}", fill="black")
+                y += (rows + 2) * rh
+            else:
+                draw.text((60 * zoomin, y), " ".join("lorem" for _ in range(random.randint(5, 20))), fill="black")
+                y += 14 * zoomin
+        pages.append(img)
+    return pages
+
+
+def pages_of(args):
+    if args.inputs:
+        return init_in_out(args)[0]
+    return synthetic_pages(args.pages)
+
+
+def bench_recognizer(args):
+    """Pages per second of the layout and table structure models, one image per session run against batched."""
+    images = pages_of(args)
+    for nm, detr in [("layout", LayoutRecognizer("layout")), ("tsr", TableStructureRecognizer())]:
+        # warm up, the first runs allocate the arenas
+        Recognizer.__call__(detr, images[:2], 0.2, 2)
+        for batch_size in [1, args.batch_size]:
+            st = time.perf_counter()
+            Recognizer.__call__(detr, images, 0.2, batch_size)
+            elapsed = time.perf_counter() - st
+            print(f"{nm} batch_size={batch_size} batchable={detr.batchable}: "
+                  f"{len(images) / elapsed:.2f} pages/s over {len(images)} pages")
+
+
+def synthetic_table(n_rows, n_cols, cell_w=60, cell_h=18, jitter=3):
+    """OCR boxes of a dense table, one per cell, and the rows, headers, columns and spans TSR would give it."""
+    random.seed(0)
+    boxes = []
+    for r in range(n_rows):
+        for c in range(n_cols):
+            x0, top = c * cell_w + random.uniform(0, jitter), r * cell_h + random.uniform(0, jitter)
+            boxes.append({"x0": x0, "x1": x0 + cell_w * random.uniform(0.4, 0.9),
+                          "top": top, "bottom": top + cell_h * random.uniform(0.5, 0.9), "layoutno": "table-0"})
+    width, height = n_cols * cell_w, n_rows * cell_h
+    rows = [{"x0": 0, "x1": width, "top": r * cell_h, "bottom": (r + 1) * cell_h, "layoutno": "table-0"}
+            for r in range(n_rows)]
+    headers = rows[:2]
+    clmns = [{"x0": c * cell_w, "x1": (c + 1) * cell_w, "top": 0, "bottom": height, "layoutno": "table-0"}
+             for c in range(n_cols)]
+    spans = [{"x0": c * cell_w, "x1": (c + 2) * cell_w, "top": r * cell_h, "bottom": (r + 1) * cell_h,
+              "layoutno": "table-0"} for r in range(0, n_rows, 7) for c in range(0, n_cols - 1, 5)]
+    return boxes, rows, headers, clmns, spans
+
+
+def bench_index(args):
+    """Milliseconds per table of the lookups the pdf parser makes for each OCR box, linear scans against BoxIndex."""
+    for n_rows, n_cols in [(20, 5), (60, 10), (200, 12)]:
+        boxes, rows, headers, clmns, spans = synthetic_table(n_rows, n_cols)
+
+        def linear():
+            return [(Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3),
+                     Recognizer.find_overlapped_with_threashold(b, headers, thr=0.3),
+                     Recognizer.find_horizontally_tightest_fit(b, clmns),
+                     Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3),
+                     Recognizer.find_overlapped(b, rows, naive=True)) for b in boxes]
+
+        def indexed():
+            rows_index, headers_index = BoxIndex(rows), BoxIndex(headers)
+            clmns_index, spans_index = BoxIndex(clmns), BoxIndex(spans)
+            return [(rows_index.find_overlapped_with_threashold(b, thr=0.3),
+                     headers_index.find_overlapped_with_threashold(b, thr=0.3),
+                     clmns_index.find_horizontally_tightest_fit(b),
+                     spans_index.find_overlapped_with_threashold(b, thr=0.3),
+                     rows_index.find_overlapped(b)) for b in boxes]
+
+        timings = {}
+        for nm, fn in [("linear", linear), ("BoxIndex", indexed)]:
+            st = time.perf_counter()
+            for _ in range(args.repeat):
+                res = fn()
+            timings[nm] = ((time.perf_counter() - st) / args.repeat * 1000, res)
+        assert timings["linear"][1] == timings["BoxIndex"][1], "BoxIndex disagrees with the linear scans"
+        print(f"{len(boxes)} boxes, {n_rows} rows, {n_cols} columns: "
+              + ", ".join(f"{nm} {ms:.2f} ms" for nm, (ms, _) in timings.items()))
+
+
+def synthetic_text_boxes(img, n, rotated=0.1):
+    """Detector-like quads of `n` text lines over `img`, in no particular order, some of them slightly rotated."""
+    random.seed(0)
+    h, w = img.shape[0:2]
+    boxes = []
+    for _ in range(n):
+        bw, bh = random.uniform(40, w / 2), random.uniform(20, 40)
+        x0, y0 = random.uniform(0, w - bw), random.uniform(0, h - bh)
+        quad = np.array([[x0, y0], [x0 + bw, y0], [x0 + bw, y0 + bh], [x0, y0 + bh]], dtype=np.float32)
+        if random.random() < rotated:
+            quad[1:3, 1] += random.uniform(-4, 4)
+        boxes.append(quad)
+    return np.array(boxes, dtype=np.float32)
+
+
+def legacy_sorted_boxes(dt_boxes):
+    """OCR.sorted_boxes before the lexsort, as reference."""
+    num_boxes = dt_boxes.shape[0]
+    sorted_boxes = sorted(dt_boxes, key=lambda x: (x[0][1], x[0][0]))
+    _boxes = list(sorted_boxes)
+    for i in range(num_boxes - 1):
+        for j in range(i, -1, -1):
+            if abs(_boxes[j + 1][0][1] - _boxes[j][0][1]) < 10 and \
+                    (_boxes[j + 1][0][0] < _boxes[j][0][0]):
+                tmp = _boxes[j]
+                _boxes[j] = _boxes[j + 1]
+                _boxes[j + 1] = tmp
+            else:
+                break
+    return _boxes
+
+
+def legacy_crop_image(img, points):
+    """OCR.get_rotate_crop_image before the slicing fast path: every box goes through the perspective warp."""
+    img_crop_width = int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3])))
+    img_crop_height = int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2])))
+    pts_std = np.float32([[0, 0], [img_crop_width, 0], [img_crop_width, img_crop_height], [0, img_crop_height]])
+    M = cv2.getPerspectiveTransform(points, pts_std)
+    dst_img = cv2.warpPerspective(img, M, (img_crop_width, img_crop_height),
+                                  borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC)
+    if dst_img.shape[0] * 1.0 / dst_img.shape[1] >= 1.5:
+        dst_img = np.rot90(dst_img)
+    return dst_img
+
+
+def bench_crop(args):
+    """Milliseconds per page of sorting the detected text boxes and cropping them, before and after."""
+    img = np.array(pages_of(args)[0])
+    # sorting and cropping need no model
+    ocr = OCR.__new__(OCR)
+    for n in [100, 400, 1000]:
+        dt_boxes = synthetic_text_boxes(img, n)
+        timings = {}
+        for nm, sort, crop in [
+            ("legacy", legacy_sorted_boxes,
+             lambda boxes: [legacy_crop_image(img, copy.deepcopy(b)) for b in boxes]),
+            ("current", lambda boxes: ocr.sorted_boxes(boxes),
+             lambda boxes: ocr.get_crop_images(img, boxes)),
+        ]:
+            sort_ms = crop_ms = 0
+            for _ in range(args.repeat):
+                st = time.perf_counter()
+                boxes = sort(dt_boxes)
+                sort_ms += time.perf_counter() - st
+                st = time.perf_counter()
+                crops = crop(boxes)
+                crop_ms += time.perf_counter() - st
+            timings[nm] = (sort_ms / args.repeat * 1000, crop_ms / args.repeat * 1000, boxes, crops)
+        assert all(np.array_equal(a, b) for a, b in zip(timings["legacy"][2], timings["current"][2])), \
+            "sorted_boxes changed the order"
+        assert [c.shape for c in timings["legacy"][3]] == [c.shape for c in timings["current"][3]], \
+            "the crops changed shape"
+        print(f"{n} boxes: " + ", ".join(f"{nm} sort {sort_ms:.2f} ms crop {crop_ms:.2f} ms"
+                                         for nm, (sort_ms, crop_ms, _, _) in timings.items()))
+
+
+def legacy_plan_batches(rec, img_list):
+    """TextRecognizer batching before plan_batches: crops sorted by aspect ratio, `rec_batch_num` at a time."""
+    imgC, imgH, imgW = rec.rec_image_shape[:3]
+    widths = [max(imgW, imgH * img.shape[1] / float(img.shape[0])) for img in img_list]
+    indices = np.argsort(np.array([img.shape[1] / float(img.shape[0]) for img in img_list])).tolist()
+    return [indices[i:i + rec.rec_batch_num] for i in range(0, len(indices), rec.rec_batch_num)], widths
+
+
+def bench_batches(args):
+    """Batches and padded pixel columns the text recognizer runs for the crops of a page, before and after."""
+    img = np.array(pages_of(args)[0])
+    ocr = OCR.__new__(OCR)
+    # planning needs no model
+    rec = TextRecognizer.__new__(TextRecognizer)
+    imgH = rec.rec_image_shape[1]
+    for n in [100, 400, 1000]:
+        crops = ocr.get_crop_images(img, ocr.sorted_boxes(synthetic_text_boxes(img, n)))
+        res = []
+        for nm, plan in [("legacy", legacy_plan_batches), ("plan_batches", TextRecognizer.plan_batches)]:
+            st = time.perf_counter()
+            batches, widths = plan(rec, crops)
+            ms = (time.perf_counter() - st) * 1000
+            assert sorted(i for b in batches for i in b) == list(range(len(crops))), f"{nm} lost crops"
+            width = padded = 0
+            for batch in batches:
+                padded_width = math.ceil(max(widths[i] for i in batch))
+                padded += padded_width * len(batch)
+                width += sum(min(padded_width, math.ceil(imgH * crops[i].shape[1] / float(crops[i].shape[0])))
+                             for i in batch)
+            res.append(f"{nm} {len(batches)} batches, {padded} padded columns, occupancy {width / padded:.2f}, "
+                       f"planned in {ms:.2f} ms")
+        print(f"{n} crops: " + "; ".join(res))
+
+
+# batch, height and width of the inputs with symbolic dimensions, as the pdf parser feeds each model
+SESSION_INPUTS = {"det": (1, 960, 736), "rec": (16, 48, 320), "layout": (1, 800, 608), "tsr": (1, 800, 608)}
+
+SESSION_CONFIGS = [
+    {"intra_op_num_threads": 1, "inter_op_num_threads": 1},
+    {"intra_op_num_threads": 2, "inter_op_num_threads": 2},
+    {"intra_op_num_threads": 4, "inter_op_num_threads": 2},
+    {"intra_op_num_threads": 2, "inter_op_num_threads": 2, "graph_optimization_level": "basic"},
+    {"intra_op_num_threads": 2, "inter_op_num_threads": 2, "int8": True},
+]
+
+
+def bench_sessions(args):
+    """Latency of each deepdoc model under the ONNX Runtime configurations, from the session manager's stats."""
+    model_dir = args.model_dir or os.path.join(get_project_base_directory(), "rag/res/deepdoc")
+    for conf in json.loads(args.configs) if args.configs else SESSION_CONFIGS:
+        ONNX_SESSIONS.reset()
+        DEEPDOC_ORT_MODEL_CONF.clear()
+        DEEPDOC_ORT_MODEL_CONF.update({nm: conf for nm in SESSION_INPUTS})
+        for nm, (batch, height, width) in SESSION_INPUTS.items():
+            sess, run_options = ONNX_SESSIONS.load(model_dir, nm)
+            feeds = dummy_feeds(sess, batch, height, width)
+            # the first run allocates, it's left out of the stats
+            sess.sess.run(None, feeds, run_options)
+            for _ in range(args.repeat):
+                sess.run(None, feeds, run_options)
+        for nm, st in ONNX_SESSIONS.stats().items():
+            print(f"{json.dumps(conf)} {nm}: {st['latency_avg'] * 1000:.1f} ms avg over {st['runs']} runs, "
+                  f"buckets {st['latency_buckets']}")
+
+
+def main(args):
+    {
+        "recognizer": bench_recognizer,
+        "index": bench_index,
+        "crop": bench_crop,
+        "batches": bench_batches,
+        "sessions": bench_sessions,
+    }[args.mode](args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', help="What to benchmark", choices=["recognizer", "index", "crop", "batches", "sessions"], default="recognizer")
+    parser.add_argument('--inputs',
+                        help="Directory of images or PDFs, or a file path to a single image or PDF. "
+                             "Synthetic pages are used if not given")
+    parser.add_argument('--output_dir', help="Directory init_in_out requires. Default: './benchmark_outputs'",
+                        default="./benchmark_outputs")
+    parser.add_argument('--pages', help="Number of synthetic pages. Default: 32", type=int, default=32)
+    parser.add_argument('--batch_size', help="Batch size compared to one by one. Default: 16", type=int, default=16)
+    parser.add_argument('--configs', help="JSON list of the ONNX Runtime configurations compared in the sessions mode, "
+                                          "as in DEEPDOC_ORT_MODEL_CONF")
+    parser.add_argument('--model_dir', help="Directory of the deepdoc models. Default: rag/res/deepdoc")
+    parser.add_argument('--repeat', help="Runs averaged for the synthetic modes. Default: 5", type=int, default=5)
+    args = parser.parse_args()
+    main(args)
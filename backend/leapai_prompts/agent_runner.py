@@ -4,6 +4,27 @@ import re
 import json
 
 
+def _load_ref(ref):
+    """The part of another prompt file `{"$ref": "<file>#/<key>/<key>"}` points to."""
+    file_name, _, path = ref.partition("#")
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), file_name), 'r', encoding='utf-8') as file:
+        value = json.load(file)
+    for key in [k for k in path.split("/") if k]:
+        value = value[key]
+    return _resolve_refs(value)
+
+
+def _resolve_refs(value):
+    """Replace the `$ref`s of a prompt, so prompts can share the parts they have in common."""
+    if isinstance(value, dict):
+        if list(value.keys()) == ["$ref"]:
+            return _load_ref(value["$ref"])
+        return {k: _resolve_refs(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve_refs(v) for v in value]
+    return value
+
+
 class AgentRunner:
     def __init__(self, system_prompt_file, llm_model=None, max_token=2048):
         self._llm_model = llm_model
@@ -12,7 +33,7 @@ class AgentRunner:
         try:
             with open(full_path, 'r', encoding='utf-8') as file:
                 try:
-                    self._prompt_dict = json.load(file)
+                    self._prompt_dict = _resolve_refs(json.load(file))
                 except json.JSONDecodeError:
                     logging.error(f"Error: The file {full_path} is not a valid JSON file.")
                     self._prompt_dict = {}
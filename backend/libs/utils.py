@@ -1,8 +1,16 @@
 import json
 import numpy as np
 import xxhash
+from rag.settings import PDF_OCR_CACHE_DIR, PDF_OCR_CACHE_MB, RAPTOR_SUMMARY_CACHE_DIR, RAPTOR_SUMMARY_CACHE_MB
+from rag.utils.disk_cache import DiskCache
 from rag.utils.redis_conn import REDIS_CONN
 
+# OCR and layout results of page images, and the text previews of documents, are large and many, they are kept
+# on local disk with a budget of their own rather than evicting the queues and small caches from Redis
+OCR_CACHE = DiskCache(PDF_OCR_CACHE_DIR, PDF_OCR_CACHE_MB * 1024 * 1024)
+# so are the RAPTOR summaries, each carrying its embedding
+RAPTOR_CACHE = DiskCache(RAPTOR_SUMMARY_CACHE_DIR, RAPTOR_SUMMARY_CACHE_MB * 1024 * 1024)
+
 
 def get_llm_cache(llmnm, txt, history, genconf):
     hasher = xxhash.xxh64()
@@ -68,3 +76,135 @@ def set_tags_to_cache(kb_ids, tags):
 
     k = hasher.hexdigest()
     REDIS_CONN.set(k, json.dumps(tags).encode("utf-8"), 600)
+
+
+def get_sql_cache(tenant_id, question_tpl, field_map):
+    hasher = xxhash.xxh64()
+    hasher.update(str(tenant_id).encode("utf-8"))
+    hasher.update(str(question_tpl).encode("utf-8"))
+    hasher.update(json.dumps(field_map, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+
+    k = "sql_" + hasher.hexdigest()
+    bin = REDIS_CONN.get(k)
+    if not bin:
+        return
+    return bin
+
+
+def set_sql_cache(tenant_id, question_tpl, field_map, sql_tpl):
+    hasher = xxhash.xxh64()
+    hasher.update(str(tenant_id).encode("utf-8"))
+    hasher.update(str(question_tpl).encode("utf-8"))
+    hasher.update(json.dumps(field_map, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+
+    k = "sql_" + hasher.hexdigest()
+    REDIS_CONN.set(k, sql_tpl.encode("utf-8"), 7 * 24 * 3600)
+
+
+def get_sql_result_cache(sql, kb_version):
+    hasher = xxhash.xxh64()
+    hasher.update(str(sql).encode("utf-8"))
+    hasher.update(str(kb_version).encode("utf-8"))
+
+    k = "sql_res_" + hasher.hexdigest()
+    bin = REDIS_CONN.get(k)
+    if not bin:
+        return
+    return json.loads(bin)
+
+
+def set_sql_result_cache(sql, kb_version, tbl):
+    hasher = xxhash.xxh64()
+    hasher.update(str(sql).encode("utf-8"))
+    hasher.update(str(kb_version).encode("utf-8"))
+
+    k = "sql_res_" + hasher.hexdigest()
+    REDIS_CONN.set(k, json.dumps(tbl, ensure_ascii=False).encode("utf-8"), 3600)
+
+
+def get_kb_chunks_changed(kb_ids):
+    """When the chunks of each knowledge base were last written, as one marker string for cache keys."""
+    return "|".join([f"{kb_id}:{REDIS_CONN.get('kb_chunks_changed_' + str(kb_id)) or ''}" for kb_id in sorted(kb_ids)])
+
+
+def set_kb_chunks_changed(kb_id, ts):
+    # outlives the SQL results cached under the previous marker
+    REDIS_CONN.set("kb_chunks_changed_" + str(kb_id), str(ts), 24 * 3600)
+
+
+def get_ocr_cache(img_hash, zoomin, model_version, chars_digest):
+    hasher = xxhash.xxh64()
+    hasher.update(str(img_hash).encode("utf-8"))
+    hasher.update(str(zoomin).encode("utf-8"))
+    hasher.update(str(model_version).encode("utf-8"))
+    hasher.update(str(chars_digest).encode("utf-8"))
+
+    return OCR_CACHE.get("ocr_" + hasher.hexdigest())
+
+
+def set_ocr_cache(img_hash, zoomin, model_version, chars_digest, rows, exp):
+    hasher = xxhash.xxh64()
+    hasher.update(str(img_hash).encode("utf-8"))
+    hasher.update(str(zoomin).encode("utf-8"))
+    hasher.update(str(model_version).encode("utf-8"))
+    hasher.update(str(chars_digest).encode("utf-8"))
+
+    OCR_CACHE.set("ocr_" + hasher.hexdigest(), rows, exp)
+
+
+def get_layout_cache(img_hash, zoomin, model_version):
+    hasher = xxhash.xxh64()
+    hasher.update(str(img_hash).encode("utf-8"))
+    hasher.update(str(zoomin).encode("utf-8"))
+    hasher.update(str(model_version).encode("utf-8"))
+
+    return OCR_CACHE.get("layout_" + hasher.hexdigest())
+
+
+def set_layout_cache(img_hash, zoomin, model_version, layouts, exp):
+    hasher = xxhash.xxh64()
+    hasher.update(str(img_hash).encode("utf-8"))
+    hasher.update(str(zoomin).encode("utf-8"))
+    hasher.update(str(model_version).encode("utf-8"))
+
+    OCR_CACHE.set("layout_" + hasher.hexdigest(), layouts, exp)
+
+
+def get_raptor_cache(llmnm, embdnm, prompt, max_token, leaf_hashes):
+    hasher = xxhash.xxh64()
+    hasher.update(str(llmnm).encode("utf-8"))
+    hasher.update(str(embdnm).encode("utf-8"))
+    hasher.update(str(prompt).encode("utf-8"))
+    hasher.update(str(max_token).encode("utf-8"))
+    hasher.update(str(sorted(leaf_hashes)).encode("utf-8"))
+
+    return RAPTOR_CACHE.get("raptor_" + hasher.hexdigest())
+
+
+def set_raptor_cache(llmnm, embdnm, prompt, max_token, leaf_hashes, content, embd, exp):
+    hasher = xxhash.xxh64()
+    hasher.update(str(llmnm).encode("utf-8"))
+    hasher.update(str(embdnm).encode("utf-8"))
+    hasher.update(str(prompt).encode("utf-8"))
+    hasher.update(str(max_token).encode("utf-8"))
+    hasher.update(str(sorted(leaf_hashes)).encode("utf-8"))
+
+    v = {"leaf_hashes": sorted(leaf_hashes), "content": content,
+         "embedding": embd.tolist() if isinstance(embd, np.ndarray) else list(embd)}
+    RAPTOR_CACHE.set("raptor_" + hasher.hexdigest(), v, exp)
+
+
+def get_preview_cache(file_hash, max_bytes):
+    hasher = xxhash.xxh64()
+    hasher.update(str(file_hash).encode("utf-8"))
+    hasher.update(str(max_bytes).encode("utf-8"))
+
+    return OCR_CACHE.get("preview_" + hasher.hexdigest())
+
+
+def set_preview_cache(file_hash, max_bytes, text, exp):
+    hasher = xxhash.xxh64()
+    hasher.update(str(file_hash).encode("utf-8"))
+    hasher.update(str(max_bytes).encode("utf-8"))
+
+    OCR_CACHE.set("preview_" + hasher.hexdigest(), text, exp)
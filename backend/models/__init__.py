@@ -41,7 +41,7 @@ from .api_key import (
     API4Conversation,
 )
 
-from .database import Base, transactional, get_current_session
+from .database import Base, transactional, get_current_session, after_commit
 
 from enum import Enum
 from enum import IntEnum
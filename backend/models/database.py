@@ -81,6 +81,18 @@ def with_async_session(func: AsyncCallable) -> AsyncCallable:
     return _wrapper
 
 
+def after_commit(key: str, factory: Callable[[], Callable[[], Any]]) -> Callable[[], Any]:
+    """
+    The callback registered under `key` in the transaction of the current session, made by `factory` on first
+    use. It is called once the transaction commits and dropped if it rolls back, so the callers of a
+    transaction can add their work to one callback. Only to be used within a `transactional` function.
+    """
+    callbacks = get_current_session().info.setdefault("after_commit", {})
+    if key not in callbacks:
+        callbacks[key] = factory()
+    return callbacks[key]
+
+
 def transactional(func: AsyncCallable) -> AsyncCallable:
     @functools.wraps(func)
     async def _wrapper(*args, **kwargs) -> Coroutine:
@@ -89,10 +101,19 @@ def transactional(func: AsyncCallable) -> AsyncCallable:
             if db_session.in_transaction():
                 return await func(*args, **kwargs)
 
-            async with db_session.begin():
-                # automatically committed / rolled back thanks to the context manager
-                return_value = await func(*args, **kwargs)
-
+            try:
+                async with db_session.begin():
+                    # automatically committed / rolled back thanks to the context manager
+                    return_value = await func(*args, **kwargs)
+            finally:
+                # callbacks of a rolled back transaction are dropped
+                callbacks = db_session.info.pop("after_commit", {})
+
+            for key, callback in callbacks.items():
+                try:
+                    callback()
+                except Exception as error:
+                    logging.error(f"after_commit {key} error", exc_info=error)
             return return_value
         except Exception as error:
             logging.error("transactional error", exc_info=error)
@@ -14,6 +14,7 @@
 #  limitations under the License.
 #
 
+import asyncio
 import io
 
 import numpy as np
@@ -27,14 +28,23 @@ from deepdoc.vision import OCR
 ocr = OCR()
 
 
-async def chunk(filename, binary, tenant_id, lang, callback=None, **kwargs):
+def ocr_image(binary):
+    """The RGB image of `binary` and the text OCR finds in it. CPU bound, to be run off the event loop."""
     img = Image.open(io.BytesIO(binary)).convert('RGB')
+    bxs = ocr(np.array(img))
+    return img, "\n".join([t[0] for _, t in bxs if t[0]])
+
+
+async def chunk(filename, binary, tenant_id, lang, callback=None, ocr_result=None, **kwargs):
+    """
+    `ocr_result` is what `ocr_image` gives for `binary` when the caller ran it already, in an executor of its own;
+    otherwise it's run in a worker thread.
+    """
+    img, txt = ocr_result or await asyncio.to_thread(ocr_image, binary)
     doc = {
         "docnm_kwd": filename,
         "image": img
     }
-    bxs = ocr(np.array(img))
-    txt = "\n".join([t[0] for _, t in bxs if t[0]])
     eng = lang.lower() == "english"
     await callback(0.4, "Finish OCR: (%s ...)" % txt[:12])
     if (eng and len(txt.split()) > 32) or len(txt) > 32:
@@ -48,7 +58,7 @@ async def chunk(filename, binary, tenant_id, lang, callback=None, **kwargs):
         img_binary = io.BytesIO()
         img.save(img_binary, format='JPEG')
         img_binary.seek(0)
-        ans = cv_mdl.describe(img_binary.read())
+        ans = await cv_mdl.describe(img_binary.read())
         await callback(0.8, "CV LLM respond: %s ..." % ans[:32])
         txt += "\n" + ans
         tokenize(doc, txt, eng)
@@ -16,7 +16,6 @@
 import logging
 import re
 import threading
-import requests
 from huggingface_hub import snapshot_download
 from zhipuai import ZhipuAI
 import os
@@ -30,6 +29,10 @@ import asyncio
 from services import settings
 from services.utils.file_utils import get_home_cache_dir
 from rag.utils import num_tokens_from_string, truncate
+from rag.utils.http_conn import HTTP_CONN
+from rag.llm.micro_batch import get_batcher
+from rag.llm.ort_model import OrtEmbedding
+from rag.settings import LOCAL_ORT, LOCAL_BATCH
 import google.generativeai as genai
 import json
 
@@ -44,6 +47,15 @@ class Base(ABC):
     def encode_queries(self, text: str):
         raise NotImplementedError("Please implement encode method!")
 
+    def encode_queries_batch(self, texts: list):
+        ress = []
+        token_count = 0
+        for t in texts:
+            embd, cnt = self.encode_queries(t)
+            ress.append(embd)
+            token_count += cnt
+        return np.array(ress), token_count
+
     def total_token_count(self, resp):
         try:
             return resp.usage.total_tokens
@@ -75,9 +87,20 @@ class DefaultEmbedding(Base):
         """
         if not settings.LIGHTEN:
             with DefaultEmbedding._model_lock:
-                from FlagEmbedding import FlagModel
-                import torch
+                if (not DefaultEmbedding._model or model_name != DefaultEmbedding._model_name) and LOCAL_ORT:
+                    try:
+                        model_dir = os.path.join(get_home_cache_dir(), re.sub(r"^[a-zA-Z0-9]+/", "", model_name))
+                        if not os.path.exists(os.path.join(model_dir, "config.json")):
+                            model_dir = snapshot_download(repo_id="BAAI/bge-large-zh-v1.5", local_dir=model_dir,
+                                                          local_dir_use_symlinks=False)
+                        DefaultEmbedding._model = OrtEmbedding(model_dir,
+                                                               query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：")
+                        DefaultEmbedding._model_name = model_name
+                    except Exception:
+                        logging.exception(f"DefaultEmbedding can't run {model_name} on ONNX Runtime, using FlagEmbedding")
                 if not DefaultEmbedding._model or model_name != DefaultEmbedding._model_name:
+                    from FlagEmbedding import FlagModel
+                    import torch
                     try:
                         DefaultEmbedding._model = FlagModel(os.path.join(get_home_cache_dir(), re.sub(r"^[a-zA-Z0-9]+/", "", model_name)),
                                                             query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
@@ -99,6 +122,9 @@ class DefaultEmbedding(Base):
         token_count = 0
         for t in texts:
             token_count += num_tokens_from_string(t)
+        if isinstance(self._model, OrtEmbedding):
+            # sorted by length over all the texts, not batch by batch, to pad them to as short buckets as can be
+            return self._model.encode(texts, batch_size=batch_size), token_count
         ress = []
         for i in range(0, len(texts), batch_size):
             ress.extend(self._model.encode(texts[i:i + batch_size]).tolist())
@@ -106,8 +132,22 @@ class DefaultEmbedding(Base):
 
     def encode_queries(self, text: str):
         token_count = num_tokens_from_string(text)
+        if LOCAL_BATCH:
+            return self._batcher().submit([text])[0].tolist(), token_count
         return self._model.encode_queries([text]).tolist()[0], token_count
 
+    def encode_queries_batch(self, texts: list):
+        token_count = 0
+        for t in texts:
+            token_count += num_tokens_from_string(t)
+        if LOCAL_BATCH:
+            return np.array(self._batcher().submit(texts).tolist()), token_count
+        return np.array(self._model.encode_queries(texts).tolist()), token_count
+
+    def _batcher(self):
+        # the queries of concurrent requests are embedded in one forward pass
+        return get_batcher(f"{self.__class__.__name__}:{self._model_name}", self._model.encode_queries)
+
 
 class OpenAIEmbed(Base):
     def __init__(self, key, model_name="text-embedding-ada-002",
@@ -135,6 +175,9 @@ class OpenAIEmbed(Base):
                                             model=self.model_name)
         return np.array(res.data[0].embedding), self.total_token_count(res)
 
+    def encode_queries_batch(self, texts: list):
+        return self.encode(texts)
+
 
 class LocalAIEmbed(Base):
     def __init__(self, key, model_name, base_url):
@@ -158,6 +201,9 @@ class LocalAIEmbed(Base):
         embds, cnt = self.encode([text])
         return np.array(embds[0]), cnt
 
+    def encode_queries_batch(self, texts: list):
+        return self.encode(texts)
+
 
 class AzureEmbed(OpenAIEmbed):
     def __init__(self, key, model_name, **kwargs):
@@ -393,7 +439,7 @@ class JinaEmbed(Base):
                 "input": texts[i:i + batch_size],
                 'encoding_type': 'float'
             }
-            res = requests.post(self.base_url, headers=self.headers, json=data).json()
+            res = HTTP_CONN.post("JinaEmbed", self.base_url, headers=self.headers, json=data).json()
             ress.extend([d["embedding"] for d in res["data"]])
             token_count += self.total_token_count(res)
         return np.array(ress), token_count
@@ -402,6 +448,9 @@ class JinaEmbed(Base):
         embds, cnt = self.encode([text])
         return np.array(embds[0]), cnt
 
+    def encode_queries_batch(self, texts: list):
+        return self.encode(texts)
+
 
 class InfinityEmbed(Base):
     _model = None
@@ -580,7 +629,7 @@ class NvidiaEmbed(Base):
                 "encoding_format": "float",
                 "truncate": "END",
             }
-            res = requests.post(self.base_url, headers=self.headers, json=payload).json()
+            res = HTTP_CONN.post("NvidiaEmbed", self.base_url, headers=self.headers, json=payload).json()
             ress.extend([d["embedding"] for d in res["data"]])
             token_count += self.total_token_count(res)
         return np.array(ress), token_count
@@ -589,6 +638,9 @@ class NvidiaEmbed(Base):
         embds, cnt = self.encode([text])
         return np.array(embds[0]), cnt
 
+    def encode_queries_batch(self, texts: list):
+        return self.encode(texts)
+
 
 class LmStudioEmbed(LocalAIEmbed):
     def __init__(self, key, model_name, base_url):
@@ -690,7 +742,7 @@ class SILICONFLOWEmbed(Base):
                 "input": texts_batch,
                 "encoding_format": "float",
             }
-            res = requests.post(self.base_url, json=payload, headers=self.headers).json()
+            res = HTTP_CONN.post("SILICONFLOWEmbed", self.base_url, json=payload, headers=self.headers).json()
             if "data" not in res or not isinstance(res["data"], list) or len(res["data"]) != len(texts_batch):
                 raise ValueError(f"SILICONFLOWEmbed.encode got invalid response from {self.base_url}")
             ress.extend([d["embedding"] for d in res["data"]])
@@ -703,7 +755,7 @@ class SILICONFLOWEmbed(Base):
             "input": text,
             "encoding_format": "float",
         }
-        res = requests.post(self.base_url, json=payload, headers=self.headers).json()
+        res = HTTP_CONN.post("SILICONFLOWEmbed", self.base_url, json=payload, headers=self.headers).json()
         if "data" not in res or not isinstance(res["data"], list) or len(res["data"])!= 1:
             raise ValueError(f"SILICONFLOWEmbed.encode_queries got invalid response from {self.base_url}")
         return np.array(res["data"][0]["embedding"]), self.total_token_count(res)
@@ -792,7 +844,8 @@ class HuggingFaceEmbed(Base):
     def encode(self, texts: list):
         embeddings = []
         for text in texts:
-            response = requests.post(
+            response = HTTP_CONN.post(
+                "HuggingFaceEmbed",
                 f"{self.base_url}/embed",
                 json={"inputs": text},
                 headers={'Content-Type': 'application/json'}
@@ -805,7 +858,8 @@ class HuggingFaceEmbed(Base):
         return np.array(embeddings), sum([num_tokens_from_string(text) for text in texts])
 
     def encode_queries(self, text):
-        response = requests.post(
+        response = HTTP_CONN.post(
+            "HuggingFaceEmbed",
             f"{self.base_url}/embed",
             json={"inputs": text},
             headers={'Content-Type': 'application/json'}
@@ -0,0 +1,153 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import queue
+import threading
+import time
+
+from rag.settings import LOCAL_BATCH_MAX_SIZE, LOCAL_BATCH_MAX_WAIT_MS
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+QUEUE_WAIT_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1]
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.count = 0
+        self.sum = 0.0
+        self.counts = [0] * (len(buckets) + 1)
+
+    def observe(self, v):
+        self.count += 1
+        self.sum += v
+        for i, b in enumerate(self.buckets):
+            if v <= b:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "buckets": {str(b): c for b, c in zip(self.buckets + ["+Inf"], self.counts)},
+        }
+
+
+class _Request:
+    def __init__(self, items):
+        self.items = items
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Runs `fn`, taking a list of inputs and giving a sequence of as many outputs, on the inputs of concurrent
+    `submit` calls at once: the first request waits up to `max_wait_ms` for others, until `max_size` inputs
+    are gathered, and each caller gets back the outputs of its own inputs.
+    One worker thread calls `fn`, so a model behind it no longer needs a lock of its own.
+    """
+
+    def __init__(self, name, fn, max_size=LOCAL_BATCH_MAX_SIZE, max_wait_ms=LOCAL_BATCH_MAX_WAIT_MS):
+        self.name = name
+        self.fn = fn
+        self.max_size = max(max_size, 1)
+        self.max_wait = max_wait_ms / 1000.
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = _Histogram(BATCH_SIZE_BUCKETS)
+        self._queue_waits = _Histogram(QUEUE_WAIT_BUCKETS)
+        self._errors = 0
+        threading.Thread(target=self._worker, name=f"micro_batch_{name}", daemon=True).start()
+
+    def submit(self, items):
+        """The outputs of `items`, computed along with the inputs of the concurrent callers."""
+        if not items:
+            return self.fn(items)
+        req = _Request(list(items))
+        self._queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def _gather(self, first):
+        batch, size = [first], len(first.items)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_size:
+            try:
+                # requests queued while the previous batch ran are taken without waiting
+                req = self._queue.get(timeout=max(deadline - time.perf_counter(), 0)) \
+                    if self.max_wait > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if size + len(req.items) > self.max_size:
+                return batch, req
+            batch.append(req)
+            size += len(req.items)
+        return batch, None
+
+    def _worker(self):
+        carried = None
+        while True:
+            first = carried or self._queue.get()
+            batch, carried = self._gather(first)
+            items = [it for req in batch for it in req.items]
+            st = time.perf_counter()
+            with self._lock:
+                self._batch_sizes.observe(len(items))
+                for req in batch:
+                    self._queue_waits.observe(st - req.enqueued)
+            try:
+                res = self.fn(items)
+                s = 0
+                for req in batch:
+                    req.result = res[s: s + len(req.items)]
+                    s += len(req.items)
+            except Exception as e:
+                logging.exception(f"MicroBatcher {self.name} fails on a batch of {len(items)}")
+                with self._lock:
+                    self._errors += 1
+                for req in batch:
+                    req.error = e
+            for req in batch:
+                req.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"errors": self._errors, "batch_size": self._batch_sizes.to_dict(),
+                    "queue_wait": self._queue_waits.to_dict()}
+
+
+def get_batcher(name, fn):
+    """The batcher of `name`, created on first use with `fn`."""
+    with _batchers_lock:
+        if name not in _batchers:
+            _batchers[name] = MicroBatcher(name, fn)
+        return _batchers[name]
+
+
+def micro_batch_stats() -> dict:
+    with _batchers_lock:
+        batchers = list(_batchers.values())
+    return {b.name: b.stats() for b in batchers}
@@ -0,0 +1,278 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+ONNX Runtime stand-ins of the FlagEmbedding models behind DefaultEmbedding and DefaultRerank, for CPU nodes.
+
+    python -m rag.llm.ort_model --kind embedding --model ~/.cache/.../bge-large-zh-v1.5
+
+checks the ONNX models against the PyTorch one on the fixed corpus and prints the throughput of each.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from filelock import FileLock
+
+from rag.settings import LOCAL_ORT_INT8, LOCAL_ORT_INTRA_THREADS, LOCAL_ORT_INTER_THREADS, LOCAL_ORT_BUCKETS, \
+    LOCAL_ORT_MIN_AGREEMENT
+
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+# corpus the int8 model is checked against the fp32 one on
+CHECK_CORPUS = [
+    "The quarterly revenue grew by 12% compared with the same period last year.",
+    "Install the package with pip and run the setup script before the first start.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "The court held that the contract was void for lack of consideration.",
+    "Transformers use self-attention to weigh the relevance of every token to the others.",
+    "Reset the router by holding the power button for ten seconds.",
+    "The patient was prescribed 500 mg of amoxicillin three times a day.",
+    "本季度营业收入同比增长百分之十二，主要来自海外市场。",
+    "使用前请仔细阅读说明书，并按照操作步骤连接电源。",
+    "合同双方应当按照约定全面履行自己的义务。",
+    "深度学习模型需要大量标注数据进行训练。",
+    "该论文提出了一种基于图神经网络的推荐算法。",
+    "如遇故障，请先检查网络连接是否正常。",
+    "北京是中华人民共和国的首都，也是全国的政治和文化中心。",
+    "Q: How do I change my password? A: Open the account settings and choose security.",
+    "Table 3 lists the mean and standard deviation of each measurement.",
+]
+CHECK_QUERIES = ["how does a model learn from data", "合同的履行义务", "router troubleshooting"]
+
+
+def cosine_agreement(a, b):
+    """Mean and minimum cosine similarity of the rows of `a` and `b`."""
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    cos = np.sum(a * b, axis=1)
+    return float(np.mean(cos)), float(np.min(cos))
+
+
+def rank_correlation(a, b):
+    """Spearman correlation of two score lists, ties ranked by position."""
+    ra = np.argsort(np.argsort(a)).astype(np.float64)
+    rb = np.argsort(np.argsort(b)).astype(np.float64)
+    if len(ra) < 2:
+        return 1.0
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+
+def bucket_length(n):
+    for b in LOCAL_ORT_BUCKETS:
+        if n <= b:
+            return b
+    return n
+
+
+def _session(path):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = LOCAL_ORT_INTRA_THREADS
+    options.inter_op_num_threads = LOCAL_ORT_INTER_THREADS
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def _export(model_dir, kind, path):
+    """Export the CLS embedding, or the relevance logit, of the Hugging Face model in `model_dir` to `path`."""
+    import torch
+    from transformers import AutoModel, AutoModelForSequenceClassification, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    if kind == "embedding":
+        model = AutoModel.from_pretrained(model_dir)
+    else:
+        model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+    model.eval()
+    sample = tokenizer(["sample text"], ["sample text"], return_tensors="pt")
+    names = [n for n in INPUT_NAMES if n in sample]
+
+    class Head(torch.nn.Module):
+        def forward(self, *inputs):
+            out = model(**dict(zip(names, inputs)))
+            return out.last_hidden_state[:, 0] if kind == "embedding" else out.logits[:, 0]
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(Head(), tuple(sample[n] for n in names), tmp, input_names=names, output_names=["output"],
+                          dynamic_axes={**{n: {0: "batch", 1: "seq"} for n in names}, "output": {0: "batch"}},
+                          opset_version=14)
+    os.replace(tmp, path)
+
+
+def _quantize(fp32_path, int8_path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    tmp = f"{int8_path}.{os.getpid()}.tmp"
+    quantize_dynamic(fp32_path, tmp, weight_type=QuantType.QInt8)
+    os.replace(tmp, int8_path)
+
+
+class OrtModel(object):
+    """
+    A model of `kind` "embedding" or "rerank" exported to ONNX in `<model_dir>/onnx` on first use.
+    Texts are sorted by length and each batch padded to its bucket, so short inputs aren't run at 512 tokens.
+    """
+
+    def __init__(self, model_dir, kind, max_length=512, int8=LOCAL_ORT_INT8):
+        from transformers import AutoTokenizer
+
+        self.kind = kind
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        onnx_dir = os.path.join(model_dir, "onnx")
+        fp32_path = os.path.join(onnx_dir, f"{kind}.onnx")
+        os.makedirs(onnx_dir, exist_ok=True)
+        # the API server and the task executors share the model directory: one process exports, quantizes and
+        # checks the model while the others wait and then load its files
+        with FileLock(os.path.join(onnx_dir, f"{kind}.lock")):
+            if not os.path.exists(fp32_path):
+                logging.info(f"OrtModel exporting {model_dir} to {fp32_path}")
+                _export(model_dir, kind, fp32_path)
+            self.session = _session(fp32_path)
+            self.input_names = [i.name for i in self.session.get_inputs()]
+            self.precision = "fp32"
+            if int8:
+                self._use_int8(fp32_path, os.path.join(onnx_dir, f"{kind}.int8.onnx"))
+        logging.info(f"OrtModel {model_dir} {kind} loaded in {self.precision}")
+
+    def _use_int8(self, fp32_path, int8_path):
+        report_path = int8_path + ".json"
+        if not os.path.exists(int8_path):
+            _quantize(fp32_path, int8_path)
+        int8 = _session(int8_path)
+        if os.path.exists(report_path):
+            with open(report_path) as f:
+                report = json.load(f)
+        else:
+            report = self.check(int8)
+            tmp = f"{report_path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(report, f)
+            os.replace(tmp, report_path)
+        if report["agreement"] < LOCAL_ORT_MIN_AGREEMENT:
+            logging.warning(f"OrtModel int8 {int8_path} disagrees with fp32, {report}, keeping fp32")
+            return
+        self.session = int8
+        self.precision = "int8"
+
+    def check(self, other):
+        """Agreement of the session `other` with this model on the fixed corpus."""
+        current = self.session
+        try:
+            if self.kind == "embedding":
+                ref = self.run(CHECK_CORPUS)
+                self.session = other
+                mean, low = cosine_agreement(ref, self.run(CHECK_CORPUS))
+                return {"agreement": mean, "min_cosine": low}
+            pairs = [(q, t) for q in CHECK_QUERIES for t in CHECK_CORPUS]
+            ref = self.run(pairs)
+            self.session = other
+            res = self.run(pairs)
+            n = len(CHECK_CORPUS)
+            corr = [rank_correlation(ref[i: i + n], res[i: i + n]) for i in range(0, len(pairs), n)]
+            return {"agreement": float(np.mean(corr)), "min_correlation": float(np.min(corr))}
+        finally:
+            self.session = current
+
+    def run(self, inputs, batch_size=16, max_length=None):
+        """The outputs of texts, or of (query, text) pairs, in the order of `inputs`."""
+        if not inputs:
+            # (0, dim) for the embeddings, (0,) for the scores, like the non empty outputs
+            return np.zeros((0, *self.session.get_outputs()[0].shape[1:]), dtype=np.float32)
+        max_length = max_length or self.max_length
+        if isinstance(inputs[0], (tuple, list)):
+            enc = self.tokenizer([q for q, _ in inputs], [t for _, t in inputs], truncation=True,
+                                 max_length=max_length)
+        else:
+            enc = self.tokenizer(list(inputs), truncation=True, max_length=max_length)
+        lengths = [len(ids) for ids in enc["input_ids"]]
+        order = np.argsort(lengths, kind="stable")
+
+        res = [None] * len(inputs)
+        for s in range(0, len(order), batch_size):
+            idx = order[s: s + batch_size]
+            batch = self.tokenizer.pad({k: [enc[k][i] for i in idx] for k in enc.keys()}, padding="max_length",
+                                       max_length=bucket_length(max(lengths[i] for i in idx)), return_tensors="np")
+            feed = {n: batch[n].astype(np.int64) for n in self.input_names}
+            out = self.session.run(None, feed)[0]
+            for i, o in zip(idx, out):
+                res[i] = o
+        return np.stack(res)
+
+
+class OrtEmbedding(OrtModel):
+    """Drop-in for FlagEmbedding's FlagModel: normalized CLS embeddings."""
+
+    def __init__(self, model_dir, query_instruction_for_retrieval="", **kwargs):
+        super().__init__(model_dir, "embedding", **kwargs)
+        self.query_instruction_for_retrieval = query_instruction_for_retrieval
+
+    def encode(self, texts, batch_size=16):
+        embds = self.run(texts, batch_size=batch_size)
+        return embds / np.linalg.norm(embds, axis=1, keepdims=True)
+
+    def encode_queries(self, texts, batch_size=16):
+        return self.encode([self.query_instruction_for_retrieval + t for t in texts], batch_size=batch_size)
+
+
+class OrtReranker(OrtModel):
+    """Drop-in for FlagEmbedding's FlagReranker: raw relevance logits."""
+
+    def __init__(self, model_dir, **kwargs):
+        super().__init__(model_dir, "rerank", **kwargs)
+
+    def compute_score(self, pairs, max_length=None, batch_size=16):
+        return self.run(pairs, batch_size=batch_size, max_length=max_length).tolist()
+
+
+def _throughput(fn, inputs, rounds):
+    fn(inputs)
+    st = time.perf_counter()
+    for _ in range(rounds):
+        fn(inputs)
+    return rounds * len(inputs) / (time.perf_counter() - st)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--kind", choices=["embedding", "rerank"], default="embedding")
+    parser.add_argument("--model", required=True, help="directory of the Hugging Face model")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.kind == "embedding":
+        from FlagEmbedding import FlagModel
+        inputs = CHECK_CORPUS
+        models = {"torch": FlagModel(args.model, use_fp16=False).encode,
+                  "ort-fp32": OrtEmbedding(args.model, int8=False).encode,
+                  "ort-int8": OrtEmbedding(args.model, int8=True).encode}
+    else:
+        from FlagEmbedding import FlagReranker
+        inputs = [(q, t) for q in CHECK_QUERIES for t in CHECK_CORPUS]
+        models = {"torch": FlagReranker(args.model, use_fp16=False).compute_score,
+                  "ort-fp32": OrtReranker(args.model, int8=False).compute_score,
+                  "ort-int8": OrtReranker(args.model, int8=True).compute_score}
+
+    ref = np.array(models["torch"](inputs))
+    for nm, fn in models.items():
+        res = np.array(fn(inputs))
+        if args.kind == "embedding":
+            agreement = cosine_agreement(ref, res)
+        else:
+            agreement = rank_correlation(ref, res)
+        print(f"{nm}: agreement with torch {agreement}, {_throughput(fn, inputs, args.rounds):.1f} inputs/s")
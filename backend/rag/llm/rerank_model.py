@@ -13,11 +13,12 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import logging
 import re
 import threading
+from functools import partial
 from urllib.parse import urljoin
 
-import requests
 import httpx
 from huggingface_hub import snapshot_download
 import os
@@ -28,6 +29,10 @@ from yarl import URL
 from services import settings
 from services.utils.file_utils import get_home_cache_dir
 from rag.utils import num_tokens_from_string, truncate
+from rag.utils.http_conn import HTTP_CONN
+from rag.llm.micro_batch import get_batcher
+from rag.llm.ort_model import OrtReranker
+from rag.settings import LOCAL_ORT, LOCAL_BATCH
 import json
 
 
@@ -71,6 +76,17 @@ class DefaultRerank(Base):
         ^_-
 
         """
+        if not settings.LIGHTEN and not DefaultRerank._model and LOCAL_ORT:
+            with DefaultRerank._model_lock:
+                if not DefaultRerank._model:
+                    try:
+                        model_dir = os.path.join(get_home_cache_dir(), re.sub(r"^[a-zA-Z0-9]+/", "", model_name))
+                        if not os.path.exists(os.path.join(model_dir, "config.json")):
+                            model_dir = snapshot_download(repo_id=model_name, local_dir=model_dir,
+                                                          local_dir_use_symlinks=False)
+                        DefaultRerank._model = OrtReranker(model_dir)
+                    except Exception:
+                        logging.exception(f"DefaultRerank can't run {model_name} on ONNX Runtime, using FlagEmbedding")
         if not settings.LIGHTEN and not DefaultRerank._model:
             import torch
             from FlagEmbedding import FlagReranker
@@ -145,6 +161,10 @@ class DefaultRerank(Base):
         for _, t in pairs:
             token_count += num_tokens_from_string(t)
         batch_size = 4096
+        if LOCAL_BATCH:
+            # the pairs of concurrent requests are scored together, by the one thread calling the model
+            batcher = get_batcher(self.__class__.__name__, partial(self._process_batch, max_batch_size=batch_size))
+            return np.array(batcher.submit(pairs)), token_count
         res = self._process_batch(pairs, max_batch_size=batch_size)
         return np.array(res), token_count
 
@@ -167,7 +187,7 @@ class JinaRerank(Base):
             "documents": texts,
             "top_n": len(texts)
         }
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = HTTP_CONN.post("JinaRerank", self.base_url, headers=self.headers, json=data).json()
         rank = np.zeros(len(texts), dtype=float)
         for d in res["results"]:
             rank[d["index"]] = d["relevance_score"]
@@ -232,7 +252,7 @@ class XInferenceRerank(Base):
             "return_len": "true",
             "documents": texts
         }
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = HTTP_CONN.post("XInferenceRerank", self.base_url, headers=self.headers, json=data).json()
         rank = np.zeros(len(texts), dtype=float)
         for d in res["results"]:
             rank[d["index"]] = d["relevance_score"]
@@ -262,7 +282,7 @@ class LocalAIRerank(Base):
         token_count = 0
         for t in texts:
             token_count += num_tokens_from_string(t)
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = HTTP_CONN.post("LocalAIRerank", self.base_url, headers=self.headers, json=data).json()
         rank = np.zeros(len(texts), dtype=float)
         if 'results' not in res:
             raise ValueError("response not contains results\n" + str(res))
@@ -315,7 +335,7 @@ class NvidiaRerank(Base):
             "truncate": "END",
             "top_n": len(texts),
         }
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = HTTP_CONN.post("NvidiaRerank", self.base_url, headers=self.headers, json=data).json()
         rank = np.zeros(len(texts), dtype=float)
         for d in res["rankings"]:
             rank[d["index"]] = d["logit"]
@@ -353,7 +373,7 @@ class OpenAI_APIRerank(Base):
         token_count = 0
         for t in texts:
             token_count += num_tokens_from_string(t)
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = HTTP_CONN.post("OpenAI_APIRerank", self.base_url, headers=self.headers, json=data).json()
         rank = np.zeros(len(texts), dtype=float)
         if 'results' not in res:
             raise ValueError("response not contains results\n" + str(res))
@@ -429,8 +449,8 @@ class SILICONFLOWRerank(Base):
             "max_chunks_per_doc": 1024,
             "overlap_tokens": 80,
         }
-        response = requests.post(
-            self.base_url, json=payload, headers=self.headers
+        response = HTTP_CONN.post(
+            "SILICONFLOWRerank", self.base_url, json=payload, headers=self.headers
         ).json()
         rank = np.zeros(len(texts), dtype=float)
         if "results" not in response:
@@ -535,8 +555,8 @@ class GPUStackRerank(Base):
         }
 
         try:
-            response = requests.post(
-                self.base_url, json=payload, headers=self.headers
+            response = HTTP_CONN.post(
+                "GPUStackRerank", self.base_url, json=payload, headers=self.headers
             )
             response.raise_for_status()
             response_json = response.json()
@@ -225,6 +225,31 @@ class FulltextQueryer:
         btkss = [toDict(tks) for tks in btkss]
         return [self.similarity(atks, btks) for btks in btkss]
 
+    def token_similarity_matrix(self, atkss, btkss):
+        """
+        token_similarity of every query in atkss against every candidate in btkss as one matrix.
+        Only the presence of a query term in a candidate counts, so candidates need no weighting.
+        """
+        import numpy as np
+
+        atkss = [tks.split() if isinstance(tks, str) else tks for tks in atkss]
+        vocab = {}
+        for tks in atkss:
+            for t in tks:
+                vocab.setdefault(t, len(vocab))
+        qwts = np.zeros((len(atkss), len(vocab)))
+        for i, tks in enumerate(atkss):
+            for t, w in self.tw.weights(tks, preprocess=False):
+                qwts[i, vocab[t]] += w
+        presence = np.zeros((len(btkss), len(vocab)))
+        for j, tks in enumerate(btkss):
+            if isinstance(tks, str):
+                tks = tks.split()
+            for t in set(tks):
+                if t in vocab:
+                    presence[j, vocab[t]] = 1
+        return (qwts @ presence.T + 1e-9) / (qwts.sum(axis=1, keepdims=True) + 1e-9)
+
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
             dtwt = {t: w for t, w in self.tw.weights(self.tw.split(dtwt), preprocess=False)}
@@ -16,6 +16,7 @@
 import logging
 import re
 from dataclasses import dataclass
+from itertools import islice
 
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import rmSpace, get_float
@@ -129,16 +130,25 @@ class Dealer:
                     total = self.dataStore.getTotal(res)
                     logging.debug("Dealer.search 2 TOTAL: {}".format(total))
 
-            for k in keywords:
-                kwds.add(k)
-                for kk in rag_tokenizer.fine_grained_tokenize(k).split():
-                    if len(kk) < 2:
-                        continue
-                    if kk in kwds:
-                        continue
-                    kwds.add(kk)
+            kwds = self._expand_keywords(keywords)
 
         logging.debug(f"TOTAL: {total}")
+        return self._search_result(res, total, src, q_vec, kwds)
+
+    @staticmethod
+    def _expand_keywords(keywords):
+        kwds = set([])
+        for k in keywords:
+            kwds.add(k)
+            for kk in rag_tokenizer.fine_grained_tokenize(k).split():
+                if len(kk) < 2:
+                    continue
+                if kk in kwds:
+                    continue
+                kwds.add(kk)
+        return kwds
+
+    def _search_result(self, res, total, src, q_vec, kwds):
         ids = self.dataStore.getChunkIds(res)
         keywords = list(kwds)
         highlight = self.dataStore.getHighlight(res, keywords, "content_with_weight")
@@ -153,6 +163,64 @@ class Dealer:
             keywords=keywords
         )
 
+    async def search_batch(self, reqs: list[dict], idx_names: str | list[str],
+                           kb_ids: list[str],
+                           emb_mdl,
+                           highlight=False,
+                           rank_features: list[dict | None] | None = None
+                           ):
+        """
+        Same as `search` for many questions: the questions are embedded in one call and sent to the
+        doc store as one multi-search. Each req must carry a question.
+        """
+        rank_features = rank_features or [None] * len(reqs)
+        qvs, _ = await emb_mdl.encode_queries_batch([req["question"] for req in reqs])
+
+        searches, metas = [], []
+        for req, qv, rank_feature in zip(reqs, qvs, rank_features):
+            topk = int(req.get("topk", 1024))
+            pg = int(req.get("page", 1)) - 1
+            ps = int(req.get("size", topk))
+            src = list(req.get("fields",
+                               ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd",
+                                "position_int", "doc_id", "page_num_int", "top_int", "create_timestamp_flt",
+                                "knowledge_graph_kwd", "question_kwd", "question_tks", "idx", "mixed",
+                                "available_int", "content_with_weight", PAGERANK_FLD, TAG_FLD]))
+            matchText, keywords = self.qryr.question(req["question"], min_match=0.3)
+            q_vec = [float(v) for v in qv]
+            matchDense = MatchDenseExpr(f"q_{len(q_vec)}_vec", q_vec, 'float', 'cosine', topk,
+                                        {"similarity": req.get("similarity", 0.1)})
+            src.append(f"q_{len(q_vec)}_vec")
+            fusionExpr = FusionExpr("weighted_sum", topk, {"weights": "0.05, 0.95"})
+            search = {"selectFields": src,
+                      "highlightFields": ["content_ltks", "title_tks"] if highlight else [],
+                      "condition": self.get_filters(req),
+                      "matchExprs": [matchText, matchDense, fusionExpr],
+                      "orderBy": OrderByExpr(),
+                      "offset": pg * ps,
+                      "limit": ps,
+                      "indexNames": idx_names,
+                      "knowledgebaseIds": kb_ids,
+                      "rank_feature": rank_feature}
+            searches.append(search)
+            metas.append((req, src, q_vec, keywords, matchDense, fusionExpr))
+
+        results = []
+        for search, (req, src, q_vec, keywords, matchDense, fusionExpr), res in zip(
+                searches, metas, self.dataStore.multiSearch(searches)):
+            total = self.dataStore.getTotal(res)
+            # If result is empty, try again with lower min_match, as `search` does
+            if total == 0:
+                matchText, _ = self.qryr.question(req["question"], min_match=0.1)
+                search["condition"].pop("doc_ids", None)
+                matchDense.extra_options["similarity"] = 0.17
+                search["matchExprs"] = [matchText, matchDense, fusionExpr]
+                res = self.dataStore.search(**search)
+                total = self.dataStore.getTotal(res)
+            logging.debug("Dealer.search_batch TOTAL: {}".format(total))
+            results.append(self._search_result(res, total, src, q_vec, self._expand_keywords(keywords)))
+        return results
+
     @staticmethod
     def trans2floats(txt):
         return [float(t) for t in txt.split("\t")]
@@ -209,24 +277,26 @@ class Dealer:
         assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
             len(ans_v[0]), len(chunk_v[0]))
 
-        chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split()
-                      for ck in chunks]
+        # The sentence x chunk similarity is computed once; chunks come as query-time `content_ltks`,
+        # so they are only split rather than re-tokenized.
+        chunks_tks = [ck.split() if isinstance(ck, str) else ck for ck in chunks]
+        pieces_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(p)).split() for p in pieces_]
+        ans_v = np.array(ans_v, dtype=float)
+        chunk_v = np.array(chunk_v, dtype=float)
+        ans_v /= np.maximum(np.linalg.norm(ans_v, axis=1, keepdims=True), 1e-12)
+        chunk_v /= np.maximum(np.linalg.norm(chunk_v, axis=1, keepdims=True), 1e-12)
+        vtsim = ans_v @ chunk_v.T
+        tksim = self.qryr.token_similarity_matrix(pieces_tks, chunks_tks)
+        sim = np.where(np.sum(vtsim, axis=1, keepdims=True) == 0, tksim, vtsim * vtweight + tksim * tkweight)
+        mx = np.max(sim, axis=1) * 0.99
+
         cites = {}
         thr = 0.63
         while thr > 0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
-            for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i],
-                                                                chunk_v,
-                                                                rag_tokenizer.tokenize(
-                                                                    self.qryr.rmWWW(pieces_[i])).split(),
-                                                                chunks_tks,
-                                                                tkweight, vtweight)
-                mx = np.max(sim) * 0.99
-                logging.debug("{} SIM: {}".format(pieces_[i], mx))
-                if mx < thr:
-                    continue
-                cites[idx[i]] = list(
-                    set([str(ii) for ii in range(len(chunk_v)) if sim[ii] > mx]))[:4]
+            for i in np.where(mx >= thr)[0]:
+                logging.debug("{} SIM: {}".format(pieces_[i], mx[i]))
+                above = [ii for ii in np.argsort(-sim[i]) if sim[i][ii] > mx[i]]
+                cites[idx[i]] = [str(ii) for ii in above[:4]]
             thr *= 0.8
 
         res = ""
@@ -369,58 +439,8 @@ class Dealer:
             sim, tsim, vsim = self.rerank(
                 sres, question, 1 - vector_similarity_weight, vector_similarity_weight,
                 rank_feature=rank_feature)
-        idx = np.argsort(sim * -1)[(page - 1) * page_size:page * page_size]
-
-        dim = len(sres.query_vector)
-        vector_column = f"q_{dim}_vec"
-        zero_vector = [0.0] * dim
-        if doc_ids:
-            similarity_threshold = 0
-            # page_size = 30
-        for i in idx:
-            # if sim[i] < similarity_threshold:
-            #     break
-            if len(ranks["chunks"]) >= page_size:
-                if aggs:
-                    continue
-                break
-            id = sres.ids[i]
-            chunk = sres.field[id]
-            dnm = chunk.get("docnm_kwd", "")
-            did = chunk.get("doc_id", "")
-            position_int = chunk.get("position_int", [])
-            d = {
-                "chunk_id": id,
-                "content_ltks": chunk["content_ltks"],
-                "content_with_weight": chunk["content_with_weight"],
-                "doc_id": did,
-                "docnm_kwd": dnm,
-                "kb_id": chunk["kb_id"],
-                "important_kwd": chunk.get("important_kwd", []),
-                "image_id": chunk.get("img_id", ""),
-                "similarity": sim[i],
-                "vector_similarity": vsim[i],
-                "term_similarity": tsim[i],
-                "vector": chunk.get(vector_column, zero_vector),
-                "positions": position_int,
-            }
-            if highlight and sres.highlight:
-                if id in sres.highlight:
-                    d["highlight"] = rmSpace(sres.highlight[id])
-                else:
-                    d["highlight"] = d["content_with_weight"]
-            ranks["chunks"].append(d)
-            if dnm not in ranks["doc_aggs"]:
-                ranks["doc_aggs"][dnm] = {"doc_id": did, "count": 0}
-            ranks["doc_aggs"][dnm]["count"] += 1
-        ranks["doc_aggs"] = [{"doc_name": k,
-                              "doc_id": v["doc_id"],
-                              "count": v["count"]} for k,
-                             v in sorted(ranks["doc_aggs"].items(),
-                                         key=lambda x: x[1]["count"] * -1)]
-        ranks["chunks"] = ranks["chunks"][:page_size]
-
-        return ranks
+        return self._compose_ranks(ranks, sres, sim, tsim, vsim, page, page_size, doc_ids, aggs, highlight,
+                                   paging=True)
 
     async def retrieval(self, question, embd_mdl, tenant_ids, kb_ids, page, page_size, similarity_threshold=0.2,
                   vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True,
@@ -452,17 +472,62 @@ class Dealer:
             sim, tsim, vsim = self.rerank(
                 sres, question, 1 - vector_similarity_weight, vector_similarity_weight,
                 rank_feature=rank_feature)
+        return self._compose_ranks(ranks, sres, sim, tsim, vsim, page, page_size, doc_ids, aggs, highlight)
+
+    async def retrieval_batch(self, questions: list[str], embd_mdl, tenant_ids, kb_ids, page, page_size,
+                              similarity_threshold=0.2, vector_similarity_weight=0.3, top=1024, doc_ids=None,
+                              aggs=True, rerank_mdl=None, highlight=False,
+                              rank_features: list[dict | None] | None = None):
+        """
+        `retrieval_paging` for many questions at once; returns one ranks dict per question, in order.
+        """
+        if rank_features is None:
+            rank_features = [{PAGERANK_FLD: 10}] * len(questions)
+        ranks_list = [{"total": 0, "chunks": [], "doc_aggs": {}} for _ in questions]
+        todo = [i for i, q in enumerate(questions) if q]
+        if not todo:
+            return ranks_list
+
+        RERANK_LIMIT = 10000
+        reqs = [{"kb_ids": kb_ids, "doc_ids": doc_ids, "page": 1, "size": RERANK_LIMIT,
+                 "question": questions[i], "vector": True, "topk": top,
+                 "similarity": similarity_threshold,
+                 "available_int": 1} for i in todo]
+
+        if isinstance(tenant_ids, str):
+            tenant_ids = tenant_ids.split(",")
+
+        sress = await self.search_batch(reqs, [index_name(tid) for tid in tenant_ids], kb_ids, embd_mdl,
+                                        highlight, rank_features=[rank_features[i] for i in todo])
+        for i, sres in zip(todo, sress):
+            ranks = ranks_list[i]
+            ranks["total"] = sres.total
+            if rerank_mdl and sres.total > 0:
+                sim, tsim, vsim = await self.rerank_by_model(rerank_mdl,
+                                                             sres, questions[i], 1 - vector_similarity_weight,
+                                                             vector_similarity_weight,
+                                                             rank_feature=rank_features[i])
+            else:
+                sim, tsim, vsim = self.rerank(
+                    sres, questions[i], 1 - vector_similarity_weight, vector_similarity_weight,
+                    rank_feature=rank_features[i])
+            ranks_list[i] = self._compose_ranks(ranks, sres, sim, tsim, vsim, page, page_size, doc_ids, aggs,
+                                                highlight, paging=True)
+        return ranks_list
+
+    def _compose_ranks(self, ranks, sres, sim, tsim, vsim, page, page_size, doc_ids, aggs, highlight, paging=False):
+        """
+        The `page` of the reranked search result. With `paging` the search fetched up to RERANK_LIMIT chunks
+        from its first page and keeps `page_size` whether or not it is restricted to `doc_ids`.
+        """
         idx = np.argsort(sim * -1)[(page - 1) * page_size:page * page_size]
 
         dim = len(sres.query_vector)
         vector_column = f"q_{dim}_vec"
         zero_vector = [0.0] * dim
-        if doc_ids:
-            similarity_threshold = 0
+        if doc_ids and not paging:
             page_size = 30
         for i in idx:
-            # if sim[i] < similarity_threshold:
-            #     break
             if len(ranks["chunks"]) >= page_size:
                 if aggs:
                     continue
@@ -513,20 +578,23 @@ class Dealer:
                    kb_ids: list[str], max_count=1024,
                    offset=0,
                    fields=["docnm_kwd", "content_with_weight", "img_id"]):
-        condition = {"doc_id": doc_id}
-        res = []
-        bs = 128
-        for p in range(offset, max_count, bs):
-            es_res = self.dataStore.search(fields, [], condition, [], OrderByExpr(), p, bs, index_name(tenant_id),
-                                           kb_ids)
-            dict_chunks = self.dataStore.getFields(es_res, fields)
-            for id, doc in dict_chunks.items():
-                doc["id"] = id
-            if dict_chunks:
-                res.extend(dict_chunks.values())
-            if len(dict_chunks.values()) < bs:
+        return list(islice(self.iter_chunks(doc_id, tenant_id, kb_ids, fields), offset, max_count))
+
+    def iter_chunks(self, doc_id: str, tenant_id: str, kb_ids: list[str],
+                    fields=["docnm_kwd", "content_with_weight", "img_id"], bs=1000):
+        """
+        The chunks of a document with their `fields` and `id`, streamed from the doc store `bs` at a time
+        """
+        return self.dataStore.iterate(fields, {"doc_id": doc_id}, index_name(tenant_id), kb_ids, bs)
+
+    async def aiter_chunks(self, doc_id: str, tenant_id: str, kb_ids: list[str],
+                           fields=["docnm_kwd", "content_with_weight", "img_id"], bs=1000, max_count=None):
+        count = 0
+        async for ck in self.dataStore.aiterate(fields, {"doc_id": doc_id}, index_name(tenant_id), kb_ids, bs):
+            if max_count is not None and count >= max_count:
                 break
-        return res
+            count += 1
+            yield ck
 
     def all_tags(self, tenant_id: str, kb_ids: list[str], S=1000):
         if not self.dataStore.indexExist(index_name(tenant_id), kb_ids[0]):
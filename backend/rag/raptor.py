@@ -13,24 +13,37 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import argparse
+import asyncio
 import logging
 import re
+from timeit import default_timer as timer
 import umap
 import numpy as np
+import xxhash
 from sklearn.mixture import GaussianMixture
 
-from libs.utils import get_llm_cache, get_embed_cache, set_embed_cache, set_llm_cache
+from libs.utils import get_llm_cache, get_embed_cache, set_embed_cache, set_llm_cache, get_raptor_cache, \
+    set_raptor_cache
+from rag.settings import RAPTOR_MAX_CONCURRENCY, RAPTOR_SUMMARY_CACHE_TTL, RAPTOR_UMAP_PARALLEL
 from rag.utils import truncate
 
 
 class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
-    def __init__(self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1):
+    def __init__(self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1,
+                 max_concurrency=RAPTOR_MAX_CONCURRENCY):
         self._max_cluster = max_cluster
         self._llm_model = llm_model
         self._embd_model = embd_model
         self._threshold = threshold
         self._prompt = prompt
         self._max_token = max_token
+        self._max_concurrency = max(1, max_concurrency)
+        # chunks, clusters and seconds spent in UMAP, the mixture search and the summaries, per layer
+        self.layer_stats = []
+        # summaries taken from the ones kept for the same leaf chunks, and the ones generated
+        self.reused_summaries = 0
+        self.generated_summaries = 0
 
     async def _chat(self, system, history, gen_conf):
         response = get_llm_cache(self._llm_model.llm_name, system, history, gen_conf)
@@ -54,30 +67,89 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         set_embed_cache(self._embd_model.llm_name, txt, embds)
         return embds
 
+    async def _embedding_encode_batch(self, txts):
+        """
+        Embeddings of `txts`, the ones not cached encoded in one call.
+        """
+        embds = [get_embed_cache(self._embd_model.llm_name, txt) for txt in txts]
+        missing = [i for i, embd in enumerate(embds) if embd is None]
+        if not missing:
+            return embds
+        encoded, _ = await self._embd_model.encode([txts[i] for i in missing])
+        if len(encoded) != len(missing) or any(len(embd) < 1 for embd in encoded):
+            raise Exception("Embedding error: ")
+        for i, embd in zip(missing, encoded):
+            embds[i] = embd
+            set_embed_cache(self._embd_model.llm_name, txts[i], embd)
+        return embds
+
     def _get_optimal_clusters(self, embeddings: np.ndarray, random_state: int):
+        """
+        The number of components in [1, max_cluster) with the lowest BIC, with its fitted mixture.
+        Every `step`-th number is fitted first, then the ones around the best of them.
+        """
         max_clusters = min(self._max_cluster, len(embeddings))
-        n_clusters = np.arange(1, max_clusters)
-        bics = []
-        for n in n_clusters:
-            gm = GaussianMixture(n_components=n, random_state=random_state)
-            gm.fit(embeddings)
-            bics.append(gm.bic(embeddings))
-        optimal_clusters = n_clusters[np.argmin(bics)]
-        return optimal_clusters
+        if max_clusters <= 2:
+            return 1, None
+        fitted = {}
+
+        def fit(n):
+            if n not in fitted:
+                gm = GaussianMixture(n_components=n, random_state=random_state)
+                gm.fit(embeddings)
+                fitted[n] = (gm.bic(embeddings), gm)
+            return fitted[n][0]
+
+        step = max(1, int(np.sqrt(max_clusters - 1)))
+        best = min(range(1, max_clusters, step), key=fit)
+        best = min(range(max(1, best - step + 1), min(max_clusters, best + step)), key=fit)
+        return best, fitted[best][1]
+
+    def _cluster(self, embeddings, random_state):
+        """
+        Reduce the embeddings of a layer with UMAP and assign them to the mixture components.
+        CPU bound, so it's run in a worker thread.
+        """
+        st = timer()
+        reduced_embeddings = _umap(embeddings, None if RAPTOR_UMAP_PARALLEL else random_state)
+        umap_elapsed = timer() - st
+
+        st = timer()
+        n_clusters, gm = self._get_optimal_clusters(reduced_embeddings, random_state)
+        if n_clusters == 1:
+            lbls = [0 for _ in range(len(reduced_embeddings))]
+        else:
+            # the winner of the search is reused rather than fitted again
+            probs = gm.predict_proba(reduced_embeddings)
+            lbls = [np.where(prob > self._threshold)[0] for prob in probs]
+            lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
+        return n_clusters, lbls, {"umap": umap_elapsed, "gmm": timer() - st}
 
     async def __call__(self, cks, random_state, callback=None):
         layers = [(0, len(cks))]
         start, end = 0, len(cks)
+        self.layer_stats = []
+        self.reused_summaries = self.generated_summaries = 0
         if len(cks) <= 1:
             return []
         chunks = [(content, embedding, i) for content, embedding, i in cks if content and len(embedding) > 0]
+        # a summary is kept by the content hashes of the leaf chunks it covers, which survive a re-parse
+        leaf_hashes = {i[0]: xxhash.xxh64(content.encode("utf-8")).hexdigest()
+                       for content, _, i in chunks if len(i) == 1}
+
+        def cache_args(mixed):
+            return (self._llm_model.llm_name, self._embd_model.llm_name, self._prompt, self._max_token,
+                    [leaf_hashes.get(j, str(j)) for j in mixed])
+
+        semaphore = asyncio.Semaphore(self._max_concurrency)
 
         async def summarize(ck_idx):
-            nonlocal chunks
+            """
+            The chunk standing for a cluster: an existing one, or its summary yet to be embedded (embedding None).
+            """
             if len(ck_idx) == 1:
                 logging.info(f"ck_idx={ck_idx}, not mixed")
-                chunks.append(chunks[0])
-                return
+                return chunks[0]
 
             mixed = []
             for i in ck_idx:
@@ -91,30 +163,62 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                 mx = chunks[i][2]
                 if mx == mixed:
                     logging.info(f"ck_idx={ck_idx}, mixed same")
-                    chunks.append(chunks[i])
-                    return
+                    return chunks[i]
+
+            if RAPTOR_SUMMARY_CACHE_TTL > 0:
+                cached = get_raptor_cache(*cache_args(mixed))
+                if cached:
+                    logging.info(f"ck_idx={ck_idx}, mixed={mixed} reuses its summary")
+                    self.reused_summaries += 1
+                    return cached["content"], np.array(cached["embedding"]), mixed
 
             try:
                 texts = [chunks[i][0] for i in ck_idx]
                 len_per_chunk = int((self._llm_model.max_length - self._max_token) / len(texts))
                 cluster_content = "\n".join([truncate(t, max(1, len_per_chunk)) for t in texts])
                 prompt = self._prompt.format(cluster_content=cluster_content)
-                cnt = await self._chat("You're a helpful assistant.",
-                                       [{"role": "user",
-                                         "content": prompt}],
-                                       {"temperature": 0.3, "max_tokens": self._max_token}
-                                       )
+                async with semaphore:
+                    cnt = await self._chat("You're a helpful assistant.",
+                                           [{"role": "user",
+                                             "content": prompt}],
+                                           {"temperature": 0.3, "max_tokens": self._max_token}
+                                           )
                 logging.info(f"ck_idx={ck_idx}, mixed={mixed}")
-                chunks.append((cnt, await self._embedding_encode(cnt), mixed))
+                return cnt, None, mixed
             except Exception as ex:
                 logging.error("summarize got exception", exc_info=ex)
                 return
 
+        async def summarize_layer(clusters):
+            # the clusters of a layer are summarized concurrently, and appended in their order
+            res = await asyncio.gather(*[summarize(ck_idx) for ck_idx in clusters])
+            todo = [i for i, r in enumerate(res) if r is not None and r[1] is None]
+            if todo:
+                try:
+                    embds = await self._embedding_encode_batch([res[i][0] for i in todo])
+                except Exception as ex:
+                    logging.error("summarize got exception in batch embedding", exc_info=ex)
+                    embds = []
+                    for i in todo:
+                        try:
+                            embds.append(await self._embedding_encode(res[i][0]))
+                        except Exception as ex:
+                            logging.error("summarize got exception", exc_info=ex)
+                            embds.append(None)
+                for i, embd in zip(todo, embds):
+                    res[i] = None if embd is None else (res[i][0], embd, res[i][2])
+                    if res[i] is None:
+                        continue
+                    self.generated_summaries += 1
+                    if RAPTOR_SUMMARY_CACHE_TTL > 0:
+                        set_raptor_cache(*cache_args(res[i][2]), res[i][0], embd, RAPTOR_SUMMARY_CACHE_TTL)
+            chunks.extend([r for r in res if r is not None])
+
         labels = []
         while end - start > 1:
             embeddings = [embd for _, embd, _ in chunks[start: end]]
             if len(embeddings) == 2:
-                await summarize([start, start + 1])
+                await summarize_layer([[start, start + 1]])
                 if callback:
                     await callback(msg="Cluster one layer: {} -> {}".format(end - start, len(chunks) - end))
                 labels.extend([0, 0])
@@ -123,26 +227,21 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                 end = len(chunks)
                 continue
 
-            n_neighbors = int((len(embeddings) - 1) ** 0.8)
-            reduced_embeddings = umap.UMAP(
-                n_neighbors=max(2, n_neighbors), n_components=min(12, len(embeddings) - 2), metric="cosine"
-            ).fit_transform(embeddings)
-            n_clusters = self._get_optimal_clusters(reduced_embeddings, random_state)
-            if n_clusters == 1:
-                lbls = [0 for _ in range(len(reduced_embeddings))]
-            else:
-                gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
-                gm.fit(reduced_embeddings)
-                probs = gm.predict_proba(reduced_embeddings)
-                lbls = [np.where(prob > self._threshold)[0] for prob in probs]
-                lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
+            n_clusters, lbls, elapsed = await asyncio.to_thread(self._cluster, embeddings, random_state)
 
+            clusters = []
             for c in range(n_clusters):
                 ck_idx = [i + start for i in range(len(lbls)) if lbls[i] == c]
                 # len(ck_idx) == 1 导致 1️⃣唯一段被总结 2️⃣递归造成的同一段内容聚类 mixed=[2, 2] mixed=[2, 2, 3, 3]
                 if len(ck_idx) < 1:
                     continue
-                await summarize(ck_idx)
+                clusters.append(ck_idx)
+            st = timer()
+            await summarize_layer(clusters)
+            elapsed["summarize"] = timer() - st
+            self.layer_stats.append({"chunks": end - start, "clusters": n_clusters, **elapsed})
+            logging.info(f"RAPTOR layer {len(layers)}: {end - start} chunks, {n_clusters} clusters, "
+                         + ", ".join(f"{k} {v:.2f}s" for k, v in elapsed.items()))
 
             labels.extend(lbls)
             layers.append((end, len(chunks)))
@@ -151,4 +250,74 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
             start = end
             end = len(chunks)
 
+        logging.info(f"RAPTOR generated {self.generated_summaries} summaries, "
+                     f"reused {self.reused_summaries} of unchanged clusters")
+        if callback and self.reused_summaries:
+            await callback(msg="Reused {} unchanged summaries ({} LLM calls avoided), generated {}".format(
+                self.reused_summaries, self.reused_summaries, self.generated_summaries))
         return chunks
+
+
+def _umap(embeddings, random_state):
+    """
+    The reduced embeddings of a layer. UMAP runs single-threaded when seeded (n_jobs is forced to 1),
+    the seed is what lets a re-run find the same clusters and so the cached summaries.
+    """
+    n_neighbors = int((len(embeddings) - 1) ** 0.8)
+    return umap.UMAP(
+        n_neighbors=max(2, n_neighbors), n_components=min(12, len(embeddings) - 2), metric="cosine",
+        random_state=random_state, n_jobs=1 if random_state is not None else -1
+    ).fit_transform(embeddings)
+
+
+def _full_sweep(embeddings, max_cluster, random_state):
+    """The search the coarse-to-fine one replaced: a mixture fitted for every number of components."""
+    max_clusters = min(max_cluster, len(embeddings))
+    if max_clusters <= 2:
+        return 1, None
+    bics = [GaussianMixture(n_components=n, random_state=random_state).fit(embeddings).bic(embeddings)
+            for n in range(1, max_clusters)]
+    return int(np.argmin(bics)) + 1, float(np.min(bics))
+
+
+if __name__ == "__main__":
+    from sklearn.datasets import make_blobs
+
+    parser = argparse.ArgumentParser(description="Time the seeded and unseeded UMAP, and the full sweep and the "
+                                                 "coarse-to-fine search for the number of clusters of a layer, "
+                                                 "on synthetic embeddings.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 2000, 10000])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--centers", type=int, default=24)
+    parser.add_argument("--max-cluster", type=int, default=64)
+    parser.add_argument("--random-state", type=int, default=0)
+    args = parser.parse_args()
+
+    raptor = RecursiveAbstractiveProcessing4TreeOrganizedRetrieval(args.max_cluster, None, None, None)
+    # numba compiles the UMAP functions on their first calls, seeded and parallel ones alike
+    warmup, _ = make_blobs(n_samples=200, n_features=args.dim, centers=args.centers, random_state=args.random_state)
+    _umap(warmup, args.random_state)
+    _umap(warmup, None)
+    for size in args.sizes:
+        embeddings, _ = make_blobs(n_samples=size, n_features=args.dim, centers=args.centers,
+                                   random_state=args.random_state)
+        st = timer()
+        reduced = _umap(embeddings, args.random_state)
+        umap_elapsed = timer() - st
+
+        st = timer()
+        _umap(embeddings, None)
+        unseeded_elapsed = timer() - st
+
+        st = timer()
+        full_n, full_bic = _full_sweep(reduced, args.max_cluster, args.random_state)
+        full_elapsed = timer() - st
+
+        st = timer()
+        n, gm = raptor._get_optimal_clusters(reduced, args.random_state)
+        elapsed = timer() - st
+        bic = float(gm.bic(reduced)) if gm is not None else None
+
+        print(f"{size} embeddings: umap {umap_elapsed:.2f}s seeded, {unseeded_elapsed:.2f}s unseeded, "
+              f"full sweep {full_n} clusters (bic {full_bic}) in {full_elapsed:.2f}s, "
+              f"coarse-to-fine {n} clusters (bic {bic}) in {elapsed:.2f}s, {full_elapsed / max(elapsed, 1e-9):.1f}x")
@@ -14,7 +14,9 @@
 #  limitations under the License.
 #
 import os
+import json
 import logging
+import tempfile
 
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
 SVR_QUEUE_NAME = "leap_rag_svr_queue"
@@ -25,9 +27,142 @@ SVR_CONSUMER_GROUP_NAME = "leap_rag_svr_consumer_group"
 PAGERANK_FLD = "pagerank_fea"
 TAG_FLD = "tag_feas"
 
+# HTTP transport shared by the remote embedding/rerank providers
+LLM_HTTP_TIMEOUT = float(os.environ.get("LLM_HTTP_TIMEOUT", 60))
+LLM_HTTP_MAX_RETRIES = int(os.environ.get("LLM_HTTP_MAX_RETRIES", 2))
+LLM_HTTP_HEDGE_AFTER = float(os.environ.get("LLM_HTTP_HEDGE_AFTER", 0))
+LLM_HTTP_MAX_CONCURRENCY = int(os.environ.get("LLM_HTTP_MAX_CONCURRENCY", 16))
+LLM_HTTP_POOL_SIZE = int(os.environ.get("LLM_HTTP_POOL_SIZE", 32))
+
+# Page images of the PDF parser: decoded pages kept in memory, and how evicted ones are kept (raw, png or none)
+PDF_PAGE_CACHE_MB = int(os.environ.get("PDF_PAGE_CACHE_MB", 512))
+PDF_PAGE_SPILL = os.environ.get("PDF_PAGE_SPILL", "raw")
+# Seconds the OCR/layout results of a page image are cached for, 0 turns the cache off
+PDF_OCR_CACHE_TTL = int(os.environ.get("PDF_OCR_CACHE_TTL", 7 * 24 * 3600))
+# Local directory they are cached in, and its size budget, the oldest results removed beyond it
+PDF_OCR_CACHE_DIR = os.environ.get("PDF_OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "leaprag_ocr_cache"))
+PDF_OCR_CACHE_MB = int(os.environ.get("PDF_OCR_CACHE_MB", 2048))
+# Detect the pages without any text box again at three times the zoom. Each retry renders the page at up to
+# 648 DPI, so it's off by default; pages with neither chars nor images are never retried
+PDF_OCR_RETRY_ZOOM = int(os.environ.get("PDF_OCR_RETRY_ZOOM", 0))
+# Processes extracting the characters of a PDF's pages, and pages per job; 0 or 1 extracts them in the parser
+PDF_CHARS_WORKERS = int(os.environ.get("PDF_CHARS_WORKERS", 4))
+PDF_CHARS_PAGES_PER_JOB = int(os.environ.get("PDF_CHARS_PAGES_PER_JOB", 16))
+# Build the text boxes of the pages with a reliable text layer from their chars instead of OCR:
+# at least MIN_CHARS chars, a MIN_VALID share of them mapped to Unicode. Image regions over MIN_REGION
+# of the page and without text are still OCRed. Off by default: unlike the OCR path, it reads the chars of
+# English documents too, and its output hasn't been compared with OCR's on a corpus yet.
+PDF_TEXT_LAYER = int(os.environ.get("PDF_TEXT_LAYER", 0))
+PDF_TEXT_LAYER_MIN_CHARS = int(os.environ.get("PDF_TEXT_LAYER_MIN_CHARS", 32))
+PDF_TEXT_LAYER_MIN_VALID = float(os.environ.get("PDF_TEXT_LAYER_MIN_VALID", 0.95))
+PDF_TEXT_LAYER_MIN_REGION = float(os.environ.get("PDF_TEXT_LAYER_MIN_REGION", 0.01))
+
+# ONNX Runtime sessions of the deepdoc models (det, rec, layout, tsr).
+# DEEPDOC_ORT_MODEL_CONF overrides them per model, e.g. {"rec": {"intra_op_num_threads": 4, "int8": true}}
+DEEPDOC_ORT_INTRA_THREADS = int(os.environ.get("DEEPDOC_ORT_INTRA_THREADS", 2))
+DEEPDOC_ORT_INTER_THREADS = int(os.environ.get("DEEPDOC_ORT_INTER_THREADS", 2))
+DEEPDOC_ORT_EXECUTION_MODE = os.environ.get("DEEPDOC_ORT_EXECUTION_MODE", "sequential")
+DEEPDOC_ORT_OPT_LEVEL = os.environ.get("DEEPDOC_ORT_OPT_LEVEL", "all")
+DEEPDOC_ORT_INT8 = int(os.environ.get("DEEPDOC_ORT_INT8", 0))
+DEEPDOC_ORT_MODEL_CONF = json.loads(os.environ.get("DEEPDOC_ORT_MODEL_CONF", "{}"))
+# Load and run the deepdoc models once when a task executor starts
+DEEPDOC_PREWARM = int(os.environ.get("DEEPDOC_PREWARM", 0))
+
+# ONNX Runtime backend of the built-in embedding and rerank models (DefaultEmbedding, DefaultRerank) instead of
+# PyTorch, the model exported once to the model directory. With LOCAL_ORT_INT8 its weights are quantized to int8,
+# kept when it agrees with the fp32 model on a fixed corpus by LOCAL_ORT_MIN_AGREEMENT (mean cosine for
+# embeddings, rank correlation for rerank scores). Inputs are padded to the smallest LOCAL_ORT_BUCKETS length.
+LOCAL_ORT = int(os.environ.get("LOCAL_ORT", 0))
+LOCAL_ORT_INT8 = int(os.environ.get("LOCAL_ORT_INT8", 1))
+LOCAL_ORT_INTRA_THREADS = int(os.environ.get("LOCAL_ORT_INTRA_THREADS", 0))
+LOCAL_ORT_INTER_THREADS = int(os.environ.get("LOCAL_ORT_INTER_THREADS", 1))
+LOCAL_ORT_BUCKETS = [int(b) for b in os.environ.get("LOCAL_ORT_BUCKETS", "32,64,128,256,512").split(",")]
+LOCAL_ORT_MIN_AGREEMENT = float(os.environ.get("LOCAL_ORT_MIN_AGREEMENT", 0.99))
+
+# Micro-batching of the query embeddings and rerank calls of the built-in models: concurrent calls are run as one
+# batch of at most LOCAL_BATCH_MAX_SIZE inputs, the first one waiting up to LOCAL_BATCH_MAX_WAIT_MS for the others
+LOCAL_BATCH = int(os.environ.get("LOCAL_BATCH", 1))
+LOCAL_BATCH_MAX_SIZE = int(os.environ.get("LOCAL_BATCH_MAX_SIZE", 128))
+LOCAL_BATCH_MAX_WAIT_MS = float(os.environ.get("LOCAL_BATCH_MAX_WAIT_MS", 5))
+
+# LLM summaries RAPTOR has in flight at once within a layer
+RAPTOR_MAX_CONCURRENCY = int(os.environ.get("RAPTOR_MAX_CONCURRENCY", 8))
+# Seconds a RAPTOR summary is kept for the leaf chunks it covers, so a re-run only summarizes changed clusters;
+# 0 turns it off
+RAPTOR_SUMMARY_CACHE_TTL = int(os.environ.get("RAPTOR_SUMMARY_CACHE_TTL", 30 * 24 * 3600))
+# Local directory the summaries and their embeddings are kept in, and its size budget
+RAPTOR_SUMMARY_CACHE_DIR = os.environ.get("RAPTOR_SUMMARY_CACHE_DIR",
+                                          os.path.join(tempfile.gettempdir(), "leaprag_raptor_cache"))
+RAPTOR_SUMMARY_CACHE_MB = int(os.environ.get("RAPTOR_SUMMARY_CACHE_MB", 1024))
+# Run the UMAP of a RAPTOR layer unseeded, on all cores. A seeded UMAP is single-threaded, but an unseeded one
+# can cluster a re-run differently, and then its summaries miss the cache
+RAPTOR_UMAP_PARALLEL = int(os.environ.get("RAPTOR_UMAP_PARALLEL", 0))
+
+# Executor shared by the requests parsing uploaded files (ParseService.parse_docs): its workers, processes
+# instead of threads when PARSE_PROCESS_POOL is set, files of a tenant parsed at once and seconds per request
+PARSE_MAX_WORKERS = int(os.environ.get("PARSE_MAX_WORKERS", 8))
+PARSE_PROCESS_POOL = int(os.environ.get("PARSE_PROCESS_POOL", 0))
+PARSE_MAX_PER_TENANT = int(os.environ.get("PARSE_MAX_PER_TENANT", 2))
+PARSE_TIMEOUT = float(os.environ.get("PARSE_TIMEOUT", 300))
+
+# Background removal of deleted documents from the doc store: doc ids per by-query operation, retries of a batch
+DOC_STORE_CLEANUP_QUEUE = "leap_rag_doc_store_cleanup_queue"
+DOC_STORE_CLEANUP_BATCH = int(os.environ.get("DOC_STORE_CLEANUP_BATCH", 500))
+DOC_STORE_CLEANUP_RETRIES = int(os.environ.get("DOC_STORE_CLEANUP_RETRIES", 3))
+
+# Text preview of a document, from its text layer only, shared by the classifier and the parse task:
+# bytes of text kept and seconds it is cached for by file hash, in PDF_OCR_CACHE_DIR
+DOC_PREVIEW_BYTES = int(os.environ.get("DOC_PREVIEW_BYTES", 8 * 1024))
+DOC_PREVIEW_CACHE_TTL = int(os.environ.get("DOC_PREVIEW_CACHE_TTL", 7 * 24 * 3600))
+
 
 def print_rag_settings():
     logging.info(f"MAX_CONTENT_LENGTH: {DOC_MAXIMUM_SIZE}")
     logging.info(f"SERVER_QUEUE_MAX_LEN: {SVR_QUEUE_MAX_LEN}")
     logging.info(f"SERVER_QUEUE_RETENTION: {SVR_QUEUE_RETENTION}")
     logging.info(f"MAX_FILE_COUNT_PER_USER: {int(os.environ.get('MAX_FILE_NUM_PER_USER', 0))}")
+    logging.info(f"LLM_HTTP_TIMEOUT: {LLM_HTTP_TIMEOUT}")
+    logging.info(f"LLM_HTTP_MAX_RETRIES: {LLM_HTTP_MAX_RETRIES}")
+    logging.info(f"LLM_HTTP_HEDGE_AFTER: {LLM_HTTP_HEDGE_AFTER}")
+    logging.info(f"LLM_HTTP_MAX_CONCURRENCY: {LLM_HTTP_MAX_CONCURRENCY}")
+    logging.info(f"PDF_PAGE_CACHE_MB: {PDF_PAGE_CACHE_MB}")
+    logging.info(f"PDF_PAGE_SPILL: {PDF_PAGE_SPILL}")
+    logging.info(f"PDF_OCR_CACHE_TTL: {PDF_OCR_CACHE_TTL}")
+    logging.info(f"PDF_OCR_CACHE_DIR: {PDF_OCR_CACHE_DIR}")
+    logging.info(f"PDF_OCR_CACHE_MB: {PDF_OCR_CACHE_MB}")
+    logging.info(f"PDF_OCR_RETRY_ZOOM: {PDF_OCR_RETRY_ZOOM}")
+    logging.info(f"PDF_CHARS_WORKERS: {PDF_CHARS_WORKERS}")
+    logging.info(f"PDF_CHARS_PAGES_PER_JOB: {PDF_CHARS_PAGES_PER_JOB}")
+    logging.info(f"PDF_TEXT_LAYER: {PDF_TEXT_LAYER}")
+    logging.info(f"PDF_TEXT_LAYER_MIN_CHARS: {PDF_TEXT_LAYER_MIN_CHARS}")
+    logging.info(f"PDF_TEXT_LAYER_MIN_VALID: {PDF_TEXT_LAYER_MIN_VALID}")
+    logging.info(f"PDF_TEXT_LAYER_MIN_REGION: {PDF_TEXT_LAYER_MIN_REGION}")
+    logging.info(f"DEEPDOC_ORT_INTRA_THREADS: {DEEPDOC_ORT_INTRA_THREADS}")
+    logging.info(f"DEEPDOC_ORT_INTER_THREADS: {DEEPDOC_ORT_INTER_THREADS}")
+    logging.info(f"DEEPDOC_ORT_EXECUTION_MODE: {DEEPDOC_ORT_EXECUTION_MODE}")
+    logging.info(f"DEEPDOC_ORT_OPT_LEVEL: {DEEPDOC_ORT_OPT_LEVEL}")
+    logging.info(f"DEEPDOC_ORT_INT8: {DEEPDOC_ORT_INT8}")
+    logging.info(f"DEEPDOC_ORT_MODEL_CONF: {DEEPDOC_ORT_MODEL_CONF}")
+    logging.info(f"DEEPDOC_PREWARM: {DEEPDOC_PREWARM}")
+    logging.info(f"LOCAL_ORT: {LOCAL_ORT}")
+    logging.info(f"LOCAL_ORT_INT8: {LOCAL_ORT_INT8}")
+    logging.info(f"LOCAL_ORT_INTRA_THREADS: {LOCAL_ORT_INTRA_THREADS}")
+    logging.info(f"LOCAL_ORT_INTER_THREADS: {LOCAL_ORT_INTER_THREADS}")
+    logging.info(f"LOCAL_ORT_BUCKETS: {LOCAL_ORT_BUCKETS}")
+    logging.info(f"LOCAL_ORT_MIN_AGREEMENT: {LOCAL_ORT_MIN_AGREEMENT}")
+    logging.info(f"LOCAL_BATCH: {LOCAL_BATCH}")
+    logging.info(f"LOCAL_BATCH_MAX_SIZE: {LOCAL_BATCH_MAX_SIZE}")
+    logging.info(f"LOCAL_BATCH_MAX_WAIT_MS: {LOCAL_BATCH_MAX_WAIT_MS}")
+    logging.info(f"RAPTOR_MAX_CONCURRENCY: {RAPTOR_MAX_CONCURRENCY}")
+    logging.info(f"RAPTOR_SUMMARY_CACHE_TTL: {RAPTOR_SUMMARY_CACHE_TTL}")
+    logging.info(f"RAPTOR_SUMMARY_CACHE_DIR: {RAPTOR_SUMMARY_CACHE_DIR}")
+    logging.info(f"RAPTOR_SUMMARY_CACHE_MB: {RAPTOR_SUMMARY_CACHE_MB}")
+    logging.info(f"RAPTOR_UMAP_PARALLEL: {RAPTOR_UMAP_PARALLEL}")
+    logging.info(f"PARSE_MAX_WORKERS: {PARSE_MAX_WORKERS}")
+    logging.info(f"PARSE_PROCESS_POOL: {PARSE_PROCESS_POOL}")
+    logging.info(f"PARSE_MAX_PER_TENANT: {PARSE_MAX_PER_TENANT}")
+    logging.info(f"PARSE_TIMEOUT: {PARSE_TIMEOUT}")
+    logging.info(f"DOC_STORE_CLEANUP_BATCH: {DOC_STORE_CLEANUP_BATCH}")
+    logging.info(f"DOC_STORE_CLEANUP_RETRIES: {DOC_STORE_CLEANUP_RETRIES}")
+    logging.info(f"DOC_PREVIEW_BYTES: {DOC_PREVIEW_BYTES}")
+    logging.info(f"DOC_PREVIEW_CACHE_TTL: {DOC_PREVIEW_CACHE_TTL}")
@@ -1,3 +1,4 @@
+import asyncio
 import random
 import sys
 
@@ -34,8 +35,11 @@ import tracemalloc
 import numpy as np
 from services import settings
 from rag.app import laws, paper, manual, qa, table, book, picture, naive, one, audio, email, tag
+from rag.llm.micro_batch import micro_batch_stats
 from rag.nlp import search, rag_tokenizer
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
+from deepdoc.parser.preview import document_preview
+from deepdoc.vision.onnx_session import ONNX_SESSIONS
 from rag.settings import DOC_MAXIMUM_SIZE, SVR_QUEUE_NAME, TAG_FLD, PAGERANK_FLD
 from rag.utils import num_tokens_from_string
 from rag.utils.redis_conn import REDIS_CONN, Payload
@@ -226,6 +230,11 @@ async def build_chunks(task, progress_callback):
         logging.error("Chunking {}/{} got exception".format(task["language"], task_document_name), exc_info=ex)
         raise
 
+    # read from the text layer, or the cache the document classifier filled, for the metadata extraction
+    # done by the task of the first pages only
+    if is_first_task(task):
+        task["preview"] = await asyncio.to_thread(document_preview, task_document_name, binary)
+
     try:
         cks = await chunker.chunk(task_document_name, binary=binary, from_page=task["from_page"],
                                   to_page=task["to_page"], lang=task["language"], callback=progress_callback,
@@ -410,8 +419,9 @@ async def run_raptor(task, chat_mdl, embd_mdl, vector_size, callback=None):
     chunks = []
     idx_id_map = {}
     vctr_nm = "q_%d_vec" % vector_size
-    for c in settings.retrievaler.chunk_list(task["doc_id"], task["tenant_id"], [str(task["kb_id"])],
-                                             fields=["content_with_weight", vctr_nm, "idx", "id"]):
+    async for c in settings.retrievaler.aiter_chunks(task["doc_id"], task["tenant_id"], [str(task["kb_id"])],
+                                                     fields=["content_with_weight", vctr_nm, "idx", "id"],
+                                                     max_count=1024):
         idx = int(c.get("idx", 0))
         cid = c.get("id")
         idx_id_map[idx] = cid
@@ -459,15 +469,17 @@ async def run_raptor(task, chat_mdl, embd_mdl, vector_size, callback=None):
     return res, tk_count
 
 
-async def extract_doc_metadata(doc_id, name, tenant_id, language, chunks):
+def is_first_task(task):
+    """Whether the task parses the first pages of its document, the ones its metadata is taken from."""
+    pages = (task.get("parser_config") or {}).get("pages")
+    first = max(0, min([s for s, _ in pages]) - 1) if pages else 0
+    return task["from_page"] <= first
+
+
+async def extract_doc_metadata(doc_id, name, tenant_id, language, chunks, preview=""):
     tenant = await TenantService.get_by_id(tenant_id)
-    content = ""
-    count = 0
-    for ck in chunks:
-        content += ck["content_with_weight"] + "\n"
-        count += 1
-        if count >= 5:
-            break
+    # the preview of the document, or its first chunks when it has no text layer
+    content = preview or "".join([ck["content_with_weight"] + "\n" for ck in chunks[:5]])
     try:
         llm_model = await LLMBundle.create(tenant.id, LLMType.CHAT, llm_name=tenant.llm_id, lang=language)
         runner = AgentRunner(llm_model=llm_model, system_prompt_file="metadata_analysis.json")
@@ -583,13 +595,17 @@ async def do_handle_task(task):
         chunks = await build_chunks(task, progress_callback)
         logging.info(
             "Build document {}: {:.2f}s chunks count:{}".format(task_document_name, timer() - start_ts, len(chunks)))
+        logging.debug(f"deepdoc model latencies: {ONNX_SESSIONS.stats()}")
         if not chunks:
             await progress_callback(1., msg=f"No chunk built from {task_document_name}")
             return
 
-        meta = await extract_doc_metadata(task_doc_id, task_document_name, task_tenant_id, task_language, chunks)
-        if meta is not None:
-            await DocumentService.update_meta_fields(task_doc_id, meta)
+        # the metadata of a document is extracted once, by the task of its first pages
+        if is_first_task(task):
+            meta = await extract_doc_metadata(task_doc_id, task_document_name, task_tenant_id, task_language,
+                                              chunks, task.get("preview", ""))
+            if meta is not None:
+                await DocumentService.update_meta_fields(task_doc_id, meta)
 
         await progress_callback(msg="Generate {} chunks".format(len(chunks)))
         start_ts = timer()
@@ -690,6 +706,8 @@ def report_status():
                     "done": DONE_TASKS,
                     "failed": FAILED_TASKS,
                     "current": CURRENT_TASK,
+                    "deepdoc": ONNX_SESSIONS.stats(),
+                    "micro_batch": micro_batch_stats(),
                 })
             REDIS_CONN.zadd(CONSUMER_NAME, heartbeat, now.timestamp())
             logging.info(f"{CONSUMER_NAME} reported heartbeat: {heartbeat}")
@@ -87,6 +87,24 @@ def num_tokens_from_string(string: str) -> int:
         return 0
 
 
+class StreamTokenCounter:
+    """Counts tokens of the not-yet-emitted tail of a streamed text, encoding only newly arrived characters."""
+
+    def __init__(self):
+        self.seen = 0
+        self.pending = 0
+
+    def feed(self, text: str) -> int:
+        if len(text) < self.seen:
+            self.seen = 0
+        self.pending += num_tokens_from_string(text[self.seen:])
+        self.seen = len(text)
+        return self.pending
+
+    def flush(self):
+        self.pending = 0
+
+
 def truncate(string: str, max_len: int) -> str:
     """Returns truncated text if the length of text exceed max_len."""
     return encoder.decode(encoder.encode(string)[:max_len])
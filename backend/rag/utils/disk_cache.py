@@ -0,0 +1,112 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class DiskCache(object):
+    """
+    JSON values kept as files under `directory`, the expiry of each stored as its modification time.
+    Once the directory may have grown over `max_bytes`, or every `sweep_every` writes since processes sharing
+    it don't see each other's, expired files and then the oldest ones are removed until it's under 80% of it.
+    Values are written to a temporary file first, so a reader never gets a partial one.
+    """
+
+    def __init__(self, directory, max_bytes, sweep_every=256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sweep_every = sweep_every
+        self._lock = threading.Lock()
+        self._size = None
+        self._writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.stat(path).st_mtime < time.time():
+                os.remove(path)
+                return
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception:
+            logging.exception(f"DiskCache fails to read {path}")
+
+    def set(self, key, value, exp):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            expire = time.time() + exp
+            os.utime(tmp, (expire, expire))
+            os.replace(tmp, path)
+            size = os.path.getsize(path)
+        except Exception:
+            logging.exception(f"DiskCache fails to write {path}")
+            return
+        with self._lock:
+            self._writes += 1
+            if self._size is not None:
+                self._size += size
+            if self._size is not None and self._size <= self.max_bytes and self._writes < self.sweep_every:
+                return
+            self._writes = 0
+        self.sweep()
+
+    def sweep(self):
+        """Remove the expired files, then the oldest ones while over the size budget."""
+        now = time.time()
+        files, size = [], 0
+        for root, _, names in os.walk(self.directory):
+            for nm in names:
+                path = os.path.join(root, nm)
+                try:
+                    st = os.stat(path)
+                    if nm.endswith(".tmp"):
+                        # being written, or left behind by a killed writer
+                        if st.st_mtime < now - 3600:
+                            os.remove(path)
+                        continue
+                    if st.st_mtime < now:
+                        os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                size += st.st_size
+        if size > self.max_bytes:
+            # values share a ttl, the ones expiring first are the oldest
+            files.sort()
+            for _, file_size, path in files:
+                if size <= self.max_bytes * 0.8:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= file_size
+        with self._lock:
+            self._size = size
@@ -14,6 +14,8 @@
 #  limitations under the License.
 #
 
+import asyncio
+import copy
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 import numpy as np
@@ -208,6 +210,57 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    def multiSearch(self, searches: list[dict]) -> list:
+        """
+        Run several searches, each given as the keyword arguments of `search`, and return their results in order
+        """
+        return [self.search(**search) for search in searches]
+
+    def iterateBatches(self, selectFields: list[str], condition: dict, indexNames: str | list[str],
+                       knowledgebaseIds: list[str], batchSize: int = 1000):
+        """
+        Iterate over the rows matching the condition, in lists of at most `batchSize` rows holding `selectFields`
+        and their `id`. This default pages with `search`; connections able to read a consistent snapshot of the
+        index page after page, with constant cost per page, override it.
+        """
+        offset = 0
+        while True:
+            res = self.search(selectFields, [], copy.deepcopy(condition), [], OrderByExpr(), offset, batchSize,
+                              indexNames, knowledgebaseIds)
+            rows = self.getFields(res, selectFields)
+            for id, row in rows.items():
+                row["id"] = id
+            if rows:
+                yield list(rows.values())
+            if len(self.getChunkIds(res)) < batchSize:
+                break
+            offset += batchSize
+
+    def iterate(self, selectFields: list[str], condition: dict, indexNames: str | list[str],
+                knowledgebaseIds: list[str], batchSize: int = 1000):
+        """
+        Iterate over the rows matching the condition, see `iterateBatches`
+        """
+        for rows in self.iterateBatches(selectFields, condition, indexNames, knowledgebaseIds, batchSize):
+            yield from rows
+
+    async def aiterate(self, selectFields: list[str], condition: dict, indexNames: str | list[str],
+                       knowledgebaseIds: list[str], batchSize: int = 1000):
+        """
+        Async generator form of `iterate`, each batch fetched in a worker thread
+        """
+        batches = self.iterateBatches(selectFields, condition, indexNames, knowledgebaseIds, batchSize)
+        try:
+            while True:
+                rows = await asyncio.to_thread(next, batches, None)
+                if rows is None:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            # releases what the iteration holds, e.g. a point in time, when the caller stops early
+            await asyncio.to_thread(batches.close)
+
     @abstractmethod
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         """
@@ -14,6 +14,8 @@
 #  limitations under the License.
 #
 
+import functools
+import inspect
 import logging
 import re
 import json
@@ -25,6 +27,7 @@ from elasticsearch import Elasticsearch, NotFoundError
 from elasticsearch_dsl import UpdateByQuery, Q, Search, Index
 from elastic_transport import ConnectionTimeout
 from rag.settings import TAG_FLD, PAGERANK_FLD
+from libs.utils import set_kb_chunks_changed
 from rag.utils import singleton
 from services.utils.file_utils import get_project_base_directory
 from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
@@ -32,10 +35,28 @@ from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr,
 from rag.nlp import is_english, rag_tokenizer
 
 ATTEMPT_TIME = 2
+# how long a point in time iterated over is kept open between two pages
+PIT_KEEP_ALIVE = "5m"
 
 logger = logging.getLogger('leaprag.es_conn')
 
 
+def _marks_kb_changed(fn):
+    """Record that the chunks of the written knowledge base changed, for the caches keyed on them."""
+    sig = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            kb_id = sig.bind(*args, **kwargs).arguments.get("knowledgebaseId")
+            if kb_id:
+                set_kb_chunks_changed(kb_id, time.time())
+
+    return wrapper
+
+
 @singleton
 class ESConnection(DocStoreConnection):
     def __init__(self):
@@ -146,6 +167,136 @@ class ESConnection(DocStoreConnection):
         if isinstance(indexNames, str):
             indexNames = indexNames.split(",")
         assert isinstance(indexNames, list) and len(indexNames) > 0
+        q = self._searchBody(selectFields, highlightFields, condition, matchExprs, orderBy, offset, limit,
+                             knowledgebaseIds, aggFields, rank_feature)
+        logger.debug(f"ESConnection.search {str(indexNames)} query: " + json.dumps(q))
+
+        for i in range(ATTEMPT_TIME):
+            try:
+                # print(json.dumps(q, ensure_ascii=False))
+                res = self.es.search(index=indexNames,
+                                     body=q,
+                                     timeout="600s",
+                                     # search_type="dfs_query_then_fetch",
+                                     track_total_hits=True,
+                                     _source=True)
+                if str(res.get("timed_out", "")).lower() == "true":
+                    raise Exception("Es Timeout.")
+                logger.debug(f"ESConnection.search {str(indexNames)} res: " + str(res))
+                return res
+            except Exception as e:
+                logger.exception(f"ESConnection.search {str(indexNames)} query: " + str(q))
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        logger.error("ESConnection.search timeout for 3 times!")
+        raise Exception("ESConnection.search timeout.")
+
+    def multiSearch(self, searches: list[dict]) -> list:
+        """
+        Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/search-multi-search.html
+        """
+        if not searches:
+            return []
+        body = []
+        for search in searches:
+            indexNames = search["indexNames"]
+            if isinstance(indexNames, str):
+                indexNames = indexNames.split(",")
+            q = self._searchBody(search["selectFields"], search["highlightFields"], search["condition"],
+                                 search["matchExprs"], search["orderBy"], search["offset"], search["limit"],
+                                 search["knowledgebaseIds"], search.get("aggFields", []), search.get("rank_feature"))
+            q["track_total_hits"] = True
+            q["timeout"] = "600s"
+            body.append({"index": indexNames})
+            body.append(q)
+        logger.debug("ESConnection.multiSearch query: " + json.dumps(body))
+
+        responses = None
+        for i in range(ATTEMPT_TIME):
+            try:
+                responses = self.es.msearch(searches=body)["responses"]
+                break
+            except Exception as e:
+                logger.exception("ESConnection.multiSearch got exception")
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        if responses is None:
+            logger.error("ESConnection.multiSearch timeout for 3 times!")
+            raise Exception("ESConnection.multiSearch timeout.")
+
+        res = []
+        for search, r in zip(searches, responses):
+            # A failed or timed-out item is redone on its own so that it gets the retries of `search`.
+            if "error" in r or str(r.get("timed_out", "")).lower() == "true":
+                logger.warning(f"ESConnection.multiSearch item failed, retry it alone: {r.get('error')}")
+                r = self.search(**search)
+            res.append(r)
+        return res
+
+    def iterateBatches(self, selectFields: list[str], condition: dict, indexNames: str | list[str],
+                       knowledgebaseIds: list[str], batchSize: int = 1000):
+        """
+        Pages through a point in time of the indices with `search_after` on `_shard_doc`, so each page costs the
+        same however deep it is and no result window caps the rows. Only `selectFields` are fetched.
+        Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html
+        """
+        if isinstance(indexNames, str):
+            indexNames = indexNames.split(",")
+        q = self._searchBody(selectFields, [], copy.deepcopy(condition), [], OrderByExpr(), 0, 0, knowledgebaseIds)
+        q.update({"size": batchSize, "sort": [{"_shard_doc": "asc"}], "_source": selectFields, "timeout": "600s"})
+        try:
+            pit = self.es.open_point_in_time(index=indexNames, keep_alive=PIT_KEEP_ALIVE)["id"]
+        except NotFoundError:
+            return
+        try:
+            while True:
+                q["pit"] = {"id": pit, "keep_alive": PIT_KEEP_ALIVE}
+                res = self._pitSearch(q)
+                pit = res.get("pit_id", pit)
+                hits = res["hits"]["hits"]
+                rows = self.getFields(res, selectFields)
+                for id, row in rows.items():
+                    row["id"] = id
+                if rows:
+                    yield list(rows.values())
+                if len(hits) < batchSize:
+                    break
+                q["search_after"] = hits[-1]["sort"]
+        finally:
+            try:
+                self.es.close_point_in_time(id=pit)
+            except Exception:
+                logger.warning("ESConnection.iterateBatches fails to close its point in time")
+
+    def _pitSearch(self, q: dict):
+        logger.debug("ESConnection.iterateBatches query: " + json.dumps(q))
+        for i in range(ATTEMPT_TIME):
+            try:
+                res = self.es.search(body=q)
+                if str(res.get("timed_out", "")).lower() == "true":
+                    raise Exception("Es Timeout.")
+                return res
+            except Exception as e:
+                logger.exception("ESConnection.iterateBatches query: " + str(q))
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        logger.error("ESConnection.iterateBatches timeout for 3 times!")
+        raise Exception("ESConnection.iterateBatches timeout.")
+
+    def _searchBody(self, selectFields: list[str],
+                    highlightFields: list[str],
+                    condition: dict,
+                    matchExprs: list[MatchExpr],
+                    orderBy: OrderByExpr,
+                    offset: int,
+                    limit: int,
+                    knowledgebaseIds: list[str],
+                    aggFields: list[str] = [],
+                    rank_feature: dict | None = None
+                    ) -> dict:
         assert "_id" not in condition
 
         bqry = Q("bool", must=[])
@@ -231,29 +382,7 @@ class ESConnection(DocStoreConnection):
 
         if limit > 0:
             s = s[offset:offset + limit]
-        q = s.to_dict()
-        logger.debug(f"ESConnection.search {str(indexNames)} query: " + json.dumps(q))
-
-        for i in range(ATTEMPT_TIME):
-            try:
-                # print(json.dumps(q, ensure_ascii=False))
-                res = self.es.search(index=indexNames,
-                                     body=q,
-                                     timeout="600s",
-                                     # search_type="dfs_query_then_fetch",
-                                     track_total_hits=True,
-                                     _source=True)
-                if str(res.get("timed_out", "")).lower() == "true":
-                    raise Exception("Es Timeout.")
-                logger.debug(f"ESConnection.search {str(indexNames)} res: " + str(res))
-                return res
-            except Exception as e:
-                logger.exception(f"ESConnection.search {str(indexNames)} query: " + str(q))
-                if str(e).find("Timeout") > 0:
-                    continue
-                raise e
-        logger.error("ESConnection.search timeout for 3 times!")
-        raise Exception("ESConnection.search timeout.")
+        return s.to_dict()
 
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         for i in range(ATTEMPT_TIME):
@@ -275,6 +404,7 @@ class ESConnection(DocStoreConnection):
         logger.error("ESConnection.get timeout for 3 times!")
         raise Exception("ESConnection.get timeout.")
 
+    @_marks_kb_changed
     def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
         # Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
         operations = []
@@ -311,6 +441,7 @@ class ESConnection(DocStoreConnection):
                     continue
         return res
 
+    @_marks_kb_changed
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
@@ -352,7 +483,10 @@ class ESConnection(DocStoreConnection):
                     scripts.append(f"ctx._source.remove('{v}');")
                 if isinstance(v, dict):
                     for kk, vv in v.items():
-                        scripts.append(f"int i=ctx._source.{kk}.indexOf(params.p_{kk});ctx._source.{kk}.remove(i);")
+                        if isinstance(vv, list):
+                            scripts.append(f"ctx._source.{kk}.removeAll(params.p_{kk});")
+                        else:
+                            scripts.append(f"int i=ctx._source.{kk}.indexOf(params.p_{kk});ctx._source.{kk}.remove(i);")
                         params[f"p_{kk}"] = vv
                 continue
             if k == "add":
@@ -394,6 +528,7 @@ class ESConnection(DocStoreConnection):
                 break
         return False
 
+    @_marks_kb_changed
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
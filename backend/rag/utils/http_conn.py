@@ -0,0 +1,156 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+
+import httpx
+
+from rag.settings import LLM_HTTP_TIMEOUT, LLM_HTTP_MAX_RETRIES, LLM_HTTP_HEDGE_AFTER, LLM_HTTP_MAX_CONCURRENCY, \
+    LLM_HTTP_POOL_SIZE
+from rag.utils import singleton
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+logger = logging.getLogger('leaprag.http_conn')
+
+
+class _ProviderStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.hedges = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, elapsed):
+        self.latency_sum += elapsed
+        for i, b in enumerate(LATENCY_BUCKETS):
+            if elapsed <= b:
+                self.latency_buckets[i] += 1
+                return
+        self.latency_buckets[-1] += 1
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "latency_avg": self.latency_sum / self.requests if self.requests else 0.0,
+            "latency_buckets": {str(b): c for b, c in zip(LATENCY_BUCKETS + ["+Inf"], self.latency_buckets)},
+        }
+
+
+@singleton
+class HttpConn:
+    """
+    Pooled HTTP transport for the remote embedding/rerank providers: one keep-alive client per host,
+    retries with jittered backoff, optional request hedging and a concurrency cap per provider.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._semaphores = {}
+        self._stats = defaultdict(_ProviderStats)
+        self._lock = threading.Lock()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=LLM_HTTP_POOL_SIZE, thread_name_prefix="http_hedge")
+
+    def _client(self, url) -> httpx.Client:
+        host = "{0.scheme}://{0.netloc}".format(urlsplit(url))
+        with self._lock:
+            if host not in self._clients:
+                self._clients[host] = httpx.Client(
+                    http2=HTTP2,
+                    timeout=httpx.Timeout(LLM_HTTP_TIMEOUT, connect=min(10.0, LLM_HTTP_TIMEOUT)),
+                    limits=httpx.Limits(max_connections=LLM_HTTP_POOL_SIZE,
+                                        max_keepalive_connections=LLM_HTTP_POOL_SIZE,
+                                        keepalive_expiry=60))
+            return self._clients[host]
+
+    def _semaphore(self, provider) -> threading.BoundedSemaphore:
+        with self._lock:
+            if provider not in self._semaphores:
+                self._semaphores[provider] = threading.BoundedSemaphore(LLM_HTTP_MAX_CONCURRENCY)
+            return self._semaphores[provider]
+
+    def _send(self, provider, method, url, **kwargs) -> httpx.Response:
+        client = self._client(url)
+        if LLM_HTTP_HEDGE_AFTER <= 0:
+            return client.request(method, url, **kwargs)
+        # Hedging: if the first attempt hasn't answered within LLM_HTTP_HEDGE_AFTER seconds, race a second one.
+        futures = [self._hedge_pool.submit(client.request, method, url, **kwargs)]
+        done, _ = wait(futures, timeout=LLM_HTTP_HEDGE_AFTER)
+        if not done:
+            with self._lock:
+                self._stats[provider].hedges += 1
+            futures.append(self._hedge_pool.submit(client.request, method, url, **kwargs))
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        first = done.pop()
+        if first.exception() is not None and len(futures) > 1:
+            other = futures[1] if first is futures[0] else futures[0]
+            return other.result()
+        return first.result()
+
+    def request(self, provider: str, method: str, url: str, **kwargs) -> httpx.Response:
+        with self._semaphore(provider):
+            for i in range(LLM_HTTP_MAX_RETRIES + 1):
+                st = time.perf_counter()
+                try:
+                    res = self._send(provider, method, url, **kwargs)
+                    retryable = res.status_code in RETRY_STATUS
+                    err = None
+                except httpx.TransportError as e:
+                    res, retryable, err = None, True, e
+                elapsed = time.perf_counter() - st
+                with self._lock:
+                    stats = self._stats[provider]
+                    stats.requests += 1
+                    stats.observe(elapsed)
+                    if err is not None or res.status_code >= 400:
+                        stats.errors += 1
+                if not retryable or i == LLM_HTTP_MAX_RETRIES:
+                    break
+                with self._lock:
+                    self._stats[provider].retries += 1
+                logger.warning(f"HttpConn {provider} {url} got {err or res.status_code}, retry {i + 1}")
+                time.sleep(random.uniform(0, min(8.0, 0.5 * 2 ** i)))
+        if err is not None:
+            raise err
+        return res
+
+    def post(self, provider: str, url: str, **kwargs) -> httpx.Response:
+        return self.request(provider, "POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {provider: s.to_dict() for provider, s in self._stats.items()}
+
+
+HTTP_CONN = HttpConn()
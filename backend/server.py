@@ -0,0 +1,77 @@
+import logging
+from contextlib import asynccontextmanager
+from fastapi.middleware.cors import CORSMiddleware
+from starlette import status
+from starlette.middleware.base import _StreamingResponse
+from starlette.responses import JSONResponse
+from app_factory import create_app
+from configs import app_config
+from libs.base_error import BusinessError
+from models.database import set_db_session_context, AsyncScopedSession
+from services.utils import get_uuid
+from rag.settings import print_rag_settings
+from services import settings
+from fastapi import Request, Response, FastAPI
+from typing import Callable, Awaitable
+
+settings.init_settings()
+print_rag_settings()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logging.warning(f"starting tasks in DEBUG:{app_config.DEBUG}")
+    # if app_config.DEBUG:
+    #     asyncio.create_task(asyncio_periodic_progress())
+    #     asyncio.create_task(asyncio_periodic_task())
+    yield
+
+
+app = create_app(lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=['*'],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.middleware("http")
+async def db_session_middleware_function(request: Request,
+                                         call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    session_id = get_uuid()
+    set_db_session_context(session_id=session_id)
+    try:
+        response = await call_next(request)
+        if isinstance(response, _StreamingResponse):
+            original_iterator = response.body_iterator
+
+            async def wrapped_iterator():
+                try:
+                    async for chunk in original_iterator:
+                        yield chunk
+                finally:
+                    await AsyncScopedSession.remove()
+                    set_db_session_context(session_id=None)
+
+            response.body_iterator = wrapped_iterator()
+        else:
+            await AsyncScopedSession.remove()
+            set_db_session_context(session_id=None)
+
+    except Exception as e:
+        await AsyncScopedSession.remove()
+        set_db_session_context(session_id=None)
+        raise e
+
+    return response
+
+
+@app.exception_handler(BusinessError)
+async def business_exception_handler(request: Request, e: BusinessError):
+    content = {'error_code': e.error_code, 'message': e.description}
+    if e.data:
+        content['data'] = e.data
+    return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        content=content)
@@ -73,3 +73,58 @@ def structure_answer(conv, ans, message_id, session_id):
     if conv.reference:
         conv.reference[-1] = reference
     return ans
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import random
+    from types import SimpleNamespace
+    from rag.utils import encoder, num_tokens_from_string, StreamTokenCounter
+
+    parser = argparse.ArgumentParser(description="Bytes and CPU of streaming an answer as full or delta SSE events, "
+                                                 "on a synthetic token stream.")
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--chunks", type=int, default=8, help="chunks in the reference of the final event")
+    args = parser.parse_args()
+
+    random.seed(0)
+    words = ["retrieval", "answer", "document", "知识库", "检索", "the", "of", "model", "chunk", "page", "表格", "。"]
+    tokens = encoder.encode(" ".join(random.choice(words) for _ in range(args.tokens)))[:args.tokens]
+    # what chat_streamly yields: the whole answer so far, one token more each time
+    stream = [encoder.decode(tokens[:i]) for i in range(1, len(tokens) + 1)]
+    reference = {"chunks": [{"chunk_id": str(i), "content_with_weight": "content " * 100, "doc_id": "d",
+                             "docnm_kwd": "doc.pdf", "kb_id": "kb", "positions": [[1, 0, 0, 0, 0]]}
+                            for i in range(args.chunks)], "doc_aggs": []}
+
+    def sse(ans):
+        return "data:" + json.dumps({"code": 0, "message": "", "data": ans}, ensure_ascii=False) + "\n\n"
+
+    def run(delta):
+        """The events of chat() in one mode as conversation_resource sends them: bytes sent and CPU seconds."""
+        conv = SimpleNamespace(messages=[], reference=[{}])
+        st = time.process_time()
+        sent, events = 0, 0
+        last_ans = ""
+        counter = StreamTokenCounter()
+        for ans in stream:
+            if delta:
+                if counter.feed(ans) < 16:
+                    continue
+                counter.flush()
+                out = {"answer": ans[len(last_ans):], "delta": True, "reference": {}, "id": "m", "session_id": "s"}
+            else:
+                if num_tokens_from_string(ans[len(last_ans):]) < 16:
+                    continue
+                out = structure_answer(conv, {"answer": ans, "reference": {}}, "m", "s")
+            last_ans = ans
+            sent += len(sse(out).encode("utf-8"))
+            events += 1
+        final = structure_answer(conv, {"answer": stream[-1], "reference": json.loads(json.dumps(reference))},
+                                 "m", "s")
+        sent += len(sse(final).encode("utf-8"))
+        return sent, events + 1, time.process_time() - st
+
+    for nm, delta in [("full", False), ("delta", True)]:
+        sent, events, cpu = run(delta)
+        print(f"{nm}: {len(tokens)} tokens, {events} events, {sent / 1024:.1f} KB sent, {cpu * 1000:.1f} ms CPU")
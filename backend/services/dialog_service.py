@@ -19,11 +19,12 @@ from services.document_service import DocumentService
 from services.knowledgebase_service import KnowledgebaseService
 from services.llm_service import TenantLLMService, LLMBundle
 from services import settings
-from libs.utils import get_tags_from_cache, set_tags_to_cache
+from libs.utils import get_tags_from_cache, set_tags_to_cache, get_sql_cache, set_sql_cache, \
+    get_sql_result_cache, set_sql_result_cache, get_kb_chunks_changed
 from rag.nlp import extract_between
 from rag.nlp.search import index_name
 from rag.settings import TAG_FLD
-from rag.utils import rmSpace, num_tokens_from_string, encoder
+from rag.utils import rmSpace, num_tokens_from_string, encoder, StreamTokenCounter
 from services.utils.file_utils import get_project_base_directory
 from rag.utils.tavily_conn import Tavily
 from sqlalchemy import select, and_
@@ -248,7 +249,7 @@ async def label_question(question, kbs):
     return tags
 
 
-async def chat_solo(dialog, messages, stream=True):
+async def chat_solo(dialog, messages, stream=True, **kwargs):
     if llm_id2llm_type(dialog.llm_id) == "image2text":
         chat_mdl = await LLMBundle.create(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
     else:
@@ -261,13 +262,25 @@ async def chat_solo(dialog, messages, stream=True):
     msg = [{"role": m["role"], "content": re.sub(r"##\d+\$\$", "", m["content"])}
            for m in messages if m["role"] != "system"]
     if stream:
+        delta = kwargs.get("delta", False)
         last_ans = ""
+        answer = ""
+        tk_counter = StreamTokenCounter()
         async for ans in chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting):
             answer = ans
             delta_ans = ans[len(last_ans):]
-            if num_tokens_from_string(delta_ans) < 16:
+            if tk_counter.feed(ans) < 16:
                 continue
+            tk_counter.flush()
             last_ans = answer
+            if delta:
+                yield {"answer": delta_ans, "delta": True, "reference": {}, "audio_binary": await tts(tts_mdl, delta_ans),
+                       "prompt": "", "created_at": time.time()}
+            else:
+                yield {"answer": answer, "reference": {}, "audio_binary": await tts(tts_mdl, delta_ans), "prompt": "",
+                       "created_at": time.time()}
+        if delta:
+            delta_ans = answer[len(last_ans):]
             yield {"answer": answer, "reference": {}, "audio_binary": await tts(tts_mdl, delta_ans), "prompt": "",
                    "created_at": time.time()}
     else:
@@ -281,7 +294,7 @@ async def chat_solo(dialog, messages, stream=True):
 async def chat(dialog, messages, stream=True, **kwargs):
     assert messages[-1]["role"] == "user", "The last content of this conversation is not from user."
     if not dialog.kb_ids:
-        async for ans in chat_solo(dialog, messages, stream):
+        async for ans in chat_solo(dialog, messages, stream, delta=kwargs.get("delta", False)):
             yield ans
         return
 
@@ -334,7 +347,11 @@ async def chat(dialog, messages, stream=True, **kwargs):
     # try to use sql if field mapping is good to go
     if field_map:
         logging.debug("Use SQL to retrieval:{}".format(questions[-1]))
-        ans = await use_sql(questions[-1], field_map, dialog.tenant_id, chat_mdl, prompt_config.get("quote", True))
+        # edits and switches of single chunks change none of the kb columns, the doc store marks them
+        kb_version = "|".join(sorted([f"{kb.id}:{kb.doc_num}:{kb.chunk_num}:{kb.updated_at}" for kb in kbs])) + \
+            "|" + get_kb_chunks_changed([kb.id for kb in kbs])
+        ans = await use_sql(questions[-1], field_map, dialog.tenant_id, chat_mdl, prompt_config.get("quote", True),
+                            kb_version=kb_version)
         if ans:
             yield ans
             return
@@ -474,20 +491,33 @@ async def chat(dialog, messages, stream=True, **kwargs):
                 "created_at": time.time()}
 
     if stream:
+        # In delta mode only the newly generated text is emitted; the final event carries the full
+        # answer together with its references.
+        delta = kwargs.get("delta", False)
         last_ans = ""
         answer = ""
+        tk_counter = StreamTokenCounter()
         async for ans in chat_mdl.chat_streamly(prompt, msg[1:], gen_conf):
             if thought:
                 ans = re.sub(r"<think>.*</think>", "", ans, flags=re.DOTALL)
             answer = ans
             delta_ans = ans[len(last_ans):]
-            if num_tokens_from_string(delta_ans) < 16:
+            if tk_counter.feed(ans) < 16:
                 continue
+            tk_counter.flush()
+            if delta:
+                yield {"answer": (thought if not last_ans else "") + delta_ans, "delta": True, "reference": {},
+                       "audio_binary": await tts(tts_mdl, delta_ans)}
+            else:
+                yield {"answer": thought + answer, "reference": {}, "audio_binary": await tts(tts_mdl, delta_ans)}
             last_ans = answer
-            yield {"answer": thought + answer, "reference": {}, "audio_binary": await tts(tts_mdl, delta_ans)}
         delta_ans = answer[len(last_ans):]
         if delta_ans:
-            yield {"answer": thought + answer, "reference": {}, "audio_binary": await tts(tts_mdl, delta_ans)}
+            if delta:
+                yield {"answer": (thought if not last_ans else "") + delta_ans, "delta": True, "reference": {},
+                       "audio_binary": await tts(tts_mdl, delta_ans)}
+            else:
+                yield {"answer": thought + answer, "reference": {}, "audio_binary": await tts(tts_mdl, delta_ans)}
         yield await decorate_answer(thought + answer)
         return
     else:
@@ -500,7 +530,63 @@ async def chat(dialog, messages, stream=True, **kwargs):
         return
 
 
-async def use_sql(question, field_map, tenant_id, chat_mdl, quota=True):
+SQL_LITERAL_PATTERN = r"'[^']+'|\"[^\"]+\"|\b[0-9]+(\.[0-9]+)?\b"
+SQL_CONSTANT_PATTERN = r"'[^']*'|\b[0-9]+(\.[0-9]+)?\b"
+SQL_SLOT_PATTERN = re.compile(r"(?<!\{)\{[0-9]+\}(?!\})")
+
+
+def normalize_sql_question(question):
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return re.sub(r"[?？。.!！ ]+$", "", question)
+
+
+def sql_question_template(question):
+    """
+    Split a question into a literal-free template and the literals (quoted strings, numbers) it carries,
+    so that questions differing only in those literals share one cached SQL.
+    """
+    question = normalize_sql_question(question)
+    literals = []
+
+    def _slot(m):
+        literals.append(m.group(0).strip("'\""))
+        return "{%d}" % (len(literals) - 1)
+
+    return re.sub(SQL_LITERAL_PATTERN, _slot, question), literals
+
+
+def compile_sql_template(sql, literals):
+    """
+    Replace each question literal in the SQL by its slot. Returns None if a literal can't be located
+    unambiguously, or if the SQL holds a constant no slot accounts for, in which case only the exact
+    question is worth caching.
+    """
+    if len(set(literals)) != len(literals):
+        return None
+    sql = sql.replace("{", "{{").replace("}", "}}")
+    for i, lit in enumerate(literals):
+        pattern = r"(?<![a-z0-9_.])%s(?![a-z0-9_.])" % re.escape(lit.lower())
+        if len(re.findall(pattern, sql)) != 1:
+            return None
+        sql = re.sub(pattern, "{%d}" % i, sql)
+
+    # any other constant would stay hard-coded in the SQL of every question sharing the template,
+    # e.g. the upper bound of `date >= '2023-01-01' and date < '2024-01-01'`
+    rest = re.sub(r"'[^']*'", lambda m: " " if SQL_SLOT_PATTERN.search(m.group(0)) else m.group(0), sql)
+    rest = SQL_SLOT_PATTERN.sub(" ", rest)
+    if re.search(SQL_CONSTANT_PATTERN, rest):
+        return None
+    return sql
+
+
+def bind_sql_template(sql_tpl, literals):
+    try:
+        return sql_tpl.format(*[str(lit).lower().replace("'", "''") for lit in literals])
+    except (IndexError, KeyError, ValueError):
+        return None
+
+
+async def use_sql(question, field_map, tenant_id, chat_mdl, quota=True, kb_version=None):
     sys_prompt = "You are a Database Administrator. You need to check the fields of the following tables based on the user's list of questions and write the SQL corresponding to the last question."
     user_prompt = """
 Table name: {};
@@ -516,6 +602,17 @@ Please write the SQL, only SQL, without any other explanations or text.
         question
     )
     tried_times = 0
+    question_tpl, literals = sql_question_template(question)
+
+    def execute(sql):
+        tbl = get_sql_result_cache(sql, kb_version) if kb_version else None
+        if tbl is not None:
+            logging.debug(f"{question} hit SQL result cache: {sql}")
+            return tbl
+        tbl = settings.retrievaler.sql_retrieval(sql, format="json")
+        if kb_version and tbl is not None and not tbl.get("error"):
+            set_sql_result_cache(sql, kb_version, tbl)
+        return tbl
 
     async def get_table():
         nonlocal sys_prompt, user_prompt, question, tried_times
@@ -541,9 +638,23 @@ Please write the SQL, only SQL, without any other explanations or text.
 
         logging.debug(f"{question} get SQL(refined): {sql}")
         tried_times += 1
-        return settings.retrievaler.sql_retrieval(sql, format="json"), sql
+        return execute(sql), sql
+
+    # A question already answered, or sharing its template with one, reuses the validated SQL without the LLM.
+    tbl, sql = None, None
+    sql_tpl = get_sql_cache(tenant_id, normalize_sql_question(question), field_map)
+    if sql_tpl is None and literals:
+        sql_tpl = get_sql_cache(tenant_id, question_tpl, field_map)
+    if sql_tpl:
+        sql = bind_sql_template(sql_tpl, literals)
+        if sql:
+            tbl = execute(sql)
+            logging.debug(f"{question} hit SQL template cache: {sql}")
+        if tbl is not None and tbl.get("error"):
+            tbl, sql = None, None
 
-    tbl, sql = await get_table()
+    if tbl is None:
+        tbl, sql = await get_table()
     if tbl is None:
         return None
     if tbl.get("error") and tried_times <= 2:
@@ -573,9 +684,17 @@ Please write the SQL, only SQL, without any other explanations or text.
         logging.debug("TRY it again: {}".format(sql))
 
     logging.debug("GET table: {}".format(tbl))
-    if tbl.get("error") or len(tbl["rows"]) == 0:
+    if tbl is None or tbl.get("error") or len(tbl["rows"]) == 0:
         return None
 
+    if tried_times > 0:
+        compiled = compile_sql_template(sql, literals)
+        if compiled:
+            set_sql_cache(tenant_id, question_tpl, field_map, compiled)
+        else:
+            set_sql_cache(tenant_id, normalize_sql_question(question), field_map,
+                          sql.replace("{", "{{").replace("}", "}}"))
+
     docid_idx = set([ii for ii, c in enumerate(
         tbl["columns"]) if c["name"] == "doc_id"])
     doc_name_idx = set([ii for ii, c in enumerate(
@@ -0,0 +1,149 @@
+import json
+import logging
+import socket
+import threading
+import time
+
+from rag.nlp import search
+from rag.settings import DOC_STORE_CLEANUP_QUEUE, DOC_STORE_CLEANUP_BATCH, DOC_STORE_CLEANUP_RETRIES
+from rag.utils.redis_conn import REDIS_CONN
+from services import settings
+from services.utils import get_uuid
+
+CLEANUP_GROUP_NAME = "leap_rag_doc_store_cleanup_group"
+CLEANUP_CONSUMER_NAME = "doc_store_cleanup_" + socket.gethostname()
+# progress of a job is kept for a week after its last change
+PROGRESS_EXPIRE = 7 * 24 * 3600
+GRAPH_KWDS = ["entity", "relation", "graph", "community_report"]
+
+
+class DocStoreCleanupService:
+    """
+    Removes the chunks, and knowledge graph references, of deleted documents and knowledge bases from the
+    doc store in the background. Jobs are queued in a Redis stream and acknowledged once done, so a job
+    interrupted by a restart is taken up again by `cleanup_worker`.
+    """
+
+    @staticmethod
+    def submit(tenant_id, kb_id, doc_ids=None, drop_kb=False, job_id=None):
+        """
+        Queue the removal of `doc_ids` of a knowledge base, or of the whole knowledge base with `drop_kb`.
+        Returns the job id to follow its progress with; when it can't be queued the job is run in a thread of
+        this process instead, lost if it exits first.
+        """
+        doc_ids = list(doc_ids or [])
+        job = {"id": job_id or get_uuid(), "tenant_id": tenant_id, "kb_id": kb_id, "doc_ids": doc_ids, "drop_kb": drop_kb}
+        total = 1 if drop_kb else (len(doc_ids) + DOC_STORE_CLEANUP_BATCH - 1) // DOC_STORE_CLEANUP_BATCH + 1
+        DocStoreCleanupService._set_progress(job["id"], {"status": "pending", "total": total, "done": 0,
+                                                         "failed": 0})
+        if not REDIS_CONN.queue_product(DOC_STORE_CLEANUP_QUEUE, message=job):
+            logging.error(f"DocStoreCleanupService can't queue the removal of {len(doc_ids)} docs of kb {kb_id}, "
+                          f"running it in a thread")
+            # never on the caller's thread, which may be the event loop of a request
+            threading.Thread(target=DocStoreCleanupService.run, args=(job,), name=f"doc_store_cleanup_{job['id']}",
+                             daemon=True).start()
+        return job["id"]
+
+    @staticmethod
+    def progress(job_id):
+        bin = REDIS_CONN.get("doc_store_cleanup_" + job_id)
+        if not bin:
+            return
+        return json.loads(bin)
+
+    @staticmethod
+    def _set_progress(job_id, progress):
+        REDIS_CONN.set("doc_store_cleanup_" + job_id, json.dumps(progress), PROGRESS_EXPIRE)
+
+    @staticmethod
+    def _retry(desc, fn):
+        for i in range(DOC_STORE_CLEANUP_RETRIES + 1):
+            try:
+                if fn() is not False:
+                    return True
+            except Exception as ex:
+                logging.warning(f"DocStoreCleanupService {desc} got exception: {ex}")
+            if i < DOC_STORE_CLEANUP_RETRIES:
+                time.sleep(min(2 ** i, 30))
+        logging.error(f"DocStoreCleanupService {desc} failed after {DOC_STORE_CLEANUP_RETRIES} retries")
+        return False
+
+    @staticmethod
+    def run(job):
+        conn = settings.docStoreConn
+        idx_nm = search.index_name(job["tenant_id"])
+        kb_id = job["kb_id"]
+        progress = {"status": "running", "total": 0, "done": 0, "failed": 0}
+
+        if job.get("drop_kb"):
+            progress["total"] = 1
+
+            def drop():
+                conn.delete({"kb_id": kb_id}, idx_nm, kb_id)
+                conn.deleteIdx(idx_nm, kb_id)
+
+            ok = DocStoreCleanupService._retry(f"dropping kb {kb_id}", drop)
+            progress["done" if ok else "failed"] += 1
+        else:
+            doc_ids = job["doc_ids"]
+            slices = [doc_ids[i: i + DOC_STORE_CLEANUP_BATCH] for i in range(0, len(doc_ids), DOC_STORE_CLEANUP_BATCH)]
+            progress["total"] = len(slices) + 1
+            for ids in slices:
+                # one by-query operation per slice of documents instead of per document
+                def remove_docs():
+                    conn.delete({"doc_id": ids}, idx_nm, kb_id)
+                    return conn.update({"kb_id": kb_id, "knowledge_graph_kwd": GRAPH_KWDS, "source_id": ids},
+                                       {"remove": {"source_id": ids}}, idx_nm, kb_id)
+
+                ok = DocStoreCleanupService._retry(f"removing {len(ids)} docs of kb {kb_id}", remove_docs)
+                progress["done" if ok else "failed"] += 1
+                DocStoreCleanupService._set_progress(job["id"], progress)
+
+            # the graph of the knowledge base is marked stale and its orphaned entries dropped once per job
+            def clean_graph():
+                if not conn.update({"kb_id": kb_id, "knowledge_graph_kwd": ["graph"]}, {"removed_kwd": "Y"},
+                                   idx_nm, kb_id):
+                    return False
+                conn.delete({"kb_id": kb_id, "knowledge_graph_kwd": GRAPH_KWDS, "must_not": {"exists": "source_id"}},
+                            idx_nm, kb_id)
+
+            ok = DocStoreCleanupService._retry(f"cleaning the graph of kb {kb_id}", clean_graph)
+            progress["done" if ok else "failed"] += 1
+
+        progress["status"] = "failed" if progress["failed"] else "done"
+        DocStoreCleanupService._set_progress(job["id"], progress)
+        logging.info(f"DocStoreCleanupService job {job['id']} of kb {kb_id}: {progress}")
+
+
+class CleanupBatch:
+    """
+    The documents deleted in a transaction, by knowledge base: registered with `after_commit`, it queues one job
+    per knowledge base once their rows are gone.
+    """
+
+    def __init__(self):
+        self.doc_ids = {}
+
+    def add(self, tenant_id, kb_id, doc_id):
+        self.doc_ids.setdefault((tenant_id, kb_id), []).append(doc_id)
+
+    def __call__(self):
+        for (tenant_id, kb_id), doc_ids in self.doc_ids.items():
+            DocStoreCleanupService.submit(tenant_id, kb_id, doc_ids)
+
+
+def cleanup_worker():
+    """Run the queued doc store cleanup jobs, the unacknowledged one of this host first."""
+    while True:
+        try:
+            payload = REDIS_CONN.get_unacked_for(CLEANUP_CONSUMER_NAME, DOC_STORE_CLEANUP_QUEUE, CLEANUP_GROUP_NAME)
+            if not payload:
+                payload = REDIS_CONN.queue_consumer(DOC_STORE_CLEANUP_QUEUE, CLEANUP_GROUP_NAME, CLEANUP_CONSUMER_NAME)
+            if not payload:
+                time.sleep(1)
+                continue
+            DocStoreCleanupService.run(payload.get_message())
+            payload.ack()
+        except Exception:
+            logging.exception("cleanup_worker got exception")
+            time.sleep(5)
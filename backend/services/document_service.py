@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import xxhash
 import json
@@ -9,22 +10,24 @@ from io import BytesIO
 from sqlalchemy import func, desc, asc, update
 from sqlalchemy.dialects.postgresql import insert
 
+from deepdoc.parser.preview import document_preview
 from leapai_prompts.agent_runner import AgentRunner
 from models.knowledgebase import ParserType
 from rag.app import naive
-from services import settings
 from services.llm_service import LLMBundle
 from services.utils import current_timestamp, get_format_time, get_uuid
 from rag.settings import SVR_QUEUE_NAME
 from extensions.ext_storage import storage as STORAGE_IMPL
-from rag.nlp import search, rag_tokenizer
+from rag.nlp import rag_tokenizer
 from datetime import datetime, UTC
 from sqlalchemy import select
 from services.common_service import CommonService
 from models import FileSource, File2Document, File, FileType, TaskStatus, LLMType, StatusEnum, transactional, \
-    TenantAccountJoin, Knowledgebase, Tenant, Task, Document, get_current_session
+    TenantAccountJoin, Knowledgebase, Tenant, Task, Document, get_current_session, \
+    after_commit
 from rag.utils.redis_conn import REDIS_CONN
 from services.utils.time_out import Timer
+from services.doc_store_cleanup_service import CleanupBatch
 
 
 class File2DocumentService(CommonService):
@@ -138,24 +141,15 @@ class DocumentService(CommonService):
 
     @classmethod
     @transactional
-    async def remove_document(cls, doc, tenant_id):
+    async def remove_document(cls, doc, tenant_id, clean_doc_store=True):
+        """
+        Delete the document; its chunks are removed from the doc store by a background job, unless the caller
+        removes them itself (`clean_doc_store=False`), e.g. with the whole knowledge base. The job is queued
+        once the transaction commits, along with those of the other documents it deletes.
+        """
         await cls.decrease_chunk_num_doc_num(doc.id)
-        try:
-            settings.docStoreConn.delete({"doc_id": doc.id}, search.index_name(tenant_id), doc.kb_id)
-            settings.docStoreConn.update(
-                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "community_report"],
-                 "source_id": doc.id},
-                {"remove": {"source_id": doc.id}},
-                search.index_name(tenant_id), doc.kb_id)
-            settings.docStoreConn.update({"kb_id": doc.kb_id, "knowledge_graph_kwd": ["graph"]},
-                                         {"removed_kwd": "Y"},
-                                         search.index_name(tenant_id), doc.kb_id)
-            settings.docStoreConn.delete(
-                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "community_report"],
-                 "must_not": {"exists": "source_id"}},
-                search.index_name(tenant_id), doc.kb_id)
-        except Exception as ex:
-            logging.error("remove document error", exc_info=ex)
+        if clean_doc_store:
+            after_commit("doc_store_cleanup", CleanupBatch).add(tenant_id, doc.kb_id, doc.id)
 
         return await cls.delete_by_id(doc.id)
 
@@ -533,44 +527,59 @@ class DocumentService(CommonService):
     async def run_document_classifier(cls, doc, kb, tenant):
         bucket, name = await File2DocumentService.get_storage_address(doc_id=doc.id)
         binary = get_storage_binary(bucket, name)
-        try:
-            cks = await naive.chunk(doc.name, binary=binary, from_page=0, to_page=10, lang=kb.language,
-                                    callback=simple_progress_callback,
-                                    kb_id=kb.id, parser_config=doc.parser_config, tenant_id=tenant.id)
-        except Exception as ex:
-            logging.error("run_document_classifier chunking {}/{} got exception".format(doc.id, name), exc_info=ex)
-            return ""
-
-        content = ""
-        count = 0
-        for ck in cks:
-            content += ck["content_with_weight"] + "\n"
-            count += 1
-            if count >= 5:
-                break
+        # the text layer is enough to tell the kind of a document, the parse task reuses the cached preview
+        content = await asyncio.to_thread(document_preview, doc.name, binary)
+        if not content:
+            # scanned documents have no text layer, their first chunks are read as before
+            try:
+                cks = await naive.chunk(doc.name, binary=binary, from_page=0, to_page=10, lang=kb.language,
+                                        callback=simple_progress_callback,
+                                        kb_id=kb.id, parser_config=doc.parser_config, tenant_id=tenant.id)
+            except Exception as ex:
+                logging.error("run_document_classifier chunking {}/{} got exception".format(doc.id, name),
+                              exc_info=ex)
+                return ""
+            content = "\n".join([ck["content_with_weight"] for ck in cks[:5]])
 
         try:
             llm_model = await LLMBundle.create(tenant.id, LLMType.CHAT, llm_name=tenant.llm_id, lang=kb.language)
+            # classification and its verification in one round
+            runner = AgentRunner(llm_model=llm_model, system_prompt_file="document_classify_verify.json")
+            result = await runner(file_name=name, file_content=content)
+            logging.info(f"run document_classify_verify result {result}")
+            parse_id = cls._suggested_parser(result)
+            if parse_id:
+                return parse_id
+
+            # the model didn't answer in the combined format, classify and verify in two rounds
             runner = AgentRunner(llm_model=llm_model, system_prompt_file="document_classifier.json")
             result = await runner(file_name=name, file_content=content)
             logging.info(f"run document_classifier result {result}")
 
             runner = AgentRunner(llm_model=llm_model, system_prompt_file="document_verifier.json")
             result = await runner(file_name=name, file_content=content, parser_id=result)
-            # 尝试提取json内容，如果有```json标记的话
-            json_content = re.search(r'```json\n(.*?)\n```', result, re.DOTALL)
-            if json_content:
-                json_str = json_content.group(1)
-            else:
-                json_str = result
             logging.info(f"run document_verifier result {result}")
-            json_data = json.loads(json_str)
-            parse_id = json_data.get("suggested_alternative", "")
-            return parse_id
+            return cls._suggested_parser(result)
         except Exception as ex:
             logging.error("run_document_classifier {}/{} got exception".format(doc.id, name), exc_info=ex)
             return ""
 
+    @staticmethod
+    def _suggested_parser(result):
+        # 尝试提取json内容，如果有```json标记的话
+        json_content = re.search(r'```json\n(.*?)\n```', result, re.DOTALL)
+        if json_content:
+            json_str = json_content.group(1)
+        else:
+            json_str = result
+        try:
+            json_data = json.loads(json_str)
+        except json.JSONDecodeError:
+            return ""
+        if not isinstance(json_data, dict):
+            return ""
+        return json_data.get("suggested_alternative", "")
+
 
 @transactional
 async def queue_raptor_o_graphrag_tasks(doc, ty, msg):
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -340,20 +341,27 @@ class LLMBundle:
         return cls(tenant_id, llm_type, llm_name, mdl, model_config)
 
     async def encode(self, texts: list):
-        embeddings, used_tokens = self.mdl.encode(texts)
+        embeddings, used_tokens = await asyncio.to_thread(self.mdl.encode, texts)
         if not await TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error(f"LLMBundle.encode can't update token usage for {self.tenant_id} {self.llm_type}")
         return embeddings, used_tokens
 
     async def encode_queries(self, query: str):
-        emd, used_tokens = self.mdl.encode_queries(query)
+        emd, used_tokens = await asyncio.to_thread(self.mdl.encode_queries, query)
         if not await TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error(
                 f"LLMBundle.encode_queries can't update token usage for for {self.tenant_id} {self.llm_type}")
         return emd, used_tokens
 
+    async def encode_queries_batch(self, queries: list):
+        embds, used_tokens = await asyncio.to_thread(self.mdl.encode_queries_batch, queries)
+        if not await TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+            logging.error(
+                f"LLMBundle.encode_queries_batch can't update token usage for for {self.tenant_id} {self.llm_type}")
+        return embds, used_tokens
+
     async def similarity(self, query: str, texts: list):
-        sim, used_tokens = self.mdl.similarity(query, texts)
+        sim, used_tokens = await asyncio.to_thread(self.mdl.similarity, query, texts)
         if not await TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error(f"LLMBundle.similarity can't update token usage for for {self.tenant_id} {self.llm_type}")
         return sim, used_tokens
@@ -1,47 +1,157 @@
-import re
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from models import File, FileType
 from models.knowledgebase import ParserType
 from services.common_service import CommonService
+from libs.base_error import BusinessError
+from services.service_error_code import ServiceErrorCode
 
 from services.utils.file_utils import filename_type, get_parser
 from rag.app import picture, naive, audio, email
+from rag.settings import PARSE_MAX_WORKERS, PARSE_MAX_PER_TENANT, PARSE_TIMEOUT, PARSE_PROCESS_POOL
+
+FACTORY = {
+    ParserType.PICTURE.value: picture,
+    ParserType.AUDIO.value: audio,
+    ParserType.EMAIL.value: email
+}
+# parsers calling the tenant's models run on the event loop, the CPU bound ones in the parse executor;
+# a picture is OCRed in the executor and only described by the tenant's CV model on the loop
+IO_PARSERS = {ParserType.AUDIO.value}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+async def _no_progress(prog=None, msg=""):
+    pass
+
+
+def _chunk_text(chunks):
+    return "\n".join([ck["content_with_weight"] for ck in chunks])
+
+
+def _chunk_in_worker(parser_id, filename, blob, kwargs):
+    """Run in the parse executor, with an event loop of its own for the async chunkers."""
+    chunker = FACTORY.get(parser_id, naive)
+    return _chunk_text(asyncio.run(chunker.chunk(filename, blob, callback=_no_progress, **kwargs)))
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if PARSE_PROCESS_POOL:
+                _executor = ProcessPoolExecutor(max_workers=PARSE_MAX_WORKERS,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            else:
+                _executor = ThreadPoolExecutor(max_workers=PARSE_MAX_WORKERS, thread_name_prefix="parse")
+        return _executor
+
+
+class _TenantSlots:
+    """
+    PARSE_MAX_PER_TENANT parse slots per tenant. The semaphore of a tenant is dropped once no one holds
+    or waits for one of its slots, so they don't pile up with the tenants seen.
+    """
+
+    def __init__(self):
+        self._semaphores = {}
+        self._users = {}
+
+    async def acquire(self, tenant_id):
+        if tenant_id not in self._semaphores:
+            self._semaphores[tenant_id] = asyncio.Semaphore(PARSE_MAX_PER_TENANT)
+        self._users[tenant_id] = self._users.get(tenant_id, 0) + 1
+        try:
+            await self._semaphores[tenant_id].acquire()
+        except BaseException:
+            self._leave(tenant_id)
+            raise
+
+    def release(self, tenant_id):
+        self._semaphores[tenant_id].release()
+        self._leave(tenant_id)
+
+    def _leave(self, tenant_id):
+        self._users[tenant_id] -= 1
+        if not self._users[tenant_id]:
+            del self._users[tenant_id]
+            del self._semaphores[tenant_id]
+
+
+_tenant_slots = _TenantSlots()
 
 
 class ParseService(CommonService):
     model = File
 
     @staticmethod
-    async def parse_docs(file_objs, tenant_id):
+    async def _run_in_executor(tenant_id, fn, *args):
+        """
+        `fn(*args)` in the parse executor, in a slot of the tenant. A running job can't be interrupted, so
+        its slot is held until it finishes even once its caller is cancelled or timed out.
+        """
+        await _tenant_slots.acquire(tenant_id)
+        try:
+            fut = _get_executor().submit(fn, *args)
+        except BaseException:
+            _tenant_slots.release(tenant_id)
+            raise
+        loop = asyncio.get_running_loop()
+        fut.add_done_callback(lambda _: loop.call_soon_threadsafe(_tenant_slots.release, tenant_id))
+        try:
+            return await asyncio.wrap_future(fut)
+        except asyncio.CancelledError:
+            # a job not started yet is dropped, a running one's result is discarded
+            fut.cancel()
+            raise
 
-        def dummy(prog=None, msg=""):
-            pass
+    @staticmethod
+    async def _parse_file(filename, blob, tenant_id, kwargs):
+        parser_id = get_parser(filename_type(filename), filename, "")
+        if parser_id == ParserType.PICTURE.value:
+            ocr_result = await ParseService._run_in_executor(tenant_id, picture.ocr_image, blob)
+            return _chunk_text(await picture.chunk(filename, blob, callback=_no_progress, ocr_result=ocr_result,
+                                                   **kwargs))
+        if parser_id in IO_PARSERS:
+            await _tenant_slots.acquire(tenant_id)
+            try:
+                return _chunk_text(await FACTORY[parser_id].chunk(filename, blob, callback=_no_progress, **kwargs))
+            finally:
+                _tenant_slots.release(tenant_id)
+        return await ParseService._run_in_executor(tenant_id, _chunk_in_worker, parser_id, filename, blob, kwargs)
 
-        FACTORY = {
-            ParserType.PICTURE.value: picture,
-            ParserType.AUDIO.value: audio,
-            ParserType.EMAIL.value: email
-        }
+    @staticmethod
+    async def parse_docs(file_objs, tenant_id, timeout=PARSE_TIMEOUT):
+        """
+        Text of the uploaded files, parsed in the shared parse executor with at most PARSE_MAX_PER_TENANT
+        files of a tenant at once. Cancelling the request, e.g. when the client disconnects, cancels the
+        files not parsed yet; BusinessError is raised once `timeout` seconds are spent.
+        """
         parser_config = {"chunk_token_num": 16096, "delimiter": "\n!?;。；！？", "layout_recognize": "Plain Text"}
-        exe = ThreadPoolExecutor(max_workers=12)
-        threads = []
+        kwargs = {
+            "lang": "English",
+            "parser_config": parser_config,
+            "from_page": 0,
+            "to_page": 100000,
+            "tenant_id": tenant_id
+        }
+        tasks = []
         for file in file_objs:
-            kwargs = {
-                "lang": "English",
-                "callback": dummy,
-                "parser_config": parser_config,
-                "from_page": 0,
-                "to_page": 100000,
-                "tenant_id": tenant_id
-            }
-            filetype = filename_type(file.filename)
             blob = await file.read()
-            threads.append(
-                exe.submit(FACTORY.get(get_parser(filetype, file.filename, ""), naive).chunk, file.filename,
-                           blob, **kwargs))
+            tasks.append(asyncio.create_task(ParseService._parse_file(file.filename, blob, tenant_id, kwargs)))
 
-        res = []
-        for th in threads:
-            res.append("\n".join([ck["content_with_weight"] for ck in th.result()]))
+        try:
+            res = await asyncio.wait_for(asyncio.gather(*tasks), timeout=timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            logging.warning(f"ParseService.parse_docs of tenant {tenant_id} timed out after {timeout}s")
+            raise BusinessError(ServiceErrorCode.PARSE_TIMEOUT, f"Parsing timed out after {timeout}s")
+        finally:
+            for t in tasks:
+                t.cancel()
 
         return "\n\n".join(res)
@@ -80,3 +80,4 @@ class ServiceErrorCode(str, Enum):
     NOT_SUPPORT = "not_support"
     NO_AUTHORIZATION = "no_authorization"
     INVALID_LLM = "invalid_llm"
+    PARSE_TIMEOUT = "parse_timeout"
@@ -4,6 +4,7 @@ import xxhash
 from datetime import datetime
 from sqlalchemy import select, func, update, delete
 from sqlalchemy.dialects.postgresql import insert
+from configs import app_config
 from models import get_current_session, transactional
 from models import File2Document, File
 from models import StatusEnum, FileType, TaskStatus
@@ -241,9 +242,10 @@ async def queue_tasks(doc: dict, bucket: str, name: str):
                                          chunking_config["kb_id"])
     await DocumentService.update_by_id(doc["id"], {"chunk_num": ck_num})
 
-    for task in parse_task_array:
-        stmt = insert(Task).values(**task).on_conflict_do_nothing()
-        await session.execute(stmt)
+    # one multi-row INSERT per chunk, the rows given the same columns
+    rows = [{"chunk_ids": "", "progress_msg": "", **task} for task in parse_task_array]
+    for chunk in CommonService.cut_list(rows, app_config.SQLALCHEMY_BULK_CHUNK_SIZE):
+        await session.execute(insert(Task).on_conflict_do_nothing(), list(chunk))
 
     await DocumentService.begin2parse(doc["id"])
 